@@ -0,0 +1,85 @@
+import collections
+import configparser
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+# xeroticket reads its config (and starts logging) on import, so the tests point it at a copy of the template with
+# two nodes and every state file in a scratch directory before anything imports it
+config_dir = tempfile.mkdtemp(prefix="xeroticket-tests-")
+config = configparser.ConfigParser(interpolation=None)
+config.optionxform = str
+config.read(os.path.join(repo_dir, "xeroticket.ini.template"))
+config["Xero"].update({
+    "xero_nodes": "xero1,xero2",
+    "disabled_servers_file": os.path.join(config_dir, "disabled_servers.txt"),
+    "failing_servers_file": os.path.join(config_dir, "failing_servers.txt"),
+    "circuit_breakers_file": os.path.join(config_dir, "circuit_breakers.txt"),
+    "restart_times_file": os.path.join(config_dir, "restart_times.txt"),
+    "state_db_file": os.path.join(config_dir, "xero_state.db"),
+})
+config["Email"].update({
+    "smtp_port": "25",
+    "smtp_recipients": "oncall@example.invalid",
+    "smtp_spool_dir": os.path.join(config_dir, "email_spool"),
+})
+config["Logging"]["log_file"] = os.path.join(config_dir, "xero_ticket.log")
+config["Run"]["deferred_work_file"] = os.path.join(config_dir, "deferred_work.txt")
+config_path = os.path.join(config_dir, "xeroticket.ini")
+with open(config_path, "w") as file:
+    config.write(file)
+os.environ["XEROTICKET_CONFIG"] = config_path
+
+import xeroticket  # noqa: E402
+
+
+@pytest.fixture
+def xt():
+    return xeroticket
+
+
+# Fresh state files for the test
+@pytest.fixture
+def state(xt, tmp_path, monkeypatch):
+    for cluster in xt.clusters:
+        monkeypatch.setattr(cluster, "disabled_servers_file", str(tmp_path / f"disabled_servers_{cluster.name}.txt"))
+        monkeypatch.setattr(cluster, "failing_servers_file", str(tmp_path / f"failing_servers_{cluster.name}.txt"))
+        cluster.open_stores()
+    for name in xt.shared_store_names:
+        monkeypatch.setattr(xt, f"{name}_store", xt.open_state_store(name, str(tmp_path / f"{name}.txt")))
+    return tmp_path
+
+
+# Stands in for the time module, the test moves it on by setting now
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+FakeTime = collections.namedtuple("FakeTime", "clock emails")
+
+
+# xeroticket's clock under the test's control, and the (node, subject) of every email instead of sending it
+@pytest.fixture
+def fake_time(xt, monkeypatch):
+    clock = Clock()
+    emails = []
+    monkeypatch.setattr(xt, "time", clock)
+    monkeypatch.setattr(xt, "send_email", lambda recipients, subject, body, node, meme_data=None: emails.append((node, subject)))
+    monkeypatch.setattr(xt.settings, "use_memes", False)
+    return FakeTime(clock, emails)
@@ -0,0 +1,94 @@
+import pytest
+
+
+# Every test starts with xero1 disabled
+@pytest.fixture(autouse=True)
+def disabled_node(xt, state, fake_time, monkeypatch):
+    monkeypatch.setattr(xt.settings, "xero_breaker_probe_interval", 300)
+    monkeypatch.setattr(xt.settings, "xero_breaker_max_probe_interval", 1000)
+    monkeypatch.setattr(xt.settings, "xero_breaker_close_successes", 2)
+    xt.DisabledServerManager.save_disabled_server("xero1", "INC0000001")
+
+
+# What the probe engine reports: an open breaker only checks reachability unless a full probe is due
+def reachability_only(reachable=True):
+    return {"breaker": "open", "reachable": reachable, "healthy": False}
+
+
+def full_probe(healthy):
+    return {"breaker": "half_open", "reachable": True, "healthy": healthy}
+
+
+def entry(xt):
+    return xt.circuit_breakers_store.get("xero1")
+
+
+def test_disabled_node_opens_its_breaker(xt, fake_time):
+    assert xt.CircuitBreaker.state("xero1") == "open"
+    xt.CircuitBreaker.record_probe_results({"xero1": reachability_only()})
+    assert entry(xt) == {"state": "open", "since": fake_time.clock.now, "interval": 300,
+                         "next_probe": fake_time.clock.now + 300, "successes": 0}
+    assert not xt.CircuitBreaker.full_probe_due("xero1", fake_time.clock.now + 299)
+    assert xt.CircuitBreaker.full_probe_due("xero1", fake_time.clock.now + 300)
+
+
+def test_reachability_check_alone_changes_nothing(xt, fake_time):
+    xt.CircuitBreaker.record_probe_results({"xero1": reachability_only()})
+    opened = entry(xt)
+    fake_time.clock.now += 100
+    xt.CircuitBreaker.record_probe_results({"xero1": reachability_only()})
+    xt.CircuitBreaker.record_probe_results({"xero1": reachability_only(reachable=False)})
+    assert entry(xt) == opened
+
+
+def test_failed_full_probes_back_off_up_to_the_maximum(xt, fake_time):
+    xt.CircuitBreaker.record_probe_results({"xero1": reachability_only()})
+    intervals = []
+    for _ in range(4):
+        fake_time.clock.now = entry(xt)["next_probe"]
+        xt.CircuitBreaker.record_probe_results({"xero1": full_probe(healthy=False)})
+        intervals.append(entry(xt)["interval"])
+    assert intervals == [600, 1000, 1000, 1000]
+    assert entry(xt)["state"] == "open"
+    assert entry(xt)["next_probe"] == fake_time.clock.now + 1000
+
+
+def test_unreachable_node_counts_as_a_failed_probe_once_due(xt, fake_time):
+    xt.CircuitBreaker.record_probe_results({"xero1": reachability_only()})
+    fake_time.clock.now = entry(xt)["next_probe"]
+    xt.CircuitBreaker.record_probe_results({"xero1": reachability_only(reachable=False)})
+    assert entry(xt)["interval"] == 600
+
+
+def test_closes_after_enough_passing_probes(xt, fake_time):
+    xt.CircuitBreaker.record_probe_results({"xero1": reachability_only()})
+    fake_time.clock.now = entry(xt)["next_probe"]
+    xt.CircuitBreaker.record_probe_results({"xero1": full_probe(healthy=True)})
+    assert xt.CircuitBreaker.state("xero1") == "half_open"
+    # a half-open node is fully probed every run
+    assert xt.CircuitBreaker.full_probe_due("xero1", fake_time.clock.now)
+    assert xt.DisabledServerManager.is_server_disabled("xero1")
+
+    xt.CircuitBreaker.record_probe_results({"xero1": full_probe(healthy=True)})
+    assert entry(xt) is None
+    assert xt.CircuitBreaker.state("xero1") == "closed"
+    assert not xt.DisabledServerManager.is_server_disabled("xero1")
+    assert len(fake_time.emails) == 1 and "Restored on xero1" in fake_time.emails[0][1]
+
+
+def test_failure_while_half_open_reopens_without_doubling(xt, fake_time):
+    xt.CircuitBreaker.record_probe_results({"xero1": reachability_only()})
+    fake_time.clock.now = entry(xt)["next_probe"]
+    xt.CircuitBreaker.record_probe_results({"xero1": full_probe(healthy=True)})
+    xt.CircuitBreaker.record_probe_results({"xero1": full_probe(healthy=False)})
+    assert entry(xt)["state"] == "open"
+    assert entry(xt)["interval"] == 300
+    assert entry(xt)["successes"] == 0
+
+
+def test_node_enabled_some_other_way_drops_its_breaker(xt, fake_time):
+    xt.CircuitBreaker.record_probe_results({"xero1": reachability_only()})
+    xt.DisabledServerManager.remove_disabled_server("xero1")
+    xt.CircuitBreaker.record_probe_results({"xero1": {"breaker": "closed", "reachable": None, "healthy": True}})
+    assert entry(xt) is None
+    assert xt.CircuitBreaker.state("xero1") == "closed"
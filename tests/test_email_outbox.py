@@ -0,0 +1,93 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+
+import pytest
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.messages = []
+        super().__init__(("127.0.0.1", 0), SmtpHandler)
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 sink")
+        data = None
+        for line in self.rfile:
+            line = line.decode().rstrip("\r\n")
+            if data is not None:
+                if line == ".":
+                    self.server.messages.append("\n".join(data))
+                    data = None
+                    self.reply("250 ok")
+                else:
+                    data.append(line)
+            elif line.upper().startswith("DATA"):
+                data = []
+                self.reply("354 go on")
+            elif line.upper().startswith("QUIT"):
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+@pytest.fixture
+def outbox(xt, tmp_path, monkeypatch):
+    monkeypatch.setattr(xt.settings, "smtp_spool_dir", str(tmp_path / "email_spool"))
+    monkeypatch.setattr(xt.settings, "smtp_server", "127.0.0.1")
+    monkeypatch.setattr(xt.settings, "smtp_retry_attempts", 1)
+    monkeypatch.setattr(xt.settings, "email_digest_mode", False)
+    return xt.EmailOutbox()
+
+
+@pytest.fixture
+def sink(xt, monkeypatch):
+    sink = SmtpSink()
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    monkeypatch.setattr(xt.settings, "smtp_port", sink.server_address[1])
+    yield sink
+    sink.shutdown()
+    sink.server_close()
+
+
+def spool(xt, count):
+    os.makedirs(xt.settings.smtp_spool_dir, exist_ok=True)
+    for index in range(count):
+        with open(os.path.join(xt.settings.smtp_spool_dir, f"1700000000.00000{index}-spooled.json"), "w") as file:
+            json.dump({"smtp_from": "xero@example.invalid", "recipients": ["oncall@example.invalid"],
+                       "message": f"Subject: spooled {index}\n\nspooled by an earlier run"}, file)
+
+
+def test_close_resends_mail_spooled_by_an_earlier_run(xt, outbox, sink):
+    spool(xt, 3)
+    outbox.close(timeout=10)
+    assert sorted(message.splitlines()[0] for message in sink.messages) == [f"Subject: spooled {index}" for index in range(3)]
+    assert outbox.spooled_paths() == []
+
+
+def test_new_and_spooled_mail_are_each_sent_once(xt, outbox, sink):
+    spool(xt, 2)
+    outbox.put("xero@example.invalid", ["oncall@example.invalid"], "Subject: new\n\nqueued by this run")
+    outbox.close(timeout=10)
+    assert sorted(message.splitlines()[0] for message in sink.messages) == ["Subject: new", "Subject: spooled 0", "Subject: spooled 1"]
+    assert outbox.spooled_paths() == []
+
+
+def test_mail_stays_spooled_while_the_relay_is_down(xt, outbox, monkeypatch):
+    with socket.socket() as unused:
+        unused.bind(("127.0.0.1", 0))
+        monkeypatch.setattr(xt.settings, "smtp_port", unused.getsockname()[1])
+    outbox.put("xero@example.invalid", ["oncall@example.invalid"], "Subject: new\n\nqueued by this run")
+    outbox.close(timeout=10)
+    assert len(outbox.spooled_paths()) == 1
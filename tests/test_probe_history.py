@@ -0,0 +1,79 @@
+import math
+
+import pytest
+
+
+@pytest.fixture
+def history(xt, tmp_path, monkeypatch):
+    monkeypatch.setattr(xt.settings, "history_dir", str(tmp_path))
+    monkeypatch.setattr(xt.settings, "history_capacity", 4)
+    history = xt.ProbeHistory()
+    yield history
+    history.close()
+
+
+def probe_result(ticket, healthy=True, degraded=False, wado=None):
+    return {"healthy": healthy, "degraded": degraded, "ticket_attempts": 1, "verify_attempts": 1,
+            "timings": {"ticket": ticket, "verify": 0.25, "wado": wado, "total": ticket + 0.25}}
+
+
+def test_recent_is_oldest_first(history):
+    for ticket in (1.0, 2.0, 3.0):
+        history.append("xero1", probe_result(ticket))
+    assert [record.ticket for record in history.recent("xero1", 10)] == [1.0, 2.0, 3.0]
+    assert [record.ticket for record in history.recent("xero1", 2)] == [2.0, 3.0]
+
+
+def test_wraps_around_at_capacity(xt, history):
+    for ticket in range(1, 11):
+        history.append("xero1", probe_result(float(ticket)))
+    assert [record.ticket for record in history.recent("xero1", 10)] == [7.0, 8.0, 9.0, 10.0]
+    mapped = history.maps["xero1"]
+    assert xt.ProbeHistory.header.unpack_from(mapped, 0) == (b"XPH1", 4, 10 % 4, 4)
+
+
+def test_survives_reopening(xt, history):
+    for ticket in range(1, 7):
+        history.append("xero1", probe_result(float(ticket)))
+    history.close()
+    reopened = xt.ProbeHistory()
+    try:
+        assert [record.ticket for record in reopened.recent("xero1", 10)] == [3.0, 4.0, 5.0, 6.0]
+    finally:
+        reopened.close()
+
+
+def test_records_outcome_and_missing_timings(history):
+    history.append("xero1", probe_result(1.0, healthy=False))
+    history.append("xero1", probe_result(1.0, degraded=True, wado=0.5))
+    failed, degraded = history.recent("xero1", 2)
+    assert failed.outcome == 0 and math.isnan(failed.wado)
+    assert degraded.outcome == 2 and degraded.wado == 0.5
+
+
+def test_nodes_are_kept_apart(history):
+    history.append("xero1", probe_result(1.0))
+    history.append("xero2", probe_result(2.0))
+    assert [record.ticket for record in history.recent("xero1", 10)] == [1.0]
+    assert [record.ticket for record in history.recent("xero2", 10)] == [2.0]
+
+
+def test_extend_wraps_around(history):
+    history.append("xero1", probe_result(1.0))
+    records = [list(record) for record in history.recent("xero1", 1)] * 5
+    history.extend("xero1", records)
+    assert len(history.recent("xero1", 10)) == 4
+
+
+def test_capacity_change_starts_a_new_history(xt, history, monkeypatch):
+    history.append("xero1", probe_result(1.0))
+    history.close()
+    monkeypatch.setattr(xt.settings, "history_capacity", 8)
+    resized = xt.ProbeHistory()
+    try:
+        assert resized.recent("xero1", 10) == []
+        for ticket in range(1, 7):
+            resized.append("xero1", probe_result(float(ticket)))
+        assert len(resized.recent("xero1", 10)) == 6
+    finally:
+        resized.close()
@@ -0,0 +1,97 @@
+import math
+
+import pytest
+
+
+@pytest.fixture
+def budget(xt, state, fake_time, monkeypatch):
+    monkeypatch.setattr(xt.settings, "deferred_alert_after", 2)
+    return xt.RunBudget()
+
+
+def run(budget, seconds, deferrals=()):
+    budget.start(seconds)
+    budget.start_phase("remediate")
+    for node, work, estimate in deferrals:
+        assert not budget.allows(node, work, estimate)
+    budget.record_deferrals()
+    budget.finish()
+
+
+def test_no_deadline_allows_everything(budget):
+    budget.start(0)
+    budget.start_phase("remediate")
+    assert budget.phase_remaining() == math.inf
+    assert budget.allows("xero1", "restart", 10_000)
+    assert budget.bounded("xero1", 300) == 300
+    assert budget.deferred == []
+
+
+def test_phase_gets_its_share_of_what_is_left(budget, fake_time):
+    budget.start(100)
+    fake_time.clock.now += 20
+    budget.start_phase("probe")
+    assert budget.phase_remaining() == pytest.approx(80 * 0.4)
+    budget.start_phase("drift")
+    assert budget.phase_remaining() == pytest.approx(80)
+
+
+def test_work_that_does_not_fit_is_deferred(budget, fake_time):
+    budget.start(100)
+    budget.start_phase("remediate")
+    assert budget.allows("xero1", "restart", 80)
+    assert not budget.allows("xero2", "restart", 90)
+    assert budget.deferred == [("xero2", "restart", "it needs up to 90s and 85s are left")]
+    fake_time.clock.now += 100
+    assert not budget.allows("xero1", "WADO cache check", 0)
+    assert budget.deferred[-1] == ("xero1", "WADO cache check", "the phase's time is up")
+
+
+def test_waits_and_commands_are_bounded_by_the_phase(budget, fake_time):
+    budget.start(100)
+    budget.start_phase("remediate")
+    assert budget.bounded("xero1", 300) == pytest.approx(85)
+    assert budget.bounded("xero1", 30) == 30
+    fake_time.clock.now += 200
+    assert budget.bounded("xero1", 300) == 0
+    assert budget.bounded("xero1", 300, floor=10) == 10
+
+
+def test_node_deferred_last_run_is_not_deferred_again(xt, budget):
+    run(budget, 100, [("xero1", "restart", 180)])
+    assert xt.deferred_work_store.get_all() == {"xero1": 1}
+
+    budget.start(100)
+    budget.start_phase("remediate")
+    assert budget.phase_remaining("xero1") == math.inf
+    assert budget.allows("xero1", "restart", 180)
+    assert budget.bounded("xero1", 300) == 300
+    # other nodes keep to the budget
+    assert not budget.allows("xero2", "restart", 180)
+    budget.record_deferrals()
+    assert xt.deferred_work_store.get_all() == {"xero2": 1}
+
+
+def test_deferrals_are_counted_in_a_row_and_alerted(xt, budget, fake_time):
+    run(budget, 100, [("xero1", "restart", 180), ("xero1", "retest after restart", 180)])
+    assert xt.deferred_work_store.get_all() == {"xero1": 1}
+    assert fake_time.emails == []
+
+    # a probe cut off by the probe engine is deferred even for an overdue node
+    budget.start(100)
+    budget.defer("xero1", "probe", "it did not finish within the probe phase")
+    budget.record_deferrals()
+    assert xt.deferred_work_store.get_all() == {"xero1": 2}
+    assert [node for node, _ in fake_time.emails] == ["xero1"]
+
+    run(budget, 100)
+    assert xt.deferred_work_store.get_all() == {}
+
+
+def test_restart_estimate_without_history_fits_a_short_budget(xt, budget, monkeypatch):
+    monkeypatch.setattr(xt.settings, "xero_ready_initial_delay", 10)
+    monkeypatch.setattr(xt.settings, "xero_ready_min_deadline", 30)
+    monkeypatch.setattr(xt.settings, "xero_ready_max_deadline", 180)
+    assert xt.restart_estimate("xero1") == 40
+    xt.record_restart_time("xero1", 60)
+    assert xt.restart_estimate("xero1") == xt.readiness_deadline("xero1") == 100
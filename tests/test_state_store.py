@@ -0,0 +1,115 @@
+import multiprocessing
+import threading
+
+import pytest
+
+
+def open_store(xt, backend, directory, name="servers"):
+    if backend == "sqlite":
+        return xt.SqliteStateStore(str(directory / "xero_state.db"), name)
+    return xt.JsonStateStore(str(directory / f"{name}.txt"))
+
+
+def increment(backend, directory, count):
+    import xeroticket as xt
+    store = open_store(xt, backend, directory)
+    for _ in range(count):
+        store.update(lambda servers: servers.__setitem__("xero1", servers.get("xero1", 0) + 1))
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request):
+    return request.param
+
+
+def test_round_trip(xt, backend, tmp_path):
+    store = open_store(xt, backend, tmp_path)
+    assert store.update(lambda servers: servers.update(xero1="INC0000001", xero2={"since": 1.5, "nodes": ["a"]})) is None
+    reopened = open_store(xt, backend, tmp_path)
+    assert reopened.get_all() == {"xero1": "INC0000001", "xero2": {"since": 1.5, "nodes": ["a"]}}
+    assert reopened.get("xero3", "missing") == "missing"
+
+    reopened.update(lambda servers: servers.pop("xero1"))
+    assert open_store(xt, backend, tmp_path).get_all() == {"xero2": {"since": 1.5, "nodes": ["a"]}}
+
+
+def test_update_returns_what_mutate_returns(xt, backend, tmp_path):
+    store = open_store(xt, backend, tmp_path)
+    store.update(lambda servers: servers.__setitem__("xero1", "INC0000001"))
+    assert store.update(lambda servers: servers.pop("xero1", None)) == "INC0000001"
+    assert store.update(lambda servers: servers.pop("xero1", None)) is None
+
+
+def test_entry_changed_in_place_is_saved(xt, backend, tmp_path):
+    store = open_store(xt, backend, tmp_path)
+    store.update(lambda servers: servers.__setitem__("xero1", {"purges": []}))
+    store.update(lambda servers: servers["xero1"].update(purge_pending=True))
+    assert open_store(xt, backend, tmp_path).get("xero1") == {"purges": [], "purge_pending": True}
+
+
+def test_get_all_is_a_copy(xt, backend, tmp_path):
+    store = open_store(xt, backend, tmp_path)
+    store.get_all()["xero1"] = "INC0000001"
+    assert store.get("xero1") is None
+
+
+def test_sees_changes_made_by_another_store(xt, backend, tmp_path):
+    first, second = open_store(xt, backend, tmp_path), open_store(xt, backend, tmp_path)
+    assert first.get_all() == {}
+    second.update(lambda servers: servers.__setitem__("xero1", "INC0000001"))
+    assert first.get("xero1") == "INC0000001"
+
+
+def test_json_update_rereads_a_file_the_cache_thinks_is_unchanged(xt, tmp_path):
+    first, second = open_store(xt, "json", tmp_path), open_store(xt, "json", tmp_path)
+    assert first.get_all() == {}
+    second.update(lambda servers: servers.__setitem__("xero1", "INC0000001"))
+    # as if the write had kept the inode, mtime and size the cache saw
+    first.version = first._file_version()
+    first.update(lambda servers: servers.__setitem__("xero2", "INC0000002"))
+    assert second.get_all() == {"xero1": "INC0000001", "xero2": "INC0000002"}
+
+
+def test_sqlite_stores_share_a_database_by_name(xt, tmp_path):
+    disabled = open_store(xt, "sqlite", tmp_path, "disabled_servers")
+    failing = open_store(xt, "sqlite", tmp_path, "failing_servers")
+    disabled.update(lambda servers: servers.__setitem__("xero1", "INC0000001"))
+    failing.update(lambda servers: servers.__setitem__("xero1", 1.5))
+    assert disabled.get_all() == {"xero1": "INC0000001"}
+    assert failing.get_all() == {"xero1": 1.5}
+
+
+def test_failed_mutation_leaves_the_store_unchanged(xt, backend, tmp_path):
+    store = open_store(xt, backend, tmp_path)
+    store.update(lambda servers: servers.__setitem__("xero1", "INC0000001"))
+
+    def fail(servers):
+        servers["xero2"] = "INC0000002"
+        raise RuntimeError("mutation failed")
+    with pytest.raises(RuntimeError):
+        store.update(fail)
+    assert open_store(xt, backend, tmp_path).get_all() == {"xero1": "INC0000001"}
+
+
+def test_concurrent_updates_from_threads(xt, backend, tmp_path):
+    store = open_store(xt, backend, tmp_path)
+    threads = [
+        threading.Thread(target=lambda: [store.update(lambda servers: servers.__setitem__("xero1", servers.get("xero1", 0) + 1))
+                                         for _ in range(50)])
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert open_store(xt, backend, tmp_path).get("xero1") == 400
+
+
+def test_concurrent_updates_from_processes(xt, backend, tmp_path):
+    processes = [multiprocessing.get_context("spawn").Process(target=increment, args=(backend, tmp_path, 25)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    assert open_store(xt, backend, tmp_path).get("xero1") == 100
@@ -0,0 +1,38 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+
+@pytest.mark.parametrize("if_none_match, matches", [
+    ('"abc"', True),
+    ('"xyz", "abc"', True),
+    ('"xyz" ,W/"abc"', True),
+    ("*", True),
+    (None, False),
+    ("", False),
+    ('"abcd"', False),
+    ('"xabc"', False),
+    ('abc', False),
+    ('"xyz", "ab"', False),
+])
+def test_etag_matches(xt, if_none_match, matches):
+    assert xt.etag_matches('"abc"', if_none_match) is matches
+
+
+def test_status_page_is_revalidated_by_etag(xt):
+    server = xt.start_metrics_server(0)
+    url = f"http://127.0.0.1:{server.server_address[1]}/status.json"
+    try:
+        with urllib.request.urlopen(url) as response:
+            etag = response.headers["ETag"]
+        for if_none_match in (etag, f'"other", {etag}', "*"):
+            with pytest.raises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(urllib.request.Request(url, headers={"If-None-Match": if_none_match}))
+            assert error.value.code == 304
+        # part of the ETag is a different version of the page
+        with urllib.request.urlopen(urllib.request.Request(url, headers={"If-None-Match": etag[:-3] + '"'})) as response:
+            assert response.status == 200
+    finally:
+        server.shutdown()
+        server.server_close()
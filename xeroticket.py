@@ -1,637 +1,4478 @@
+import argparse
+import atexit
 import base64
 import json
 import urllib
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
-import ast
 import requests
 import os
+import sys
 import configparser
-import paramiko
+import contextlib
+import contextvars
+import functools
+import gzip
+import hashlib
+import html
+import importlib
+import io
+import math
+import mmap
+import queue
+import re
+import struct
+import tempfile
 import logging
+import logging.handlers
 import uuid
+import time
+import asyncio
+import random
+import signal
+import socket
+import ssl
+import threading
 from time import sleep
-import smtplib
-from email.mime.text import MIMEText
 from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
+import collections
 import concurrent.futures
-import cx_Oracle
 import urllib3
 import textwrap
 
+# paramiko, Pillow, cx_Oracle, smtplib/email and http.server are imported where they are used, so a run
+# where every node is healthy only pays for requests; see --startup-report
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 # ignore insecure warnings
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # Get the absolute path of the script
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
-# Set up logging
-log_file_path = os.path.join(script_dir, "xero_ticket.log")
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s]: %(message)s',
-    handlers=[
-        logging.FileHandler(log_file_path),
-        logging.StreamHandler()
-    ]
-)
+# Construct the absolute path of the configuration file, XEROTICKET_CONFIG points at an alternate one
+config_file_path = os.environ.get("XEROTICKET_CONFIG", os.path.join(script_dir, "xeroticket.ini"))
 
 
-# Construct the absolute path of the configuration file
-config_file_path = os.path.join(script_dir, "xeroticket.ini")
-
-# Load the configuration file
-config = configparser.ConfigParser()
-config.read(config_file_path)
-
-# Xero API Variables
-xero_user = config.get("Xero", "xero_user")
-xero_password = config.get("Xero", "xero_password")
-xero_domain = config.get("Xero", "xero_domain")
-xero_query_constraints = config.get("Xero", "xero_query_constraints")
-xero_nodes = config.get("Xero", "xero_nodes").split(',')
-xero_restart_command = config.get("Xero", "xero_restart_command")
-xero_haproxy_restart_command = config.get("Xero", "xero_haproxy_restart_command")
-xero_disable_command = config.get("Xero", "xero_disable_command")
-xero_wado_purge_command = config.get("Xero", "xero_wado_purge_command")
-xero_server_user = config.get("Xero", "xero_server_user")
-xero_server_private_key = config.get("Xero", "xero_server_private_key")
-xero_get_ticket_timeout = int(config.get("Xero", "xero_get_ticket_timeout"))
-xero_ticket_validation_timeout = int(config.get("Xero", "xero_ticket_validation_timeout"))
-xero_retry_attempts = int(config.get("Xero", "xero_retry_attempts"))
-xero_wado = ast.literal_eval(config.get("Xero", "xero_wado"))
-validation_study_PatientID = config.get("Xero", "validation_study_PatientID")
-validation_study_AccessionNumber = config.get("Xero", "validation_study_AccessionNumber")
-xero_theme = config.get("Xero", "theme")
-disabled_servers_file = os.path.join(script_dir, config.get("Xero", "disabled_servers_file"))
-cluster_db_host = config.get("Xero", "cluster_db_host")
-cluster_db_port = config.get("Xero", "cluster_db_port")
-cluster_db_service_name = config.get("Xero", "cluster_db_service_name")
-cluster_db_user = config.get("Xero", "cluster_db_user")
-cluster_db_password = config.get("Xero", "cluster_db_password")
-
-
-query_constraints = f"PatientID={validation_study_PatientID}, AccessionNumber={validation_study_AccessionNumber}"
-display_vars = f"theme={xero_theme}, PatientID={validation_study_PatientID}, AccessionNumber={validation_study_AccessionNumber}"
-
-
-
-# email variables
-smtp_server = config.get("Email", "smtp_server")
-smtp_port = int(config.get("Email", "smtp_port"))
-smtp_username = config.get("Email", "smtp_username")
-smtp_password = config.get("Email", "smtp_password")
-smtp_from_domain = config.get("Email", "smtp_from_domain")
-smtp_recipients_string = config.get("Email", "smtp_recipients")
-smtp_recipients = smtp_recipients_string.split(",")
-
-# meme variables
-use_memes = config.getboolean("Meme", "use_memes")
-successful_restart_meme_path = os.path.join(script_dir, 'memes', config.get("Meme", "successful_restart_meme"))
-unsuccessful_restart_meme_path = os.path.join(script_dir, 'memes', config.get("Meme", "unsuccessful_restart_meme"))
-temp_meme_path = os.path.join(script_dir, os.path.dirname('memes'), 'temp_meme.jpg')
-font_path = os.path.join(script_dir, 'fonts', config.get("Meme", "font"))
-
-# service now variables
-service_now_instance = config.get("ServiceNow", "instance")
-service_now_table = config.get("ServiceNow", "table")
-service_now_api_user = config.get("ServiceNow", "api_user")
-service_now_api_password = config.get("ServiceNow", "api_password")
-ticket_type = config.get("ServiceNow", "ticket_type")
-configuration_item = config.get("ServiceNow", "configuration_item")
-assignment_group = config.get("ServiceNow", "assignment_group")
-assignee = config.get("ServiceNow", "assignee")
-business_hours_start_time = config.get("ServiceNow", "business_hours_start_time")
-business_hours_end_time = config.get("ServiceNow", "business_hours_end_time")
-after_hours_urgency = config.get("ServiceNow", "after_hours_urgency")
-after_hours_impact = config.get("ServiceNow", "after_hours_impact")
-business_hours_urgency = config.get("ServiceNow", "business_hours_urgency")
-business_hours_impact = config.get("ServiceNow", "business_hours_impact")
-
-
-
-# Get the current time and day of the week
-current_time = datetime.now().time()
-current_day = datetime.now().weekday()
-
-# Define business hours
-business_hours_start = datetime.strptime(business_hours_start_time, "%H:%M:%S").time()
-business_hours_end = datetime.strptime(business_hours_end_time, "%H:%M:%S").time()
-
-# Set default values
-urgency = after_hours_urgency  # Default value for after hours and weekends
-impact = after_hours_urgency  # Default value for after hours and weekends
-
-# Check if it's business hours
-if business_hours_start <= current_time <= business_hours_end and current_day < 5:  # Monday to Friday
-    urgency = business_hours_urgency
-    impact = business_hours_impact
-
-local_time_str = datetime.now().time()
-
-# Function to generate meme with better text size and positioning
-def generate_meme(image_path, top_text, bottom_text, output_path):
-    logging.info("Generating meme...")
+class ConfigError(Exception):
+    pass
+
+
+def config_int(minimum=0):
+    def parse(value):
+        number = int(value)
+        if number < minimum:
+            raise ValueError(f"must be at least {minimum}")
+        return number
+    return parse
+
+
+def config_boolean(value):
+    if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+        raise ValueError("must be True or False")
+    return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+
+
+def config_list(value):
+    items = [item.strip() for item in value.split(",") if item.strip()]
+    if not items:
+        raise ValueError("must list at least one value")
+    return items
+
+
+def config_optional_list(value):
+    return config_list(value) if value.strip() else []
+
+
+def config_float(minimum=0.0):
+    def parse(value):
+        number = float(value)
+        if number < minimum:
+            raise ValueError(f"must be at least {minimum}")
+        return number
+    return parse
+
+
+def config_regex(value):
     try:
-        # Open the image
-        img = Image.open(image_path)
-        draw = ImageDraw.Draw(img)
+        return re.compile(value)
+    except re.error as e:
+        raise ValueError(str(e))
 
-        # Load the TrueType font
-        max_width = img.width * 0.9  # Allow a 5% margin on either side
-        max_font_size = img.height // 10  # Set a maximum font size based on image height
 
-        font_size = max_font_size
-        font = ImageFont.truetype(font_path, font_size)
+def config_choice(*choices):
+    def parse(value):
+        if value.lower() not in choices:
+            raise ValueError(f"must be one of {', '.join(choices)}")
+        return value.lower()
+    return parse
 
-        # Reduce font size until text fits within max_width
-        def fit_text_to_width(text, font):
-            while draw.textbbox((0, 0), text, font=font)[2] > max_width and font_size > 10:
-                font = ImageFont.truetype(font_path, font.size - 2)
-            return font
 
-        # Adjust top text font
-        font = fit_text_to_width(top_text, font)
-        wrapped_top_text = textwrap.fill(top_text, width=40)
+def config_path(*subdirectories):
+    return lambda value: os.path.join(script_dir, *subdirectories, value)
 
-        # Draw top text
-        top_y_position = 10
-        draw.multiline_text(
-            ((img.width - draw.textbbox((0, 0), wrapped_top_text, font=font)[2]) / 2, top_y_position),
-            wrapped_top_text, fill="white", font=font, align="center"
-        )
 
-        # Adjust bottom text font
-        font = fit_text_to_width(bottom_text, font)
-        wrapped_bottom_text = textwrap.fill(bottom_text, width=40)
+def config_time(value):
+    return datetime.strptime(value, "%H:%M:%S").time()
 
-        # Draw bottom text at the bottom with a bit of padding
-        bottom_y_position = img.height - draw.textbbox((0, 0), wrapped_bottom_text, font=font)[3] - 20
-        draw.multiline_text(
-            ((img.width - draw.textbbox((0, 0), wrapped_bottom_text, font=font)[2]) / 2, bottom_y_position),
-            wrapped_bottom_text, fill="white", font=font, align="center"
-        )
 
-        # Save the meme
-        img.save(output_path)
-        logging.info(f"Meme saved at {output_path}")
-        return output_path
+# Every option the script reads: (attribute, ini option, parser, default). A default of None marks a required option.
+config_options = {
+    "Xero": [
+        ("xero_user", "xero_user", str, None),
+        ("xero_password", "xero_password", str, None),
+        ("xero_domain", "xero_domain", str, None),
+        ("xero_query_constraints", "xero_query_constraints", str, None),
+        ("xero_nodes", "xero_nodes", config_optional_list, ""),
+        ("cluster_name", "cluster_name", str, "default"),
+        ("xero_discover_nodes", "xero_discover_nodes", config_boolean, "False"),
+        ("xero_discover_pattern", "xero_discover_pattern", config_regex, ""),
+        ("xero_inventory_refresh", "xero_inventory_refresh", config_int(0), "3600"),
+        ("xero_discovery_timeout", "xero_discovery_timeout", config_int(1), "15"),
+        ("node_inventory_file", "node_inventory_file", config_path(), "node_inventory.txt"),
+        ("xero_restart_command", "xero_restart_command", str, None),
+        ("xero_haproxy_restart_command", "xero_haproxy_restart_command", str, None),
+        ("xero_disable_command", "xero_disable_command", str, None),
+        ("xero_wado_purge_command", "xero_wado_purge_command", str, None),
+        ("xero_server_user", "xero_server_user", str, None),
+        ("xero_server_private_key", "xero_server_private_key", str, None),
+        ("xero_ssh_port", "xero_ssh_port", config_int(1), "22"),
+        ("xero_https_port", "xero_https_port", config_int(1), "443"),
+        ("xero_ssh_connect_timeout", "xero_ssh_connect_timeout", config_int(1), "10"),
+        ("xero_ssh_command_timeout", "xero_ssh_command_timeout", config_int(1), "300"),
+        ("xero_get_ticket_timeout", "xero_get_ticket_timeout", config_int(1), None),
+        ("xero_ticket_validation_timeout", "xero_ticket_validation_timeout", config_int(1), None),
+        ("xero_retry_attempts", "xero_retry_attempts", config_int(1), None),
+        ("xero_probe_concurrency", "xero_probe_concurrency", config_int(1), "10"),
+        ("xero_wado", "xero_wado", config_boolean, None),
+        ("xero_wado_path", "xero_wado_path", str, "/wado"),
+        ("xero_wado_study_uid", "xero_wado_study_uid", str, ""),
+        ("xero_wado_series_uid", "xero_wado_series_uid", str, ""),
+        ("xero_wado_object_uids", "xero_wado_object_uids", config_optional_list, ""),
+        ("xero_wado_content_type", "xero_wado_content_type", str, "application/dicom"),
+        ("xero_wado_max_bytes", "xero_wado_max_bytes", config_int(1), "8388608"),
+        ("xero_wado_first_byte_timeout", "xero_wado_first_byte_timeout", config_int(1), "5"),
+        ("xero_wado_timeout", "xero_wado_timeout", config_int(1), "30"),
+        ("xero_wado_min_throughput", "xero_wado_min_throughput", config_int(0), "1024"),
+        ("degraded_servers_file", "degraded_servers_file", config_path(), "degraded_servers.txt"),
+        ("xero_wado_cache_usage_command", "xero_wado_cache_usage_command", str,
+         'for cache in /wado2cache*; do echo "$cache $(df -P -B1 "$cache" | awk \'NR==2 {print $2, $3}\') '
+         '$(sudo /bin/nice -n +15 /bin/find "$cache" -xdev -type f | wc -l)"; done'),
+        ("xero_wado_cache_df_command", "xero_wado_cache_df_command", str,
+         'for cache in /wado2cache*; do echo "$cache $(df -P -B1 "$cache" | awk \'NR==2 {print $2, $3}\')"; done'),
+        ("xero_wado_cache_usage_max_age", "xero_wado_cache_usage_max_age", config_int(0), "300"),
+        ("xero_wado_cache_threshold", "xero_wado_cache_threshold", config_int(1), "85"),
+        ("xero_wado_cache_check_interval", "xero_wado_cache_check_interval", config_int(0), "3600"),
+        ("xero_wado_purge_timeout", "xero_wado_purge_timeout", config_int(1), "1800"),
+        ("wado_cache_file", "wado_cache_file", config_path(), "wado_cache.txt"),
+        ("validation_study_PatientID", "validation_study_PatientID", str, None),
+        ("validation_study_AccessionNumber", "validation_study_AccessionNumber", str, None),
+        ("xero_theme", "theme", str, None),
+        ("disabled_servers_file", "disabled_servers_file", config_path(), None),
+        ("failing_servers_file", "failing_servers_file", config_path(), "failing_servers.txt"),
+        ("xero_breaker_probe_interval", "xero_breaker_probe_interval", config_int(1), "300"),
+        ("xero_breaker_max_probe_interval", "xero_breaker_max_probe_interval", config_int(1), "3600"),
+        ("xero_breaker_close_successes", "xero_breaker_close_successes", config_int(1), "3"),
+        ("xero_breaker_connect_timeout", "xero_breaker_connect_timeout", config_int(1), "3"),
+        ("circuit_breakers_file", "circuit_breakers_file", config_path(), "circuit_breakers.txt"),
+        ("xero_max_concurrent_restarts", "xero_max_concurrent_restarts", config_int(1), "1"),
+        ("xero_min_healthy_nodes", "xero_min_healthy_nodes", config_int(0), "1"),
+        ("restart_times_file", "restart_times_file", config_path(), "restart_times.txt"),
+        ("xero_ready_initial_delay", "xero_ready_initial_delay", config_int(0), "5"),
+        ("xero_ready_min_deadline", "xero_ready_min_deadline", config_int(1), "30"),
+        ("xero_ready_max_deadline", "xero_ready_max_deadline", config_int(1), "180"),
+        ("state_backend", "state_backend", config_choice("json", "sqlite"), "json"),
+        ("state_db_file", "state_db_file", config_path(), "xero_state.db"),
+        ("cluster_db_host", "cluster_db_host", str, None),
+        ("cluster_db_port", "cluster_db_port", str, None),
+        ("cluster_db_service_name", "cluster_db_service_name", str, None),
+        ("cluster_db_user", "cluster_db_user", str, None),
+        ("cluster_db_password", "cluster_db_password", str, None),
+        ("cluster_db_pool_max", "cluster_db_pool_max", config_int(1), "2"),
+        ("upgrade_status_ttl", "upgrade_status_ttl", config_int(0), "60"),
+        ("pending_incidents_file", "pending_incidents_file", config_path(), "pending_incidents.txt"),
+    ],
+    "Email": [
+        ("smtp_server", "smtp_server", str, None),
+        ("smtp_port", "smtp_port", config_int(1), None),
+        ("smtp_username", "smtp_username", str, None),
+        ("smtp_password", "smtp_password", str, None),
+        ("smtp_from_domain", "smtp_from_domain", str, None),
+        ("smtp_recipients", "smtp_recipients", config_list, None),
+        ("smtp_from_override", "smtp_from_address", str, ""),
+        ("smtp_retry_attempts", "smtp_retry_attempts", config_int(1), "3"),
+        ("smtp_spool_dir", "smtp_spool_dir", config_path(), "email_spool"),
+        ("email_digest_mode", "digest_mode", config_boolean, "False"),
+    ],
+    "Meme": [
+        ("use_memes", "use_memes", config_boolean, None),
+        ("successful_restart_meme_path", "successful_restart_meme", config_path("memes"), None),
+        ("unsuccessful_restart_meme_path", "unsuccessful_restart_meme", config_path("memes"), None),
+        ("font_path", "font", config_path("fonts"), None),
+    ],
+    "ServiceNow": [
+        ("service_now_instance", "instance", str, None),
+        ("service_now_table", "table", str, None),
+        ("service_now_api_user", "api_user", str, None),
+        ("service_now_api_password", "api_password", str, None),
+        ("ticket_type", "ticket_type", str, None),
+        ("configuration_item", "configuration_item", str, None),
+        ("assignment_group", "assignment_group", str, None),
+        ("assignee", "assignee", str, None),
+        ("business_hours_start", "business_hours_start_time", config_time, None),
+        ("business_hours_end", "business_hours_end_time", config_time, None),
+        ("after_hours_urgency", "after_hours_urgency", str, None),
+        ("after_hours_impact", "after_hours_impact", str, None),
+        ("business_hours_urgency", "business_hours_urgency", str, None),
+        ("business_hours_impact", "business_hours_impact", str, None),
+        ("service_now_timeout", "timeout", config_int(1), "10"),
+        ("service_now_retry_attempts", "retry_attempts", config_int(0), "5"),
+        ("correlate_incidents", "correlate_incidents", config_boolean, "False"),
+        ("correlation_min_nodes", "correlation_min_nodes", config_int(2), "2"),
+    ],
+    "Metrics": [
+        ("metrics_textfile", "textfile", str, ""),
+        ("metrics_http_port", "http_port", config_int(0), "0"),
+        ("status_file", "status_file", str, ""),
+    ],
+    "Run": [
+        ("run_deadline", "deadline", config_int(0), "0"),
+        ("run_lock_file", "lock_file", config_path(), "xeroticket.lock"),
+        ("run_lock_stale_after", "lock_stale_after", config_int(1), "3600"),
+        ("deferred_work_file", "deferred_work_file", config_path(), "deferred_work.txt"),
+        ("deferred_alert_after", "deferred_alert_after", config_int(1), "3"),
+    ],
+    "Recording": [
+        ("record_dir", "dir", str, ""),
+        ("record_failures_only", "failures_only", config_boolean, "True"),
+    ],
+    "Logging": [
+        ("log_file", "log_file", config_path(), "xero_ticket.log"),
+        ("log_format", "format", config_choice("json", "text"), "json"),
+        ("log_rotation", "rotation", config_choice("size", "time"), "size"),
+        ("log_max_bytes", "max_bytes", config_int(1024), "10485760"),
+        ("log_rotate_when", "rotate_when", str, "midnight"),
+        ("log_backup_count", "backup_count", config_int(0), "14"),
+    ],
+    "Daemon": [
+        ("daemon_probe_interval", "probe_interval", config_int(1), "30"),
+        ("daemon_probe_jitter", "probe_jitter", config_int(0), "5"),
+        ("daemon_liveness_interval", "liveness_interval", config_int(0), "5"),
+        ("daemon_liveness_path", "liveness_path", str, "/"),
+        ("daemon_liveness_timeout", "liveness_timeout", config_int(1), "3"),
+    ],
+    "History": [
+        ("history_dir", "history_dir", config_path(), "probe_history"),
+        ("history_capacity", "capacity", config_int(100), "20160"),
+        ("drift_window", "drift_window", config_int(5), "20"),
+        ("drift_baseline", "drift_baseline", config_int(10), "1000"),
+        ("drift_min_samples", "drift_min_samples", config_int(3), "10"),
+        ("drift_factor", "drift_factor", config_float(1.0), "2.0"),
+        ("drift_min_ms", "drift_min_ms", config_int(0), "250"),
+        ("drift_action", "drift_action", config_choice("none", "purge", "restart"), "none"),
+        ("drift_quiet_start", "quiet_hours_start_time", config_time, "01:00:00"),
+        ("drift_quiet_end", "quiet_hours_end_time", config_time, "05:00:00"),
+        ("drifting_servers_file", "drifting_servers_file", config_path(), "drifting_servers.txt"),
+    ],
+}
+# Checks that involve more than one option of a section, each returns an error message or None
+config_checks = {
+    "Xero": [
+        lambda values: "xero_nodes is missing (or set xero_discover_nodes = True)"
+        if not values["xero_nodes"] and not values["xero_discover_nodes"] else None,
+        # the installer_node table lists every node of the cluster, not only the Xero ones
+        lambda values: "xero_discover_nodes = True needs xero_discover_pattern"
+        if values["xero_discover_nodes"] and not values["xero_discover_pattern"].pattern else None,
+        lambda values: "xero_wado = True needs xero_wado_study_uid, xero_wado_series_uid and xero_wado_object_uids"
+        if values["xero_wado"] and not (
+            values["xero_wado_study_uid"] and values["xero_wado_series_uid"] and values["xero_wado_object_uids"]
+        ) else None,
+    ],
+}
+option_sections = {attribute: section for section, options in config_options.items() for attribute, *_ in options}
+# [Xero] options a [Cluster <name>] section can set for its own cluster, the rest are shared by every cluster
+cluster_options = (
+    "xero_nodes", "xero_discover_nodes", "xero_discover_pattern", "cluster_db_host", "cluster_db_port", "cluster_db_service_name", "cluster_db_user",
+    "cluster_db_password", "cluster_db_pool_max", "disabled_servers_file", "failing_servers_file",
+    "xero_probe_concurrency", "xero_max_concurrent_restarts", "xero_min_healthy_nodes",
+)
 
-    except Exception as e:
-        logging.error(f"Failed to generate meme: {e}")
-        raise
 
+# Settings are parsed and validated a section at a time, the first time any option in that section is used,
+# so a run where every node passes never reads the email, ServiceNow or meme sections
+class Settings:
+    def __init__(self, path):
+        self.path = path
+        self.parser = None
+        self.loaded_sections = set()
+        self.lock = threading.Lock()
 
+    def __getattr__(self, name):
+        section = option_sections.get(name)
+        if section is None:
+            raise AttributeError(name)
+        self.load_section(section)
+        return self.__dict__[name]
 
-# disabled server management
-class DisabledServerManager:
-    @staticmethod
-    def load_disabled_servers():
-        try:
-            with open(disabled_servers_file, 'r') as file:
-                content = file.read().strip()
-                return json.loads(content) if content else {}
-        except (FileNotFoundError, ValueError, json.JSONDecodeError):
-            # Create a new file or replace a blank file with an empty dictionary
-            with open(disabled_servers_file, 'w') as file:
-                json.dump({}, file)
-            return {}
+    def load_section(self, section):
+        with self.lock:
+            if section in self.loaded_sections:
+                return
+            if self.parser is None:
+                parser = configparser.ConfigParser()
+                if not parser.read(self.path):
+                    raise ConfigError(f"Unable to read configuration file {self.path}")
+                self.parser = parser
 
-    @staticmethod
-    def save_disabled_servers(servers):
-        with open(disabled_servers_file, 'w') as file:
-            json.dump(servers, file)
+            values, errors = {}, []
+            for attribute, option, parse, default in config_options[section]:
+                value = self.parser.get(section, option, fallback=default)
+                if value is None:
+                    errors.append(f"{option} is missing")
+                    continue
+                try:
+                    values[attribute] = parse(value)
+                except ValueError as e:
+                    errors.append(f"{option} = {value!r} ({e})")
+            if not errors:
+                errors = [error for check in config_checks.get(section, []) if (error := check(values))]
+            if errors:
+                raise ConfigError(f"Invalid [{section}] settings in {self.path}: {'; '.join(errors)}")
 
-    @staticmethod
-    def is_server_disabled(xero_server):
-        servers = DisabledServerManager.load_disabled_servers()
-        return xero_server in servers
+            # values assigned before the section was loaded (e.g. by the benchmark harness) are kept
+            for attribute, value in values.items():
+                self.__dict__.setdefault(attribute, value)
+            self.loaded_sections.add(section)
 
-    @staticmethod
-    def save_disabled_server(xero_server, incident_number):
-        servers = DisabledServerManager.load_disabled_servers()
-        servers[xero_server] = incident_number
-        DisabledServerManager.save_disabled_servers(servers)
+    # [(name, {attribute: value})] for every cluster: [Xero] describes the first one and each [Cluster <name>]
+    # section adds another, taking any of the cluster_options it leaves out from [Xero]
+    def cluster_settings(self):
+        self.load_section("Xero")
+        first = {attribute: getattr(self, attribute) for attribute in cluster_options}
+        clusters, errors = [(self.cluster_name, first)], []
+        parsers = {attribute: (option, parse) for attribute, option, parse, _ in config_options["Xero"]}
+        for section in self.parser.sections():
+            if not section.startswith("Cluster "):
+                continue
+            name = section[len("Cluster "):].strip()
+            values = dict(first, xero_nodes=[], failing_servers_file=config_path()(f"failing_servers_{name}.txt"))
+            # a cluster never shares its node list or disabled servers file with another
+            section_errors = [] if self.parser.has_option(section, "disabled_servers_file") else ["disabled_servers_file is missing"]
+            for attribute in cluster_options:
+                option, parse = parsers[attribute]
+                if not self.parser.has_option(section, option):
+                    continue
+                value = self.parser.get(section, option)
+                try:
+                    values[attribute] = parse(value)
+                except ValueError as e:
+                    section_errors.append(f"{option} = {value!r} ({e})")
+            if not values["xero_nodes"] and not values["xero_discover_nodes"]:
+                section_errors.append("xero_nodes is missing (or set xero_discover_nodes = True)")
+            if values["xero_discover_nodes"] and not values["xero_discover_pattern"].pattern:
+                section_errors.append("xero_discover_nodes = True needs xero_discover_pattern")
+            if section_errors:
+                errors.append(f"Invalid [{section}] settings in {self.path}: {'; '.join(section_errors)}")
+            clusters.append((name, values))
 
-    @staticmethod
-    def remove_disabled_server(xero_server):
-        servers = DisabledServerManager.load_disabled_servers()
-        if xero_server in servers:
-            incident = servers[xero_server]
-            local_time_str = datetime.now().time()
-            if incident == 'PREPARE':
-                subject = f"Xero Ticketing/Image Display has been Restored on {xero_server} at {local_time_str}"
-                body = f"Xero Ticketing/Image Display has been Restored on {xero_server} at {local_time_str}"
-            else:
-                subject = f"Xero Ticketing/Image Display has been Restored on {xero_server} at {local_time_str}"
-                body = f"Xero Ticketing/Image Display has been Restored on {xero_server} at {local_time_str}\nPlease Close {incident}"
-            if use_memes:
-                generate_meme(successful_restart_meme_path, f"Xero Ticketing/Image Display has been Restored on {xero_server}",
-                              "", temp_meme_path)
-                send_email(smtp_recipients, subject, body, xero_server, temp_meme_path)
-                os.remove(temp_meme_path)
-            else:
-                send_email(smtp_recipients, subject, body, xero_server)
-            del servers[xero_server]
-            DisabledServerManager.save_disabled_servers(servers)
+        owners = {}
+        for name, values in clusters:
+            for node in values["xero_nodes"]:
+                if node in owners:
+                    errors.append(f"{node} is listed in both the {owners[node]} and {name} clusters")
+                owners.setdefault(node, name)
+        if errors:
+            raise ConfigError("\n".join(errors))
+        return clusters
 
+    def validate(self):
+        errors = []
+        for section in config_options:
+            try:
+                self.load_section(section)
+            except ConfigError as e:
+                errors.append(str(e))
+        try:
+            self.cluster_settings()
+        except ConfigError as e:
+            errors.append(str(e))
+        if errors:
+            raise ConfigError("\n".join(errors))
 
-# Function to encode an image as base64
-def image_to_base64(image_path):
-    with open(image_path, "rb") as image_file:
-        encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
-    return encoded_image
+    @property
+    def smtp_from_address(self):
+        return self.smtp_from_override or f"xero-monitor@{self.smtp_from_domain}"
 
+    @property
+    def query_constraints(self):
+        return f"PatientID={self.validation_study_PatientID}, AccessionNumber={self.validation_study_AccessionNumber}"
 
-# Define a unified function to send emails, with optional meme attachment
-def send_email(smtp_recipients, subject, body, node, meme_path=None):
-    smtp_from = f"{node}@{smtp_from_domain}"
-    msg = construct_email_message(smtp_from, smtp_recipients, subject, body, meme_path)
+    @property
+    def display_vars(self):
+        return f"theme={self.xero_theme}, PatientID={self.validation_study_PatientID}, AccessionNumber={self.validation_study_AccessionNumber}"
 
-    try:
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.sendmail(smtp_from, smtp_recipients, msg.as_string())
-        server.quit()
-        logging.info(f"Email sent to {', '.join(smtp_recipients)}")
-    except Exception as e:
-        logging.error(f"Email sending failed to {', '.join(smtp_recipients)}: {e}")
 
+settings = Settings(config_file_path)
 
 
-# Helper function to construct email message with an embedded image
-def construct_email_message(smtp_from, smtp_recipients, subject, body, meme_path=None):
-    # Create a MIMEMultipart message to handle both HTML and image content
-    msg = MIMEMultipart('related')
-    msg["From"] = smtp_from
-    msg["To"] = ", ".join(smtp_recipients)
-    msg["Subject"] = subject
+# Fields attached to every log record made while they are set: node, phase, attempt and the probe_id that
+# ties together a probe's retries and whatever remediation it led to
+log_fields = contextvars.ContextVar("log_fields", default={})
 
-    # Create the HTML body, embedding the image with a CID
-    body_html = body.replace("\n", "<br>")
-    html_body = f"""
-    <html>
-        <body>
-            <p>{body_html}</p>
-            {"<img src='cid:meme_image' alt='Meme'>" if meme_path else ""}
-        </body>
-    </html>
-    """
-    # Attach the HTML body to the email
-    msg.attach(MIMEText(html_body, 'html'))
 
-    # Attach the image if the meme_path is provided
-    if meme_path:
-        with open(meme_path, 'rb') as img_file:
-            meme_data = img_file.read()
-            image_part = MIMEImage(meme_data)
-            image_part.add_header('Content-ID', '<meme_image>')
-            image_part.add_header('Content-Disposition', 'inline', filename='meme.jpg')
-            msg.attach(image_part)
+@contextlib.contextmanager
+def log_context(**fields):
+    token = log_fields.set({**log_fields.get(), **fields})
+    try:
+        yield
+    finally:
+        log_fields.reset(token)
 
-    return msg
 
+def call_with_log_context(fields, function, *args):
+    with log_context(**fields):
+        return function(*args)
 
-def create_and_send_failure_incident(xero_server, failure_reason):
-    local_time_str = datetime.now().time()
-    subject = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} ({failure_reason})"
-    body = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str}\nPlease investigate."
-    incident_summary = subject
-    external_unique_id = str(uuid.uuid4())
-    incident_number = create_service_now_incident(
-        incident_summary, body, configuration_item, external_unique_id, urgency, impact
-    )
-    if incident_number:
-        subject += f" {incident_number}"
-        DisabledServerManager.save_disabled_server(xero_server, incident_number)
-    else:
-        DisabledServerManager.save_disabled_server(xero_server, "Ticket Creation Failed")
 
-    send_email(smtp_recipients, subject, body, xero_server)
+# Filters run before the record is queued, so the fields are those of the thread that made the record
+class LogContextFilter(logging.Filter):
+    def filter(self, record):
+        for name, value in log_fields.get().items():
+            setattr(record, name, value)
+        return True
 
 
-def create_service_now_incident(summary, description, configuration_item, external_unique_id, urgency, impact):
-    incident_api_url = f"https://{service_now_instance}/api/now/table/{service_now_table}"
+class JsonLogFormatter(logging.Formatter):
+    fields = ("cluster", "node", "phase", "attempt", "probe_id")
 
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update((name, getattr(record, name)) for name in self.fields if hasattr(record, name))
+        return json.dumps(entry)
 
-    payload = {
-        "u_short_description": summary,
-        "u_description": description,
-        "u_affected_user_id": "",
-        "u_configuration_item": configuration_item,
-        "u_external_unique_id": external_unique_id,
-        "u_urgency": urgency,
-        "u_impact": impact,
-        "u_type": ticket_type,
-        "u_assignment_group": assignment_group,
-    }
 
+class TextLogFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s [%(levelname)s]: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        context = " ".join(f"{name}={getattr(record, name)}" for name in JsonLogFormatter.fields if hasattr(record, name))
+        return f"{line} [{context}]" if context else line
+
+
+# Log records are handed to a queue and written by a single listener thread, so a slow disk never holds up a
+# probe or remediation worker. The file is rotated by size or time; the console keeps the plain text format.
+def setup_logging():
     try:
-        # logging.info("Incident Creation Payload:", payload)  # Print payload for debugging
-        response = requests.post(
-            incident_api_url,
-            headers=headers,
-            auth=(service_now_api_user, service_now_api_password),
-            json=payload,
+        settings.load_section("Logging")
+        config_error = None
+    except ConfigError as e:
+        # fall back to the defaults so the error itself can be logged
+        config_error = e
+        for attribute, _, parse, default in config_options["Logging"]:
+            settings.__dict__.setdefault(attribute, parse(default))
+
+    if settings.log_rotation == "time":
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            settings.log_file, when=settings.log_rotate_when, backupCount=settings.log_backup_count
         )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            settings.log_file, maxBytes=settings.log_max_bytes, backupCount=settings.log_backup_count
+        )
+    file_handler.setFormatter(JsonLogFormatter() if settings.log_format == "json" else TextLogFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(TextLogFormatter())
 
-        # logging.info("Incident Creation Response Status Code:", response.status_code)  # Print status code for debugging
-        # logging.info("Incident Creation Response Content:", response.text)  # Print response content for debugging
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    # flush whatever is still queued on the way out
+    atexit.register(listener.stop)
+    if config_error is not None:
+        logging.error(f"{config_error}, logging with the default [Logging] settings")
 
-        if response.status_code == 201:
-            incident_number = response.json().get("result", {}).get("u_task_string")
-            sys_id = response.json().get('result', {}).get('u_task', {}).get('value')
-            logging.info(f"ServiceNow incident created successfully: {incident_number}")
-            return incident_number
-        else:
-            logging.info(f"Failed to create ServiceNow incident. Response: {response.text}")
 
-    except requests.exceptions.RequestException as e:
-        logging.error(f"An error occurred while creating ServiceNow incident: {e}")
+setup_logging()
 
-    return None
 
+# Work out urgency/impact at the time of each decision, a resident daemon crosses business hours boundaries
+def get_urgency_and_impact():
+    # Get the current time and day of the week
+    now = datetime.now()
+    current_time = now.time()
+    current_day = now.weekday()
 
-def get_xero_ticket(xero_server, retry_amount=xero_retry_attempts):
-    api_url = f"https://{xero_server}/encodedTicket"
+    # Check if it's business hours
+    if settings.business_hours_start <= current_time <= settings.business_hours_end and current_day < 5:  # Monday to Friday
+        return settings.business_hours_urgency, settings.business_hours_impact
 
-    # URL encode the query constraints and display vars
-    query_constraints_encoded = urllib.parse.quote(query_constraints)
-    display_vars_encoded = urllib.parse.quote(display_vars)
-    # logging.info(query_constraints_encoded)
-    # logging.info(display_vars_encoded)
-    payload = {
-        "user": xero_user,
-        "password": xero_password,
-        "domain": xero_domain,
-        "queryConstraints": query_constraints_encoded,
-        # "initialDisplay": display_vars_encoded,
-        "ticketDuration": "300",
-        "uriEncodedTicket": "true",
-        "ticketUser": "TICKET_TESTING_USER",
-        "ticketRoles": "EprUser",
-    }
+    # Default value for after hours and weekends
+    return settings.after_hours_urgency, settings.after_hours_impact
 
-    headers = {}
 
-    for attempt in range(retry_amount):
-        try:
-            logging.info(f"Testing Ticket Creation for {xero_server}, Attempt {attempt + 1}")
-            response = requests.post(api_url, headers=headers, data=payload, verify=False,
-                                     timeout=xero_get_ticket_timeout)
-            # logging.info(f"{xero_server} Ticket Creation Response Status Code: {response.status_code}")  # Print status code for debugging
-            if response.status_code == 200:
-                logging.info(f"{xero_server} created a ticket successfully")
-                # logging.info(response.text)
-                return response.text
-            else:
-                logging.info(f"{xero_server} Ticket Creation Failure, Status Code: {response.status_code}")
-        except requests.exceptions.RequestException as e:
-            logging.error(f"An error occurred while attempting to create xero tickets on {xero_server}: {e}")
+# Minimal in-process metrics registry rendered in the OpenMetrics text format
+class MetricsRegistry:
+    default_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
 
-        # Wait before retrying
-        sleep(2)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}
+        self.samples = {}
 
-    logging.error(f"Failed to create xero ticket after {retry_amount} attempts")
-    return None
+    def _family(self, name, metric_type, documentation):
+        if name not in self.families:
+            self.families[name] = (metric_type, documentation)
+            self.samples[name] = {}
+        return self.samples[name]
 
+    def inc(self, name, documentation, labels, amount=1):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self._family(name, "counter", documentation)
+            samples[key] = samples.get(key, 0) + amount
 
-def verify_ticket(xero_server, xero_ticket, retry_amount=xero_retry_attempts):
-    verification_url = f"https://{xero_server}/?PatientID={validation_study_PatientID}&AccessionNumber={validation_study_AccessionNumber}&theme={xero_theme}&ticket={xero_ticket}"
+    def set(self, name, documentation, labels, value):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self._family(name, "gauge", documentation)[key] = value
 
-    for attempt in range(retry_amount):
-        try:
-            logging.info(f"Verifying Ticket for {xero_server}, Attempt {attempt + 1}")
-            response = requests.get(verification_url, verify=False, timeout=xero_ticket_validation_timeout)
-            # logging.info(f"{xero_server} Verification URL Response Status Code: {response.status_code}")
-            # logging.info(f"Verification URL Response Content: {response.text}")
+    def observe(self, name, documentation, labels, value):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self._family(name, "histogram", documentation)
+            histogram = samples.setdefault(key, {"buckets": [0] * len(self.default_buckets), "sum": 0.0, "count": 0})
+            for index, bound in enumerate(self.default_buckets):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
 
-            if response.status_code == 200:
-                logging.info(f"{xero_server} Ticket verification successful")
-                return True
-            else:
-                logging.info(f"{xero_server} Ticket verification failed, Status Code: {response.status_code}")
-        except requests.exceptions.RequestException as e:
-            logging.error(f"An error occurred while attempting to verify the ticket: {e}")
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        escaped = []
+        for name, value in pairs:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{name}="{value}"')
+        return "{" + ",".join(escaped) + "}"
 
-        # Wait before retrying
-        sleep(2)
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (metric_type, documentation) in sorted(self.families.items()):
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.append(f"# HELP {name} {documentation}")
+                for key, value in sorted(self.samples[name].items()):
+                    if metric_type == "counter":
+                        lines.append(f"{name}_total{self._labels(key)} {value}")
+                    elif metric_type == "gauge":
+                        lines.append(f"{name}{self._labels(key)} {value}")
+                    else:
+                        for bound, count in zip(self.default_buckets, value["buckets"]):
+                            lines.append(f"{name}_bucket{self._labels(key, [('le', bound)])} {count}")
+                        lines.append(f"{name}_bucket{self._labels(key, [('le', '+Inf')])} {value['count']}")
+                        lines.append(f"{name}_sum{self._labels(key)} {value['sum']}")
+                        lines.append(f"{name}_count{self._labels(key)} {value['count']}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
 
-    logging.error(f"Failed to verify xero ticket after {retry_amount} attempts")
-    return False
+    def write_textfile(self, path):
+        # written to a temp file and renamed so a textfile collector never reads a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as file:
+            file.write(self.render())
+        os.replace(temp_path, path)
 
 
-def get_and_verify_ticket(xero_server):
-    xero_ticket = get_xero_ticket(xero_server)
-    if xero_ticket:
-        if verify_ticket(xero_server, xero_ticket):
-            if DisabledServerManager.is_server_disabled(xero_server):
-                DisabledServerManager.remove_disabled_server(xero_server)
+metrics = MetricsRegistry()
+
+
+def is_connection_refused(exception):
+    # requests wraps the socket error a few levels deep (ConnectionError <- MaxRetryError <- NewConnectionError)
+    seen = set()
+    while exception is not None and id(exception) not in seen:
+        if isinstance(exception, ConnectionRefusedError):
             return True
-        return False
+        seen.add(id(exception))
+        exception = exception.__cause__ or exception.__context__ or getattr(exception, "reason", None)
     return False
 
 
-#  check for upgrade pending/inprogress
-def check_for_upgrade(xero_server):
-    # Oracle database connection details
-    dsn = cx_Oracle.makedsn(cluster_db_host, cluster_db_port, service_name=cluster_db_service_name)
-    connection = cx_Oracle.connect(user=cluster_db_user, password=cluster_db_password, dsn=dsn)
+def request_outcome(exception):
+    if isinstance(exception, requests.exceptions.Timeout):
+        return "timeout"
+    if isinstance(exception, requests.exceptions.ConnectionError):
+        # a read timeout while streaming a response body surfaces as a ConnectionError
+        if exception.args and isinstance(exception.args[0], urllib3.exceptions.ReadTimeoutError):
+            return "timeout"
+        return "connection_refused" if is_connection_refused(exception) else "connection_error"
+    return "error"
 
-    query = """
-    select t.installstage "Installation Stage", inode.id "Cluster node"
-    from installer_node inode,
-    xmltable('/installStatus' 
-        passing xmltype(inode.status) 
-        columns 
-            installstage varchar2(64) path 'stage',
-            uninstalled varchar2(64) path 'uninstall'
-        ) t
-    where upper(inode.id) like upper(:xero_server)
-    and uninstalled = 'false'
-    and installstage = 'PREPARE'
-    """
 
-    try:
-        cursor = connection.cursor()
-        cursor.execute(query, xero_server=f"{xero_server}%")
-        result = cursor.fetchone()
-        logging.info(f"upgrade check for {xero_server} result is:{result}")
-        return result is not None
-
-    except cx_Oracle.DatabaseError as e:
-        # Specifically catch Oracle-related errors
-        logging.error(f"Database error occurred: {e}; continuing with restarts...")
-        return False
+# Delay before retrying a failed ticket/verification request, based on how it failed
+def retry_delay(outcome, attempt):
+    if recorder.mode == "replay":
+        # a replay takes its timing from the recording
+        return 0.0
+    if outcome == "timeout":
+        # the timeout itself was the wait
+        return 0.5
+    if outcome == "connection_refused":
+        # nothing listening, it will either come up shortly or stay down; a longer wait doesn't help
+        return 1.0
+    return min(10.0, 2.0 * 2 ** attempt) * random.uniform(0.5, 1.0)
 
-    except Exception as e:
-        # Catch ANY other exception
-        logging.error(f"An unexpected error occurred: {e}")
+
+def record_probe_attempt(xero_server, phase, outcome, duration):
+    labels = {"node": xero_server, "phase": phase, "outcome": outcome}
+    metrics.observe("xero_probe_request_seconds", "Latency of individual ticket/verification requests", labels, duration)
+    metrics.inc("xero_probe_requests", "Ticket/verification requests by outcome, including retries", labels)
+
+
+# If-None-Match is either "*" or a comma-separated list of entity tags, compared weakly (a W/ prefix is ignored)
+def etag_matches(etag, if_none_match):
+    if not if_none_match:
         return False
-    finally:
-        cursor.close()
-        connection.close()
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any((tag[2:] if tag.startswith("W/") else tag) == etag for tag in tags)
 
 
-def restart_xero_services(xero_server):
-    try:
-        commands = [
-            (xero_haproxy_restart_command, "HAProxy"),
-            (xero_restart_command, "JBoss")
-        ]
-        for command, service_name in commands:
-            logging.info(f"Attempting to restart {service_name} on {xero_server}")
-            result = execute_remote_command(
-                xero_server, xero_server_user, xero_server_private_key, command
-            )
-            logging.info(f"{service_name} restarted successfully on {xero_server}: {result}")
-    except Exception as e:
-        logging.error(f"Error restarting services on Xero server ({xero_server}): {e}")
-        create_and_send_failure_incident(xero_server, "Unable to connect to server")
-        return None
+def start_metrics_server(port):
+    import http.server
 
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/metrics":
+                self.reply(metrics.render().encode(), "application/openmetrics-text; version=1.0.0; charset=utf-8")
+            elif path == "/status.json":
+                self.reply(status_board.render_json(), "application/json", cacheable=True)
+            elif path in ("/", "/status"):
+                self.reply(status_board.render_html(), "text/html; charset=utf-8", cacheable=True)
+            else:
+                self.send_error(404)
 
-def disable_xero_server(xero_server):
-    try:
-        logging.info(f"attempting to disable xero services on {xero_server}")
-        result = execute_remote_command(
-            xero_server,
-            xero_server_user,
-            xero_server_private_key,
-            xero_disable_command,
-        )
-    except Exception as e:
-        logging.error(f"Error Disabling Xero server ({xero_server}): {e}")
-        subject = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} (Unable to connect to server) (Ticket Creation Failure))"
-        body = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} (Unable to connect to server)/nPlease investigate"
-        incident_summary = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} (Unable to connect to server)"
-        incident_description = body
-        external_unique_id = str(uuid.uuid4())
-        incident_number = create_service_now_incident(
-            incident_summary, incident_description,
-            configuration_item, external_unique_id,
-            urgency, impact
-        )
-        if incident_number:
-            logging.info(incident_number)
-            subject = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} (Unable to connect to server) {incident_number}"
-            DisabledServerManager.save_disabled_server(xero_server, incident_number)
-        else:
-            DisabledServerManager.save_disabled_server(xero_server, "Ticket Creation Failed")
-        if use_memes:
-            generate_meme(unsuccessful_restart_meme_path, "ONE DOES NOT SIMPLY",f"DISABLE XERO SERVICES ON {xero_server}", temp_meme_path)
-            send_email(smtp_recipients, subject, body, xero_server, temp_meme_path)
-            os.remove(temp_meme_path)
-        else:
-            send_email(smtp_recipients, subject, body, xero_server)
-    else:
-        logging.info(f"Xero server Disabling successfully: {result}")
-        subject = f"Xero Ticketing/Image Display has been Disabled on {xero_server} at {local_time_str}"
-        body = f"Xero Ticketing/Image Display has been Disabled on {xero_server} at {local_time_str}\nTo enable the server run the following command on the xero server: sudo agility-haproxy restart"
-        #body = f"Xero Ticketing/Image Display has been Disabled on {xero_server} at {local_time_str}\nTo manually purge cache run the following command: sudo /bin/nice -n +15 /bin/find /wado2cache* -mmin +240 -delete \nTo enable the server run the following command on the xero server: sudo agility-haproxy start"
-        incident_summary = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} (Server Disabled)"
-        incident_description = body
-        external_unique_id = str(uuid.uuid4())
-        incident_number = create_service_now_incident(
-            incident_summary, incident_description,
-            configuration_item, external_unique_id,
-            urgency, impact
-        )
-        if incident_number:
-            logging.info(incident_number)
-            subject = f"Xero Ticketing/Image Display has been Disabled on {xero_server} at {local_time_str} {incident_number}"
-            DisabledServerManager.save_disabled_server(xero_server,incident_number)
-        else:
-            DisabledServerManager.save_disabled_server(xero_server, "Ticket Creation Failed")
-        if use_memes:
-            generate_meme(unsuccessful_restart_meme_path, "ONE DOES NOT SIMPLY",f"RESTART XERO SERVICES ON {xero_server}", temp_meme_path)
-            send_email(smtp_recipients, subject, body, xero_server, temp_meme_path)
-            os.remove(temp_meme_path)
-        else:
-            send_email(smtp_recipients, subject, body, xero_server)
-    return None  # Return the result or another suitable value
+        # the status pages only change when a probe lands, so pollers revalidate with If-None-Match
+        def reply(self, body, content_type, cacheable=False):
+            etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"' if cacheable else None
+            if etag is not None and etag_matches(etag, self.headers.get("If-None-Match")):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            if etag is not None:
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(body)
 
+        def log_message(self, format, *args):
+            pass
 
-def execute_remote_command(hostname, username, private_key_path, command):
-    ssh = paramiko.SSHClient()
-    ssh.load_system_host_keys()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    server = http.server.ThreadingHTTPServer(("", port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info(f"Serving metrics and node status on port {port}")
+    return server
 
-    try:
-        ssh.connect(hostname, username=username, key_filename=private_key_path)
-        stdin, stdout, stderr = ssh.exec_command(command)
-        output = stdout.read().decode()
-        error = stderr.read().decode()
 
-        result = {'output': output, 'error': error}
-        ssh.close()
-        return result
-    except Exception as e:
-        logging.error(f"Error executing remote command: {e}")
-        return None
+def write_metrics_textfile():
+    if not settings.metrics_textfile:
+        return
+    try:
+        metrics.write_textfile(settings.metrics_textfile)
+    except OSError as e:
+        logging.error(f"Unable to write metrics textfile {settings.metrics_textfile}: {e}")
 
 
+# Decoded base images and fonts are cached per path/size, every meme is drawn on a copy
+@functools.lru_cache(maxsize=None)
+def load_meme_image(image_path):
+    from PIL import Image
+    with Image.open(image_path) as img:
+        img.load()
+        return img.convert("RGB")
 
-def notify_failed_server_pending_upgrade(xero_server):
-    subject = f"Xero Ticketing/Image Display Failing on {xero_server} at {local_time_str} (Server in PREPARE Status)"
-    body = f"Xero Ticketing/Image Display Failing on {xero_server} at {local_time_str} (Server in PREPARE Status)\n The server will has been placed on the disabled servers lists, and will be removed automacailly after the upgrade is complete and ticketing is validated."
-    send_email(smtp_recipients, subject, body, xero_server)
-    DisabledServerManager.save_disabled_server(xero_server, "PREPARE")
-    return
 
-def process_node(node):
-    if get_and_verify_ticket(node):
-        return
-    logging.info(f"Ticket Creation failed for {node}")
-    if DisabledServerManager.is_server_disabled(node):
-        logging.info(f"Skipping {node} - Server is already disabled.")
-        return
+@functools.lru_cache(maxsize=64)
+def load_meme_font(font_path, font_size):
+    from PIL import ImageFont
+    return ImageFont.truetype(font_path, font_size)
 
-    server_in_prepare_status = check_for_upgrade(node)
-    if server_in_prepare_status:
-        logging.info(f"Skipping {node} - Server is in a PREPARE Status")
-        notify_failed_server_pending_upgrade(node)
-        return
 
-    restart_xero_services(node)
-    sleep(10)  # Wait and retry
-    logging.info("Restart Completed, waiting 10 seconds to retest")
-    if not get_and_verify_ticket(node):
-        logging.info(f"Ticket Creation failed for {node} Disabling Server")
-        disable_xero_server(node)
-    else:
-        subject = f"Xero Ticketing/Image Display has been Restored on {node} at {local_time_str}"
-        body = f"Xero Ticketing/Image Display has been Restored on {node} at {local_time_str}"
-        if use_memes:
-            generate_meme(successful_restart_meme_path,
-                          f"Xero Ticketing/Image Display has been Restored on {node}",
-                          "", temp_meme_path)
-            send_email(smtp_recipients, subject, body, node, temp_meme_path)
-            os.remove(temp_meme_path)
+# Largest font size between min_font_size and max_font_size whose rendering of text fits max_width, found by bisection
+def fit_font_to_width(draw, text, max_width, max_font_size, min_font_size=10):
+    low, high = min_font_size, max(min_font_size, max_font_size)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if draw.multiline_textbbox((0, 0), text, font=load_meme_font(settings.font_path, middle))[2] <= max_width:
+            low = middle
         else:
-            send_email(smtp_recipients, subject, body, node)
+            high = middle - 1
+    return load_meme_font(settings.font_path, low)
 
 
+# Function to generate meme with better text size and positioning, returns the JPEG bytes
+def generate_meme(image_path, top_text, bottom_text):
+    from PIL import ImageDraw
+    logging.info("Generating meme...")
+    try:
+        img = load_meme_image(image_path).copy()
+        draw = ImageDraw.Draw(img)
 
+        max_width = img.width * 0.9  # Allow a 5% margin on either side
+        max_font_size = img.height // 10  # Set a maximum font size based on image height
 
-def main():
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        executor.map(process_node, xero_nodes)
-    logging.info("All tasks completed. Shutting down.")
+        # Adjust top text font
+        wrapped_top_text = textwrap.fill(top_text, width=40)
+        font = fit_font_to_width(draw, wrapped_top_text, max_width, max_font_size)
 
-def meme_testing():
-    xero_server = "TESTSERVER"
-    generate_meme(successful_restart_meme_path, f"Xero Ticketing/Image Display has been Restored on {xero_server}","", temp_meme_path)
-    #generate_meme(unsuccessful_restart_meme_path, "ONE DOES NOT SIMPLY", f"RESTART XERO SERVICES ON {xero_server}", temp_meme_path)
-    subject = f"Xero Ticketing/Image Display has been Restored on {xero_server} at {local_time_str}"
-    body = f"Xero Ticketing/Image Display has been Restored on {xero_server} at {local_time_str}"
-    send_email(smtp_recipients, subject, body, xero_server, temp_meme_path)
-    #os.remove(temp_meme_path)
+        # Draw top text
+        top_y_position = 10
+        draw.multiline_text(
+            ((img.width - draw.multiline_textbbox((0, 0), wrapped_top_text, font=font)[2]) / 2, top_y_position),
+            wrapped_top_text, fill="white", font=font, align="center"
+        )
 
-if __name__ == '__main__':
-    main()
+        # Adjust bottom text font
+        wrapped_bottom_text = textwrap.fill(bottom_text, width=40)
+        font = fit_font_to_width(draw, wrapped_bottom_text, max_width, max_font_size)
+
+        # Draw bottom text at the bottom with a bit of padding
+        bottom_y_position = img.height - draw.multiline_textbbox((0, 0), wrapped_bottom_text, font=font)[3] - 20
+        draw.multiline_text(
+            ((img.width - draw.multiline_textbbox((0, 0), wrapped_bottom_text, font=font)[2]) / 2, bottom_y_position),
+            wrapped_bottom_text, fill="white", font=font, align="center"
+        )
+
+        # Render the meme into memory
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG")
+        logging.info(f"Meme generated ({buffer.tell()} bytes)")
+        return buffer.getvalue()
+
+    except Exception as e:
+        logging.error(f"Failed to generate meme: {e}")
+        raise
+
+
+
+# Cross-process lock so an overlapping run can't interleave its writes with ours
+@contextlib.contextmanager
+def locked_file(lock_path):
+    with open(lock_path, 'a+') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# JSON state file held in memory: lookups never touch the file contents, and mutations are applied under a
+# thread lock plus a cross-process file lock, then written to a temp file and renamed over the original
+class JsonStateStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.data = None
+        self.version = None
+
+    # every write replaces the file, so the inode changes even where mtimes are too coarse to tell writes apart
+    def _file_version(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self, force=False):
+        # reload only when another process (or an operator) has changed the file since we last saw it
+        version = self._file_version()
+        if not force and self.data is not None and version == self.version:
+            return
+        try:
+            with open(self.path, 'r') as file:
+                content = file.read().strip()
+                self.data = json.loads(content) if content else {}
+        except (FileNotFoundError, ValueError, json.JSONDecodeError):
+            self.data = {}
+        self.version = version
+
+    def _write(self):
+        directory = os.path.dirname(self.path) or "."
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(self.data, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.version = self._file_version()
+
+    def get_all(self):
+        with self.lock:
+            self._load()
+            return dict(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            self._load()
+            return self.data.get(key, default)
+
+    def update(self, mutate):
+        with self.lock, locked_file(self.path + ".lock"):
+            # always re-read under the file lock, a change the cache missed would otherwise be written over
+            self._load(force=True)
+            result = mutate(self.data)
+            self._write()
+            return result
+
+    def record_event(self, xero_server, event, detail):
+        # history is only kept by the SQLite backend
+        pass
+
+
+# SQLite-backed alternative, several stores share one database and it also keeps a history of disable/restore events
+class SqliteStateStore:
+    def __init__(self, db_path, name):
+        self.db_path = db_path
+        self.name = name
+        self.lock = threading.RLock()
+        self.data = None
+        self.data_version = None
+        import sqlite3
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute(
+                "create table if not exists server_state "
+                "(store text not null, server text not null, value text, primary key (store, server))"
+            )
+            self.connection.execute(
+                "create table if not exists server_history "
+                "(id integer primary key autoincrement, recorded_at text not null, store text not null, "
+                "server text not null, event text not null, detail text)"
+            )
+
+    def _load(self):
+        data_version = self.connection.execute("pragma data_version").fetchone()[0]
+        if self.data is not None and data_version == self.data_version:
+            return
+        rows = self.connection.execute("select server, value from server_state where store = ?", (self.name,))
+        self.data = {server: json.loads(value) for server, value in rows}
+        self.data_version = data_version
+
+    def get_all(self):
+        with self.lock:
+            self._load()
+            return dict(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            self._load()
+            return self.data.get(key, default)
+
+    def update(self, mutate):
+        with self.lock:
+            # begin immediate takes SQLite's write lock up front, which serializes us against other processes
+            self.connection.execute("begin immediate")
+            try:
+                self.data = None
+                self._load()
+                # compared as JSON, mutate may change an entry in place
+                before = {server: json.dumps(value) for server, value in self.data.items()}
+                result = mutate(self.data)
+                for server in before.keys() - self.data.keys():
+                    self.connection.execute(
+                        "delete from server_state where store = ? and server = ?", (self.name, server)
+                    )
+                for server, value in self.data.items():
+                    value = json.dumps(value)
+                    if before.get(server) != value:
+                        self.connection.execute(
+                            "insert or replace into server_state (store, server, value) values (?, ?, ?)",
+                            (self.name, server, value),
+                        )
+                self.connection.execute("commit")
+            except Exception:
+                self.connection.execute("rollback")
+                self.data = None
+                raise
+            return result
+
+    def record_event(self, xero_server, event, detail):
+        with self.lock:
+            self.connection.execute(
+                "insert into server_history (recorded_at, store, server, event, detail) values (?, ?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec="seconds"), self.name, xero_server, event, detail),
+            )
+
+
+def open_state_store(name, json_path):
+    if settings.state_backend == "sqlite":
+        return SqliteStateStore(settings.state_db_file, name)
+    return JsonStateStore(json_path)
+
+
+# A shared state store opened the first time it is used, so importing the script never reads [Xero] and a bad
+# config is reported by --check-config (or the exit status 2 of a run) rather than a traceback
+class LazyStateStore:
+    def __init__(self, name, path_option):
+        self.store_args = (name, path_option)
+        self.store = None
+        self.open_lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        with self.open_lock:
+            if self.store is None:
+                name, path_option = self.store_args
+                self.store = open_state_store(name, getattr(settings, path_option))
+        return getattr(self.store, attribute)
+
+
+# Restart slots of a cluster, handed out in the order the nodes were queued (longest-failing first) rather than in
+# whatever order their workers get there. A queued node that ends up not needing a slot must leave the queue.
+class RestartSlots:
+    def __init__(self, slots):
+        self.free = slots
+        self.waiting = []
+        self.condition = threading.Condition()
+
+    def queue(self, nodes):
+        with self.condition:
+            self.waiting.extend(node for node in nodes if node not in self.waiting)
+
+    def leave(self, node):
+        with self.condition:
+            if node in self.waiting:
+                self.waiting.remove(node)
+                self.condition.notify_all()
+
+    # Waits for the node's turn and a free slot, up to timeout seconds (None for no limit)
+    def acquire(self, xero_server, timeout=None):
+        with self.condition:
+            if xero_server not in self.waiting:
+                self.waiting.append(xero_server)
+            acquired = self.condition.wait_for(lambda: self.free and self.waiting[0] == xero_server, timeout)
+            self.waiting.remove(xero_server)
+            if acquired:
+                self.free -= 1
+            # the next node in the queue may be able to go now
+            self.condition.notify_all()
+            return bool(acquired)
+
+    def release(self):
+        with self.condition:
+            self.free += 1
+            self.condition.notify_all()
+
+
+# One monitored cluster: its nodes, state files, cluster DB pool and the limits that apply within it.
+# HTTP sessions, SSH connections and email delivery are shared by every cluster.
+class Cluster:
+    def __init__(self, name, values, store_prefix):
+        self.name = name
+        for attribute, value in values.items():
+            setattr(self, attribute, value)
+        self.nodes = self.xero_nodes
+        self.store_prefix = store_prefix
+        self.open_stores()
+        self.db_pool = None
+        self.db_pool_lock = threading.Lock()
+        self.upgrade_status_snapshot = {"fetched_at": None, "nodes": None}
+        self.upgrade_status_lock = threading.Lock()
+        # at most xero_max_concurrent_restarts of the cluster's nodes are restarting at once
+        self.restart_slots = RestartSlots(self.xero_max_concurrent_restarts)
+        self.capacity_lock = threading.Lock()
+        self.pending_disables = set()
+        # one purge per cluster at a time, a purge is disk-heavy and nodes share storage bandwidth
+        self.purge_slot = threading.Lock()
+
+    def open_stores(self):
+        self.disabled_servers_store = open_state_store(f"{self.store_prefix}disabled_servers", self.disabled_servers_file)
+        self.failing_servers_store = open_state_store(f"{self.store_prefix}failing_servers", self.failing_servers_file)
+
+
+# the first cluster keeps the unprefixed SQLite store names it had before there could be several
+def load_clusters():
+    return [
+        Cluster(name, values, f"{name}:" if index else "")
+        for index, (name, values) in enumerate(settings.cluster_settings())
+    ]
+
+
+# Built the first time they are used, like the state stores
+class ClusterList:
+    def __init__(self):
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.loaded is None:
+                self.loaded = load_clusters()
+        return self.loaded
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __getitem__(self, index):
+        return self.load()[index]
+
+    def __len__(self):
+        return len(self.load())
+
+
+clusters = ClusterList()
+
+
+def cluster_for_node(xero_server):
+    for cluster in clusters:
+        if xero_server in cluster.nodes:
+            return cluster
+    # a node outside every cluster (e.g. meme testing) is handled like one of the first cluster's
+    return clusters[0]
+
+
+def monitored_nodes():
+    return [node for cluster in clusters for node in cluster.nodes]
+
+
+degraded_servers_store = LazyStateStore("degraded_servers", "degraded_servers_file")
+
+
+# disabled server management
+class DisabledServerManager:
+    @staticmethod
+    def load_disabled_servers():
+        disabled = {}
+        for cluster in clusters:
+            disabled.update(cluster.disabled_servers_store.get_all())
+        return disabled
+
+    @staticmethod
+    def save_disabled_servers(servers):
+        for cluster in clusters:
+            def replace(data, cluster=cluster):
+                data.clear()
+                data.update({node: incident for node, incident in servers.items() if cluster_for_node(node) is cluster})
+            cluster.disabled_servers_store.update(replace)
+
+    @staticmethod
+    def is_server_disabled(xero_server):
+        return cluster_for_node(xero_server).disabled_servers_store.get(xero_server) is not None
+
+    @staticmethod
+    def save_disabled_server(xero_server, incident_number):
+        store = cluster_for_node(xero_server).disabled_servers_store
+        store.update(lambda servers: servers.__setitem__(xero_server, incident_number))
+        store.record_event(xero_server, "disabled", incident_number)
+
+    @staticmethod
+    def remove_disabled_server(xero_server):
+        # removing first means only one thread sends the restored notification
+        store = cluster_for_node(xero_server).disabled_servers_store
+        incident = store.update(lambda servers: servers.pop(xero_server, None))
+        if incident is None:
+            return
+        store.record_event(xero_server, "restored", incident)
+        local_time_str = datetime.now().time()
+        if incident == 'PREPARE':
+            subject = f"Xero Ticketing/Image Display has been Restored on {xero_server} at {local_time_str}"
+            body = f"Xero Ticketing/Image Display has been Restored on {xero_server} at {local_time_str}"
+        else:
+            subject = f"Xero Ticketing/Image Display has been Restored on {xero_server} at {local_time_str}"
+            body = f"Xero Ticketing/Image Display has been Restored on {xero_server} at {local_time_str}\nPlease Close {incident}"
+        if settings.use_memes:
+            meme_data = generate_meme(settings.successful_restart_meme_path,
+                                      f"Xero Ticketing/Image Display has been Restored on {xero_server}", "")
+            send_email(settings.smtp_recipients, subject, body, xero_server, meme_data)
+        else:
+            send_email(settings.smtp_recipients, subject, body, xero_server)
+
+
+# Tracks when each node started failing so remediation can handle the longest-failing nodes first
+class FailureTracker:
+    @staticmethod
+    def load_failing_servers():
+        failing = {}
+        for cluster in clusters:
+            failing.update(cluster.failing_servers_store.get_all())
+        return failing
+
+    @staticmethod
+    def record_probe_results(probe_results):
+        now = time.time()
+        failing = {}
+        for cluster in clusters:
+            results = {node: result for node, result in probe_results.items() if cluster_for_node(node) is cluster}
+            if not results:
+                continue
+
+            def record(servers, results=results):
+                for node, result in results.items():
+                    if result["healthy"]:
+                        servers.pop(node, None)
+                    else:
+                        servers.setdefault(node, now)
+                return dict(servers)
+            failing.update(cluster.failing_servers_store.update(record))
+        return failing
+
+
+# Nodes that hand out tickets but fail or crawl on the WADO probe. They stay in rotation, operators are
+# told when a node becomes degraded and again when its image retrieval recovers
+class DegradedTracker:
+    @staticmethod
+    def load_degraded_servers():
+        return degraded_servers_store.get_all()
+
+    @staticmethod
+    def record_probe_results(probe_results):
+        def record(servers):
+            changes = []
+            for node, result in probe_results.items():
+                # nodes without a WADO result (probe disabled, or ticketing failed) keep their current state
+                if result.get("wado") is None:
+                    continue
+                if result["degraded"]:
+                    if node not in servers:
+                        servers[node] = {"since": time.time(), "reason": result["wado"]["degraded_reason"]}
+                        changes.append((node, True))
+                elif servers.pop(node, None) is not None:
+                    changes.append((node, False))
+            return changes
+
+        for node, degraded in degraded_servers_store.update(record):
+            if degraded:
+                notify_wado_degraded(node, probe_results[node]["wado"])
+            else:
+                notify_wado_recovered(node, probe_results[node]["wado"])
+
+
+circuit_breakers_store = LazyStateStore("circuit_breakers", "circuit_breakers_file")
+
+
+# Circuit breaker for disabled nodes. A disabled node is "open": each run it only gets a TCP/TLS reachability
+# check, and a full ticket probe every xero_breaker_probe_interval seconds, doubling after each failed probe up to
+# xero_breaker_max_probe_interval. Once a full probe passes it is "half_open" and fully probed every run, and it
+# is only re-enabled ("closed") after xero_breaker_close_successes passing probes in a row.
+class CircuitBreaker:
+    @staticmethod
+    def state(xero_server):
+        entry = circuit_breakers_store.get(xero_server)
+        if entry is not None:
+            return entry["state"]
+        return "open" if DisabledServerManager.is_server_disabled(xero_server) else "closed"
+
+    @staticmethod
+    def full_probe_due(xero_server, now):
+        entry = circuit_breakers_store.get(xero_server)
+        return entry is not None and (entry["state"] == "half_open" or now >= entry["next_probe"])
+
+    @staticmethod
+    def record_probe_results(probe_results):
+        now = time.time()
+
+        def record(breakers):
+            closed = []
+            for node, result in probe_results.items():
+                if not DisabledServerManager.is_server_disabled(node):
+                    # re-enabled some other way (by hand)
+                    breakers.pop(node, None)
+                    continue
+                entry = breakers.get(node)
+                if entry is None:
+                    breakers[node] = {
+                        "state": "open", "since": now, "interval": settings.xero_breaker_probe_interval,
+                        "next_probe": now + settings.xero_breaker_probe_interval, "successes": 0,
+                    }
+                    continue
+                if result["breaker"] == "open" and not (result["reachable"] is False and now >= entry["next_probe"]):
+                    # only the reachability check ran; a due node that can't even be reached counts as a failed probe
+                    continue
+                if result["healthy"]:
+                    entry.update(state="half_open", successes=entry["successes"] + 1)
+                    if entry["successes"] >= settings.xero_breaker_close_successes:
+                        breakers.pop(node)
+                        closed.append(node)
+                else:
+                    interval = entry["interval"] if entry["state"] == "half_open" else entry["interval"] * 2
+                    interval = min(interval, settings.xero_breaker_max_probe_interval)
+                    entry.update(state="open", interval=interval, next_probe=now + interval, successes=0)
+            return closed
+
+        for node in circuit_breakers_store.update(record):
+            logging.info(f"{node} passed {settings.xero_breaker_close_successes} probes in a row, closing its circuit breaker")
+            DisabledServerManager.remove_disabled_server(node)
+        for node in probe_results:
+            metrics.set("xero_node_breaker_state", "Circuit breaker state of the node: 0 closed, 1 half-open, 2 open",
+                        {"node": node}, {"closed": 0, "half_open": 1, "open": 2}[CircuitBreaker.state(node)])
+
+
+ProbeRecord = collections.namedtuple(
+    "ProbeRecord", "timestamp ticket verify wado total ticket_attempts verify_attempts outcome"
+)
+
+
+# Per-node probe history: a fixed-size file of fixed-width records, memory-mapped and written as a ring buffer.
+# The header holds the capacity, the slot the next record goes into and how many slots are filled; missing
+# phase timings are stored as NaN.
+class ProbeHistory:
+    header = struct.Struct("<4sIII")
+    record = struct.Struct("<dffffHHB3x")
+    magic = b"XPH1"
+    outcome_codes = {"failure": 0, "healthy": 1, "degraded": 2}
+
+    def __init__(self):
+        self.maps = {}
+        self.lock = threading.Lock()
+
+    def path(self, xero_server):
+        return os.path.join(settings.history_dir, f"{xero_server}.hist")
+
+    def _open(self, xero_server):
+        mapped = self.maps.get(xero_server)
+        if mapped is not None:
+            return mapped
+        capacity = settings.history_capacity
+        size = self.header.size + capacity * self.record.size
+        path = self.path(xero_server)
+        os.makedirs(settings.history_dir, exist_ok=True)
+        with locked_file(f"{path}.lock"):
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                if os.path.exists(path):
+                    logging.info(f"Probe history capacity changed, starting a new history for {xero_server}")
+                with open(path, 'wb') as file:
+                    file.write(self.header.pack(self.magic, capacity, 0, 0))
+                    file.truncate(size)
+            with open(path, 'r+b') as file:
+                mapped = mmap.mmap(file.fileno(), size)
+        self.maps[xero_server] = mapped
+        return mapped
+
+    def append(self, xero_server, result):
+        timings = result["timings"]
+        outcome = "degraded" if result["degraded"] else "healthy" if result["healthy"] else "failure"
+        values = [math.nan if timings.get(phase) is None else timings[phase] for phase in ("ticket", "verify", "wado", "total")]
+        with self.lock:
+            mapped = self._open(xero_server)
+            with locked_file(f"{self.path(xero_server)}.lock"):
+                _, capacity, next_index, count = self.header.unpack_from(mapped, 0)
+                self.record.pack_into(
+                    mapped, self.header.size + next_index * self.record.size, time.time(), *values,
+                    result["ticket_attempts"], result["verify_attempts"], self.outcome_codes[outcome],
+                )
+                # the header is only advanced once the record is in place
+                self.header.pack_into(mapped, 0, self.magic, capacity, (next_index + 1) % capacity, min(count + 1, capacity))
+
+    # Appends records taken from another history (e.g. a recording), oldest first
+    def extend(self, xero_server, records):
+        with self.lock:
+            mapped = self._open(xero_server)
+            with locked_file(f"{self.path(xero_server)}.lock"):
+                _, capacity, next_index, count = self.header.unpack_from(mapped, 0)
+                for record in records:
+                    self.record.pack_into(mapped, self.header.size + next_index * self.record.size, *record)
+                    next_index, count = (next_index + 1) % capacity, min(count + 1, capacity)
+                self.header.pack_into(mapped, 0, self.magic, capacity, next_index, count)
+
+    # The newest limit records, oldest first
+    def recent(self, xero_server, limit):
+        with self.lock:
+            mapped = self._open(xero_server)
+            _, capacity, next_index, count = self.header.unpack_from(mapped, 0)
+            limit = min(limit, count)
+            first = (next_index - limit) % capacity
+            return [
+                ProbeRecord._make(self.record.unpack_from(mapped, self.header.size + (first + offset) % capacity * self.record.size))
+                for offset in range(limit)
+            ]
+
+    def close(self):
+        with self.lock:
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps.clear()
+
+
+probe_history = ProbeHistory()
+drifting_servers_store = LazyStateStore("drifting_servers", "drifting_servers_file")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def latency_p95(values):
+    return percentile(values, 0.95)
+
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+
+# Flag nodes whose rolling p95 ticket/verification latency over their last drift_window successful probes has
+# drifted drift_factor times above their own baseline (the drift_baseline probes before that) or above the
+# cluster median, by at least drift_min_ms. Returns {node: [reasons]}.
+def detect_latency_drift(nodes):
+    floor = settings.drift_min_ms / 1000
+    recent_p95 = {}
+    baseline_p95 = {}
+    for node in nodes:
+        records = [
+            record for record in probe_history.recent(node, settings.drift_window + settings.drift_baseline)
+            if record.outcome != ProbeHistory.outcome_codes["failure"]
+        ]
+        recent, earlier = records[-settings.drift_window:], records[:-settings.drift_window]
+        if len(recent) < settings.drift_min_samples:
+            continue
+        for phase in ("ticket", "verify"):
+            recent_p95[node, phase] = latency_p95(getattr(record, phase) for record in recent)
+            if len(earlier) >= settings.drift_min_samples:
+                baseline_p95[node, phase] = latency_p95(getattr(record, phase) for record in earlier)
+
+    flags = {}
+    for phase in ("ticket", "verify"):
+        cluster_values = {}
+        for (node, key), value in recent_p95.items():
+            if key == phase:
+                cluster_values.setdefault(cluster_for_node(node).name, []).append(value)
+        for (node, key), value in recent_p95.items():
+            if key != phase:
+                continue
+            phase_values = cluster_values[cluster_for_node(node).name]
+            # a cluster median needs a few nodes to mean anything
+            cluster_median = median(phase_values) if len(phase_values) >= 3 else None
+            metrics.set("xero_probe_latency_p95_seconds", "Rolling p95 latency over the last drift_window probes",
+                        {"node": node, "phase": phase}, round(value, 4))
+            baseline = baseline_p95.get((node, phase))
+            if baseline is not None and value > baseline * settings.drift_factor and value - baseline > floor:
+                flags.setdefault(node, []).append(
+                    f"{phase} p95 {value * 1000:.0f}ms vs its baseline {baseline * 1000:.0f}ms"
+                )
+            if cluster_median is not None and value > cluster_median * settings.drift_factor and value - cluster_median > floor:
+                flags.setdefault(node, []).append(
+                    f"{phase} p95 {value * 1000:.0f}ms vs cluster median {cluster_median * 1000:.0f}ms"
+                )
+    for node in nodes:
+        metrics.set("xero_node_drifting", "1 if the node's probe latency has drifted above its baseline or the cluster",
+                    {"node": node}, int(node in flags))
+    return flags
+
+
+# Last known state of every node for the status pages and status_file, built from the most recent probe and
+# liveness results plus the state stores. Serving it never touches the Xero nodes or the cluster DB.
+class StatusBoard:
+    def __init__(self):
+        self.probes = {}
+        self.liveness = {}
+        self.updated_at = None
+        self.lock = threading.Lock()
+
+    def record_probe(self, xero_server, result):
+        with self.lock:
+            self.updated_at = time.time()
+            self.probes[xero_server] = {
+                "at": self.updated_at,
+                "healthy": result["healthy"],
+                "degraded": result["degraded"],
+                "breaker": result["breaker"],
+                "reachable": result["reachable"],
+                "ticket_attempts": result["ticket_attempts"],
+                "verify_attempts": result["verify_attempts"],
+                "timings": {phase: None if seconds is None else round(seconds, 4) for phase, seconds in result["timings"].items()},
+                "wado_throughput": round(result["wado"]["throughput"]) if result["wado"] else None,
+            }
+
+    def record_liveness(self, xero_server, alive):
+        with self.lock:
+            self.updated_at = time.time()
+            self.liveness[xero_server] = {"at": self.updated_at, "alive": alive}
+
+    def snapshot(self):
+        with self.lock:
+            probes, liveness, updated_at = dict(self.probes), dict(self.liveness), self.updated_at
+        failing = FailureTracker.load_failing_servers()
+        degraded = DegradedTracker.load_degraded_servers()
+        inventory = node_inventory_store.get_all()
+        nodes = {}
+        for cluster in clusters:
+            disabled = cluster.disabled_servers_store.get_all()
+            # only what the last upgrade check or discovery already fetched, the status page never queries the DB
+            upgrade_status = cluster.upgrade_status_snapshot["nodes"] or {}
+            stages = (inventory.get(cluster.name) or {}).get("stages", {})
+            for node in cluster.nodes:
+                probe = probes.get(node)
+                installer = [status for node_id, status in installer_entries(upgrade_status, node)]
+                if node in disabled:
+                    state = "disabled"
+                elif probe is None:
+                    state = "unknown"
+                else:
+                    state = "degraded" if probe["degraded"] else "healthy" if probe["healthy"] else "failing"
+                nodes[node] = {
+                    "cluster": cluster.name,
+                    "state": state,
+                    "last_probe": probe,
+                    "last_liveness": liveness.get(node),
+                    "failing_since": failing.get(node),
+                    "degraded": degraded.get(node),
+                    "disabled": disabled.get(node),
+                    "circuit_breaker": CircuitBreaker.state(node),
+                    "install_stage": installer[0]["stage"] if installer else stages.get(node),
+                    "prepare": disabled.get(node) == "PREPARE"
+                    or any(status["stage"] == "PREPARE" and status["uninstalled"] == 'false' for status in installer),
+                }
+        return {"updated_at": updated_at, "nodes": nodes}
+
+    def render_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True).encode()
+
+    def render_html(self):
+        def cell(value):
+            return f"<td>{html.escape('' if value is None else str(value))}</td>"
+
+        def when(timestamp):
+            return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S") if timestamp else None
+
+        snapshot = self.snapshot()
+        rows = []
+        for node, status in snapshot["nodes"].items():
+            probe = status["last_probe"] or {"timings": {}}
+            rows.append(
+                f"<tr class=\"{status['state']}\">" + cell(node) + cell(status["cluster"]) + cell(status["state"])
+                + cell(when(probe.get("at"))) + "".join(cell(probe["timings"].get(phase)) for phase in ("ticket", "verify", "wado", "total"))
+                + cell(status["disabled"]) + cell(status["install_stage"]) + cell("yes" if status["prepare"] else "")
+                + cell(status["circuit_breaker"]) + "</tr>"
+            )
+        return (
+            "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Xero node status</title><style>"
+            "body{font-family:sans-serif}td,th{padding:2px 8px;text-align:left}"
+            ".failing,.disabled{background:#f8d7da}.degraded{background:#fff3cd}</style></head><body>"
+            f"<h1>Xero node status</h1><p>Last update {html.escape(str(when(snapshot['updated_at'])))}</p><table>"
+            "<tr><th>Node</th><th>Cluster</th><th>State</th><th>Last probe</th><th>Ticket s</th><th>Verify s</th>"
+            "<th>WADO s</th><th>Total s</th><th>Disabled (incident)</th><th>Install stage</th><th>PREPARE</th>"
+            "<th>Breaker</th></tr>" + "".join(rows) + "</table></body></html>"
+        ).encode()
+
+    def write_file(self, path):
+        directory = os.path.dirname(path) or "."
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(self.render_json())
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+status_board = StatusBoard()
+
+
+def write_status_file():
+    if not settings.status_file:
+        return
+    try:
+        status_board.write_file(settings.status_file)
+    except OSError as e:
+        logging.error(f"Unable to write status file {settings.status_file}: {e}")
+
+
+# Function to encode an image as base64
+def image_to_base64(image_path):
+    with open(image_path, "rb") as image_file:
+        encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
+    return encoded_image
+
+
+# Outgoing mail is queued and delivered by one background sender over a reused SMTP connection.
+# Every message is spooled to disk before its first attempt and removed once delivered, so mail the relay didn't
+# take (or that was still queued when the run ended) is resent by a later run.
+class EmailOutbox:
+    idle_timeout = 60
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        self.smtp = None
+        self.relay_down_until = 0
+        self.digest = []
+        self.digest_lock = threading.Lock()
+        # spool files of the messages in the queue, so they aren't queued twice
+        self.queued = set()
+        self.spool_lock = threading.Lock()
+
+    def start(self):
+        with self.thread_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+                self.thread.start()
+
+    def put(self, smtp_from, recipients, message):
+        item = {"smtp_from": smtp_from, "recipients": recipients, "message": message}
+        try:
+            self._spool(item)
+        except OSError as e:
+            logging.error(f"Unable to spool email to {', '.join(recipients)}, it is only queued in memory: {e}")
+        self.start()
+        self.queue.put(item)
+
+    def spooled_paths(self):
+        if not os.path.isdir(settings.smtp_spool_dir):
+            return []
+        return [os.path.join(settings.smtp_spool_dir, name) for name in sorted(os.listdir(settings.smtp_spool_dir))
+                if name.endswith(".json")]
+
+    # Resends mail spooled by earlier runs, even when this run has nothing new to send. The mail is queued here
+    # rather than by the sender thread, so it is ahead of the sentinel close() queues straight after.
+    def resend_spooled(self):
+        spooled = self.spooled_paths()
+        if spooled:
+            logging.info(f"Resending {len(spooled)} spooled emails")
+            self.start()
+            self._queue_spooled()
+
+    def add_to_digest(self, node, subject, body):
+        with self.digest_lock:
+            self.digest.append({"time": datetime.now(), "node": node, "subject": subject, "body": body})
+
+    def digest_age(self):
+        with self.digest_lock:
+            if not self.digest:
+                return 0
+            return (datetime.now() - self.digest[0]["time"]).total_seconds()
+
+    def flush_digest(self):
+        with self.digest_lock:
+            events, self.digest = self.digest, []
+        if not events:
+            return
+        subject = f"Xero Monitoring: {len(events)} events on {len({event['node'] for event in events})} nodes"
+        rows = "".join(
+            f"<tr><td>{event['time'].strftime('%H:%M:%S')}</td><td>{event['node']}</td>"
+            f"<td>{event['subject']}</td><td>{event['body'].replace(chr(10), '<br>')}</td></tr>"
+            for event in events
+        )
+        from email.mime.text import MIMEText
+        msg = MIMEText(
+            f"<html><body><table border='1' cellpadding='4' cellspacing='0'>"
+            f"<tr><th>Time</th><th>Node</th><th>Event</th><th>Details</th></tr>{rows}</table></body></html>",
+            'html'
+        )
+        msg["From"] = settings.smtp_from_address
+        msg["To"] = ", ".join(settings.smtp_recipients)
+        msg["Subject"] = subject
+        logging.info(f"Queueing digest email with {len(events)} events")
+        self.put(settings.smtp_from_address, settings.smtp_recipients, msg.as_string())
+
+    def _run(self):
+        self._queue_spooled()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                # don't hold the relay connection open while there is nothing to send
+                self._disconnect()
+                self._queue_spooled()
+                continue
+            try:
+                if item is None:
+                    self._disconnect()
+                    return
+                self._deliver(item)
+            finally:
+                self.queue.task_done()
+
+    def _connect(self):
+        import smtplib
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(settings.smtp_server, settings.smtp_port, timeout=30)
+        return self.smtp
+
+    def _disconnect(self):
+        import smtplib
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self.smtp.close()
+            self.smtp = None
+
+    def _deliver(self, item):
+        try:
+            self._send(item)
+        finally:
+            with self.spool_lock:
+                self.queued.discard(item.get("spool_path"))
+
+    def _send(self, item):
+        import smtplib
+        recipients = ', '.join(item["recipients"])
+        if time.monotonic() < self.relay_down_until:
+            self._keep_spooled(item)
+            return
+        for attempt in range(settings.smtp_retry_attempts):
+            start = time.perf_counter()
+            try:
+                self._connect().sendmail(item["smtp_from"], item["recipients"], item["message"])
+                metrics.observe("xero_email_send_seconds", "Duration of SMTP deliveries", {"outcome": "success"},
+                                time.perf_counter() - start)
+                logging.info(f"Email sent to {recipients}")
+                if item.get("spool_path"):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(item["spool_path"])
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                metrics.observe("xero_email_send_seconds", "Duration of SMTP deliveries", {"outcome": "failure"},
+                                time.perf_counter() - start)
+                logging.error(f"Email sending failed to {recipients} (attempt {attempt + 1}): {e}")
+                self._disconnect()
+                if attempt + 1 < settings.smtp_retry_attempts:
+                    sleep(2 ** attempt)
+        # the relay looks down, leave this and anything queued behind it spooled for a while instead of retrying each one
+        self.relay_down_until = time.monotonic() + self.idle_timeout
+        self._keep_spooled(item)
+
+    def _spool(self, item):
+        os.makedirs(settings.smtp_spool_dir, exist_ok=True)
+        spool_path = os.path.join(settings.smtp_spool_dir, f"{time.time():.6f}-{uuid.uuid4().hex}.json")
+        # marked as queued before it appears, so the sender doesn't pick it up from the spool as well
+        with self.spool_lock:
+            self.queued.add(spool_path)
+        try:
+            with open(spool_path + ".tmp", 'w') as file:
+                json.dump(item, file)
+            os.replace(spool_path + ".tmp", spool_path)
+        except OSError:
+            with self.spool_lock:
+                self.queued.discard(spool_path)
+            raise
+        item["spool_path"] = spool_path
+
+    def _keep_spooled(self, item):
+        if not item.get("spool_path"):
+            try:
+                self._spool(item)
+            except OSError as e:
+                logging.error(f"Unable to spool email to {', '.join(item['recipients'])}, it is lost: {e}")
+                return
+        metrics.inc("xero_emails_spooled", "Emails left spooled on disk while the relay was unavailable", {})
+        logging.info(f"Email to {', '.join(item['recipients'])} left spooled at {item['spool_path']} for a later attempt")
+
+    def _queue_spooled(self):
+        if time.monotonic() < self.relay_down_until:
+            return
+        for spool_path in self.spooled_paths():
+            # claimed under the lock, close() and the sender thread may both be queueing the spool
+            with self.spool_lock:
+                if spool_path in self.queued:
+                    continue
+                self.queued.add(spool_path)
+            try:
+                with open(spool_path, 'r') as file:
+                    item = json.load(file)
+            except (OSError, ValueError) as e:
+                logging.error(f"Unable to read spooled email {spool_path}: {e}")
+                with self.spool_lock:
+                    self.queued.discard(spool_path)
+                continue
+            item["spool_path"] = spool_path
+            self.queue.put(item)
+
+    def close(self, timeout=60):
+        if settings.email_digest_mode:
+            self.flush_digest()
+        self.resend_spooled()
+        with self.thread_lock:
+            thread = self.thread
+            self.thread = None
+        if thread is None:
+            return
+        self.queue.put(None)
+        thread.join(timeout)
+        if thread.is_alive():
+            logging.error(f"Email outbox did not drain within {timeout}s, undelivered mail stays spooled for the next run")
+
+
+email_outbox = EmailOutbox()
+
+
+# Define a unified function to send emails, with optional meme attachment
+def send_email(smtp_recipients, subject, body, node, meme_data=None):
+    recorder.note("email", node, {"to": list(smtp_recipients), "subject": subject, "body": body})
+    if recorder.mode == "replay":
+        return
+    if settings.email_digest_mode:
+        email_outbox.add_to_digest(node, subject, body)
+        return
+    smtp_from = f"{node}@{settings.smtp_from_domain}"
+    msg = construct_email_message(smtp_from, smtp_recipients, subject, body, meme_data)
+    email_outbox.put(smtp_from, smtp_recipients, msg.as_string())
+    metrics.inc("xero_emails_queued", "Notification emails queued", {})
+    logging.info(f"Email queued for {', '.join(smtp_recipients)}")
+
+
+
+# Helper function to construct email message with an embedded image
+def construct_email_message(smtp_from, smtp_recipients, subject, body, meme_data=None):
+    from email.mime.image import MIMEImage
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    # Create a MIMEMultipart message to handle both HTML and image content
+    msg = MIMEMultipart('related')
+    msg["From"] = smtp_from
+    msg["To"] = ", ".join(smtp_recipients)
+    msg["Subject"] = subject
+
+    # Create the HTML body, embedding the image with a CID
+    body_html = body.replace("\n", "<br>")
+    html_body = f"""
+    <html>
+        <body>
+            <p>{body_html}</p>
+            {"<img src='cid:meme_image' alt='Meme'>" if meme_data else ""}
+        </body>
+    </html>
+    """
+    # Attach the HTML body to the email
+    msg.attach(MIMEText(html_body, 'html'))
+
+    # Attach the image if meme_data is provided
+    if meme_data:
+        image_part = MIMEImage(meme_data)
+        image_part.add_header('Content-ID', '<meme_image>')
+        image_part.add_header('Content-Disposition', 'inline', filename='meme.jpg')
+        msg.attach(image_part)
+
+    return msg
+
+
+def create_and_send_failure_incident(xero_server, failure_reason):
+    local_time_str = datetime.now().time()
+    subject = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} ({failure_reason})"
+    body = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str}\nPlease investigate."
+    incident_summary = subject
+    external_unique_id = incident_external_id(xero_server)
+    urgency, impact = get_urgency_and_impact()
+    incident_number = create_service_now_incident(
+        incident_summary, body, settings.configuration_item, external_unique_id, urgency, impact, xero_server
+    )
+    if incident_number:
+        subject += f" {incident_number}"
+        DisabledServerManager.save_disabled_server(xero_server, incident_number)
+    else:
+        DisabledServerManager.save_disabled_server(xero_server, "Ticket Creation Failed")
+
+    send_email(settings.smtp_recipients, subject, body, xero_server)
+
+
+# The same node + failure episode always maps to the same external id, so a retried or repeated
+# incident request coalesces onto the incident already opened for that failure
+def incident_external_id(xero_server):
+    episode = FailureTracker.load_failing_servers().get(xero_server)
+    if episode is None:
+        episode = datetime.now().strftime("%Y-%m-%d")
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{settings.service_now_instance}/{xero_server}/{episode}"))
+
+
+pending_incidents_store = LazyStateStore("pending_incidents", "pending_incidents_file")
+
+
+# ServiceNow client: one pooled session with bounded timeouts, incidents remembered by external id,
+# and 5xx/timeout failures handed to a background retry queue so callers never wait on a slow instance.
+# Incidents waiting for a retry are kept in pending_incidents_file until they are created, so one the run
+# didn't get to is retried by the next run.
+class ServiceNowClient:
+    def __init__(self):
+        self.session = None
+        self.lock = threading.Lock()
+        self.incidents = {}
+        self.retry_queue = queue.Queue()
+        self.retry_thread = None
+        self.correlated_incident = None
+        self.correlated_nodes = set()
+        self.correlation_candidates = set()
+        # held while the parent incident is opened, so nodes failing together can't open one each
+        self.correlation_lock = threading.Lock()
+
+    def get_session(self):
+        with self.lock:
+            if self.session is None:
+                self.session = requests.Session()
+                self.session.mount("https://", http_adapter())
+                self.session.auth = (settings.service_now_api_user, settings.service_now_api_password)
+                self.session.headers.update({
+                    "Content-Type": "application/json",
+                    "Accept": "application/json",
+                })
+            return self.session
+
+    def post_incident(self, payload, xero_server):
+        incident_api_url = f"https://{settings.service_now_instance}/api/now/table/{settings.service_now_table}"
+        # logging.info("Incident Creation Payload:", payload)  # Print payload for debugging
+        start = time.perf_counter()
+        try:
+            # every incident goes to the same URL, so a replay tells them apart by the node (or the outage) they are for
+            with recorder.requests_for(xero_server or "correlated outage"):
+                response = self.get_session().post(incident_api_url, json=payload, timeout=(5, settings.service_now_timeout))
+        except requests.exceptions.RequestException as e:
+            metrics.observe("xero_servicenow_request_seconds", "Duration of ServiceNow incident requests",
+                            {"outcome": request_outcome(e)}, time.perf_counter() - start)
+            raise
+        metrics.observe("xero_servicenow_request_seconds", "Duration of ServiceNow incident requests",
+                        {"outcome": "success" if response.status_code == 201 else "http_error"}, time.perf_counter() - start)
+
+        # logging.info("Incident Creation Response Status Code:", response.status_code)  # Print status code for debugging
+        # logging.info("Incident Creation Response Content:", response.text)  # Print response content for debugging
+
+        if response.status_code == 201:
+            incident_number = response.json().get("result", {}).get("u_task_string")
+            logging.info(f"ServiceNow incident created successfully: {incident_number}")
+            with self.lock:
+                self.incidents[payload["u_external_unique_id"]] = incident_number
+            return incident_number, False
+        logging.info(f"Failed to create ServiceNow incident. Response: {response.text}")
+        return None, response.status_code >= 500
+
+    def create_incident(self, summary, description, configuration_item, external_unique_id, urgency, impact, xero_server=None):
+        if xero_server is not None:
+            parent = self.correlated_incident_for(xero_server)
+            if parent is not None:
+                return parent
+        with self.lock:
+            if external_unique_id in self.incidents:
+                logging.info(f"ServiceNow incident {self.incidents[external_unique_id]} already open for this failure")
+                return self.incidents[external_unique_id]
+        if pending_incidents_store.get(external_unique_id) is not None:
+            logging.info(f"ServiceNow incident {external_unique_id} is already waiting for a retry")
+            return None
+
+        payload = {
+            "u_short_description": summary,
+            "u_description": description,
+            "u_affected_user_id": "",
+            "u_configuration_item": configuration_item,
+            "u_external_unique_id": external_unique_id,
+            "u_urgency": urgency,
+            "u_impact": impact,
+            "u_type": settings.ticket_type,
+            "u_assignment_group": settings.assignment_group,
+        }
+
+        try:
+            incident_number, retryable = self.post_incident(payload, xero_server)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            logging.error(f"An error occurred while creating ServiceNow incident: {e}")
+            incident_number, retryable = None, True
+        except requests.exceptions.RequestException as e:
+            logging.error(f"An error occurred while creating ServiceNow incident: {e}")
+            incident_number, retryable = None, False
+
+        if incident_number is None and retryable:
+            self.queue_retry(payload, xero_server)
+        return incident_number
+
+    def queue_retry(self, payload, xero_server, resumed=False):
+        logging.info(f"Queueing ServiceNow incident {payload['u_external_unique_id']} for retry")
+        if not resumed:
+            pending_incidents_store.update(lambda incidents: incidents.__setitem__(
+                payload["u_external_unique_id"], {"payload": payload, "xero_server": xero_server, "queued_at": time.time()}
+            ))
+        with self.lock:
+            if self.retry_thread is None:
+                self.retry_thread = threading.Thread(target=self._retry_loop, name="servicenow-retry", daemon=True)
+                self.retry_thread.start()
+        self.retry_queue.put((payload, xero_server, resumed))
+
+    # Queues the incidents an earlier run left waiting for a retry. One whose node has since been restored, or
+    # has had an incident recorded for it some other way, is dropped.
+    def resume_pending(self):
+        pending = pending_incidents_store.get_all()
+        for external_unique_id, entry in pending.items():
+            xero_server = entry["xero_server"]
+            if xero_server is not None and \
+                    cluster_for_node(xero_server).disabled_servers_store.get(xero_server) != "Ticket Creation Failed":
+                logging.info(f"Dropping pending ServiceNow incident {external_unique_id}, {xero_server} no longer needs it")
+                pending_incidents_store.update(lambda incidents, key=external_unique_id: incidents.pop(key, None))
+                continue
+            self.queue_retry(entry["payload"], xero_server, resumed=True)
+
+    def _retry_loop(self):
+        while True:
+            item = self.retry_queue.get()
+            try:
+                if item is None:
+                    return
+                self._retry(*item)
+            finally:
+                self.retry_queue.task_done()
+
+    def _retry(self, payload, xero_server, resumed):
+        external_unique_id = payload["u_external_unique_id"]
+        for attempt in range(settings.service_now_retry_attempts):
+            # an incident left by an earlier run has waited long enough already
+            if attempt or not resumed:
+                sleep(min(60, 5 * 2 ** attempt))
+            try:
+                incident_number, retryable = self.post_incident(payload, xero_server)
+            except requests.exceptions.RequestException as e:
+                logging.error(f"ServiceNow retry {attempt + 1} failed: {e}")
+                continue
+            if incident_number:
+                if xero_server is not None:
+                    self.attach_incident(xero_server, incident_number)
+                pending_incidents_store.update(lambda incidents: incidents.pop(external_unique_id, None))
+                return
+            if not retryable:
+                logging.error(f"Giving up on ServiceNow incident {external_unique_id}, ServiceNow rejected it")
+                pending_incidents_store.update(lambda incidents: incidents.pop(external_unique_id, None))
+                return
+        logging.error(f"ServiceNow incident {external_unique_id} still failing after {settings.service_now_retry_attempts} "
+                      f"retries, leaving it for the next run")
+
+    @staticmethod
+    def attach_incident(xero_server, incident_number):
+        # swap the placeholder saved when the first attempt failed for the real incident number
+        def replace_placeholder(servers):
+            if servers.get(xero_server) == "Ticket Creation Failed":
+                servers[xero_server] = incident_number
+                return True
+            return False
+        if cluster_for_node(xero_server).disabled_servers_store.update(replace_placeholder):
+            logging.info(f"Recorded late ServiceNow incident {incident_number} for {xero_server}")
+
+    # Nodes failing together that have not been remediated yet. Nothing is opened until one of them needs an
+    # incident, i.e. its restart didn't bring it back.
+    def add_correlation_candidates(self, nodes):
+        with self.lock:
+            self.correlation_candidates.update(nodes)
+
+    # The parent incident a failing node joins instead of opening its own: opened by the first candidate whose
+    # remediation fails, and listing every node that was failing with it
+    def correlated_incident_for(self, xero_server):
+        with self.correlation_lock:
+            with self.lock:
+                if xero_server not in self.correlation_candidates and xero_server not in self.correlated_nodes:
+                    return None
+                parent = self.correlated_incident
+                nodes = sorted(self.correlation_candidates | self.correlated_nodes)
+            if parent is None:
+                parent = self.open_correlated_incident(nodes)
+                if parent is None:
+                    return None
+            with self.lock:
+                self.correlated_incident = parent
+                self.correlated_nodes.add(xero_server)
+        logging.info(f"{xero_server} is part of correlated outage incident {parent}")
+        return parent
+
+    def open_correlated_incident(self, nodes):
+        failing_since = FailureTracker.load_failing_servers()
+        episode = min(failing_since.get(node, time.time()) for node in nodes)
+        external_unique_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{settings.service_now_instance}/outage/{episode}"))
+        local_time_str = datetime.now().time()
+        summary = f"Xero Ticketing/Image Display is failing on {len(nodes)} nodes at {local_time_str}"
+        description = f"{summary}\nAffected nodes: {', '.join(nodes)}\nPlease investigate."
+        urgency, impact = get_urgency_and_impact()
+        parent = self.create_incident(summary, description, settings.configuration_item, external_unique_id, urgency, impact)
+        if parent is not None:
+            logging.info(f"Opened correlated outage incident {parent} for {', '.join(nodes)}")
+        return parent
+
+    def clear_correlation(self, healthy_nodes):
+        with self.lock:
+            self.correlation_candidates.difference_update(healthy_nodes)
+            self.correlated_nodes.difference_update(healthy_nodes)
+            if not self.correlated_nodes:
+                self.correlated_incident = None
+
+    def close(self, timeout=None):
+        with self.lock:
+            retry_thread = self.retry_thread
+            self.retry_thread = None
+        if retry_thread is not None:
+            self.retry_queue.put(None)
+            retry_thread.join(timeout if timeout is not None else settings.service_now_timeout * 3)
+            if retry_thread.is_alive():
+                # the deterministic external id lets the next run pick these up without duplicates
+                logging.error("ServiceNow retries still pending at shutdown")
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+
+
+service_now_client = ServiceNowClient()
+
+
+def create_service_now_incident(summary, description, configuration_item, external_unique_id, urgency, impact, xero_server=None):
+    return service_now_client.create_incident(
+        summary, description, configuration_item, external_unique_id, urgency, impact, xero_server
+    )
+
+
+class ReplayMismatch(Exception):
+    pass
+
+
+# Time patterns in emails and commands, so a replay made at another time of day still matches the recording
+recorded_time_pattern = re.compile(r"\d{1,2}:\d{2}:\d{2}(\.\d+)?")
+
+
+def normalize_recorded(value):
+    return recorded_time_pattern.sub("<time>", json.dumps(value, sort_keys=True))
+
+
+def describe_error(exception):
+    error = {"type": f"{type(exception).__module__}.{type(exception).__qualname__}", "message": str(exception)}
+    if isinstance(exception, requests.exceptions.RequestException):
+        error["outcome"] = request_outcome(exception)
+    return error
+
+
+# Rebuilds a recorded exception, including what request_outcome looks for to tell timeouts and refusals apart
+def replayed_error(error):
+    module_name, _, name = error["type"].rpartition(".")
+    outcome = error.get("outcome")
+    try:
+        error_type = getattr(importlib.import_module(module_name), name)
+        if outcome == "timeout" and not issubclass(error_type, requests.exceptions.Timeout):
+            exception = error_type(urllib3.exceptions.ReadTimeoutError(None, None, error["message"]))
+        else:
+            exception = error_type(error["message"])
+    except Exception:
+        exception = RuntimeError(error["message"])
+    if outcome == "connection_refused":
+        exception.__cause__ = ConnectionRefusedError(error["message"])
+    return exception
+
+
+# Stands in for the time module while a run is replayed: the clocks follow the recording's timeline, which moves
+# forward as recorded interactions are replayed, and sleeps return at once but still move it on by the time slept.
+# Each probe and worker thread keeps its own place on the timeline, so one node's replayed retries don't make another
+# node's requests look slow; a new place starts from the furthest point reached so far.
+class ReplayClock:
+    def __init__(self, real_time, started_at):
+        self.real_time = real_time
+        self.started_at = started_at
+        self.base = real_time.monotonic()
+        self.timeline = contextvars.ContextVar("replay_timeline")
+        self.latest = 0.0
+        self.lock = threading.Lock()
+
+    def new_timeline(self):
+        position = [self.latest]
+        self.timeline.set(position)
+        return position
+
+    def position(self):
+        try:
+            return self.timeline.get()
+        except LookupError:
+            return self.new_timeline()
+
+    def advance_to(self, offset):
+        position = self.position()
+        with self.lock:
+            position[0] = max(position[0], offset)
+            self.latest = max(self.latest, position[0])
+
+    def monotonic(self):
+        return self.base + self.position()[0]
+
+    perf_counter = monotonic
+
+    def time(self):
+        return self.started_at + self.position()[0]
+
+    def sleep(self, seconds):
+        self.advance_to(self.position()[0] + seconds)
+
+    def __getattr__(self, name):
+        return getattr(self.real_time, name)
+
+
+# Captures every outbound interaction of a run (HTTP including ServiceNow, SSH, the cluster DB, reachability checks
+# and emails) and plays them back for `replay`. Interactions are matched by kind and key (e.g. method and URL) in
+# the order they were made for that key, so the order concurrent probes interleave in doesn't matter. Where a key is
+# shared by several nodes (ServiceNow, emails) the request is matched too, so each node gets its own recorded answer.
+class Recorder:
+    body_limit = 65536
+
+    def __init__(self):
+        self.mode = None
+        self.lock = threading.Lock()
+        self.subject = contextvars.ContextVar("recorded_subject", default=None)
+
+    def start_recording(self):
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.interactions = []
+        self.state = snapshot_state()
+        self.history = snapshot_history()
+        self.mode = "record"
+
+    def start_replay(self, recording, clock):
+        self.clock = clock
+        self.pending = collections.defaultdict(collections.deque)
+        for entry in recording["interactions"]:
+            self.pending[(entry["kind"], entry["key"])].append(entry)
+        self.mismatches = []
+        self.mode = "replay"
+
+    def stop(self):
+        self.mode = None
+
+    def add(self, kind, key, start, request=None, **fields):
+        entry = {"kind": kind, "key": key, "at": round(start - self.started, 4),
+                 "seconds": round(time.perf_counter() - start, 4), **fields}
+        if request is not None:
+            entry["request"] = request
+        with self.lock:
+            self.interactions.append(entry)
+        return entry
+
+    # The next recorded interaction for kind and key, after checking the request made now is the recorded one
+    def take(self, kind, key, request=None):
+        with self.lock:
+            pending = self.pending.get((kind, key))
+            if not pending:
+                self.mismatches.append(f"{kind} {key} was not in the recording" + (f": {request!r}" if request else ""))
+                return None
+            entry = pending[0]
+            if request is not None:
+                wanted = normalize_recorded(request)
+                entry = next((recorded for recorded in pending if normalize_recorded(recorded.get("request")) == wanted), None)
+                if entry is None:
+                    entry = pending[0]
+                    self.mismatches.append(f"{kind} {key}: recorded {entry.get('request')!r}, replayed {request!r}")
+            pending.remove(entry)
+        self.clock.advance_to(entry["at"] + entry["seconds"])
+        return entry
+
+    # Calls function, or while replaying returns what it returned (or raises what it raised) in the recording
+    def call(self, kind, key, function, *args, request=None):
+        if self.mode == "replay":
+            entry = self.take(kind, key, request)
+            if entry is None:
+                raise ReplayMismatch(f"{kind} {key} was not in the recording")
+            if "error" in entry:
+                raise replayed_error(entry["error"])
+            return entry.get("result")
+        if self.mode != "record":
+            return function(*args)
+        start = time.perf_counter()
+        try:
+            result = function(*args)
+        except Exception as e:
+            self.add(kind, key, start, request, error=describe_error(e))
+            raise
+        self.add(kind, key, start, request, result=result)
+        return result
+
+    # HTTP requests made inside are recorded and replayed as being for subject, for URLs several nodes share
+    @contextlib.contextmanager
+    def requests_for(self, subject):
+        token = self.subject.set(subject)
+        try:
+            yield
+        finally:
+            self.subject.reset(token)
+
+    def http_request(self):
+        subject = self.subject.get()
+        return None if subject is None else {"for": subject}
+
+    # Something the run sends without needing an answer, like an email: recorded, or checked against the recording
+    def note(self, kind, key, request):
+        if self.mode == "replay":
+            self.take(kind, key, request)
+        elif self.mode == "record":
+            self.add(kind, key, time.perf_counter(), request)
+
+    # The nodes whose probes the recorded run cut off at the end of its probe phase. A replay doesn't probe them and
+    # drops what the recording has of their unfinished probes.
+    def cut_off_probes(self, nodes):
+        with self.lock:
+            cut_off = {node for node in nodes if "probe" in (entry.get("request") for entry in self.pending.get(("deferred", node), ()))}
+            for (kind, key), pending in self.pending.items():
+                if kind == "http" and urllib.parse.urlsplit(key.split(" ", 1)[1]).hostname in cut_off or \
+                        kind == "reachable" and key in cut_off:
+                    pending.clear()
+        return cut_off
+
+    def save(self, path, outcomes):
+        self.mode = None
+        if path is None:
+            if settings.record_failures_only and all(outcome == "healthy" for outcome in outcomes.values()):
+                return
+            os.makedirs(settings.record_dir, exist_ok=True)
+            path = os.path.join(settings.record_dir, f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.jsonl.gz")
+        with gzip.open(path, "wt") as file:
+            file.write(json.dumps({"started_at": self.started_at, "state": self.state, "history": self.history}) + "\n")
+            for entry in self.interactions:
+                if "body" in entry:
+                    body = entry.pop("body")
+                    # large bodies (WADO objects) are replayed as zeros of the recorded size
+                    if entry["size"] <= self.body_limit:
+                        entry["body"] = base64.b64encode(bytes(body)).decode()
+                file.write(json.dumps(entry) + "\n")
+            file.write(json.dumps({"outcomes": outcomes, "disabled": disabled_state()}) + "\n")
+        logging.info(f"Recorded {len(self.interactions)} interactions to {path}")
+
+
+def load_recording(path):
+    with gzip.open(path, "rt") as file:
+        lines = [json.loads(line) for line in file]
+    return {**lines[0], "interactions": lines[1:-1], **lines[-1]}
+
+
+recorder = Recorder()
+
+
+# Passes the body through as it is read and keeps it (up to body_limit) for the recording
+class RecordedBody:
+    def __init__(self, raw, entry, start):
+        self.raw = raw
+        self.entry = entry
+        self.start = start
+
+    def stream(self, amt=65536, decode_content=None):
+        try:
+            for chunk in self.raw.stream(amt, decode_content=decode_content):
+                self.entry["size"] += len(chunk)
+                if self.entry["size"] <= recorder.body_limit:
+                    self.entry["body"] += chunk
+                self.entry["body_seconds"] = round(time.perf_counter() - self.start, 4)
+                yield chunk
+        except (urllib3.exceptions.ReadTimeoutError, urllib3.exceptions.ProtocolError) as e:
+            self.entry["body_error"] = {"type": type(e).__name__, "message": str(e)}
+            self.entry["body_seconds"] = round(time.perf_counter() - self.start, 4)
+            raise
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class RecordingAdapter(requests.adapters.HTTPAdapter):
+    def send(self, request, **kwargs):
+        key = f"{request.method} {request.url}"
+        start = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.exceptions.RequestException as e:
+            recorder.add("http", key, start, recorder.http_request(), error=describe_error(e))
+            raise
+        entry = recorder.add("http", key, start, recorder.http_request(), status=response.status_code, reason=response.reason,
+                             headers=dict(response.headers), size=0, body=bytearray())
+        response.raw = RecordedBody(response.raw, entry, start)
+        return response
+
+
+class ReplayedBody:
+    def __init__(self, entry):
+        self.entry = entry
+
+    def stream(self, amt=65536, decode_content=None):
+        entry = self.entry
+        body = base64.b64decode(entry["body"]) if "body" in entry else bytes(entry["size"])
+        for offset in range(0, len(body), amt):
+            yield body[offset:offset + amt]
+        recorder.clock.advance_to(entry["at"] + entry.get("body_seconds", entry["seconds"]))
+        if "body_error" in entry:
+            error_type = getattr(urllib3.exceptions, entry["body_error"]["type"])
+            if error_type is urllib3.exceptions.ReadTimeoutError:
+                raise error_type(None, None, entry["body_error"]["message"])
+            raise error_type(entry["body_error"]["message"])
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    def send(self, request, **kwargs):
+        entry = recorder.take("http", f"{request.method} {request.url}", recorder.http_request())
+        if entry is None:
+            raise requests.exceptions.ConnectionError(f"{request.method} {request.url} was not in the recording")
+        if "error" in entry:
+            raise replayed_error(entry["error"])
+        response = requests.models.Response()
+        response.status_code = entry["status"]
+        response.reason = entry["reason"]
+        response.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.raw = ReplayedBody(entry)
+        return response
+
+    def close(self):
+        pass
+
+
+def http_adapter(**pool_options):
+    if recorder.mode == "replay":
+        return ReplayAdapter()
+    if recorder.mode == "record":
+        return RecordingAdapter(**pool_options)
+    return requests.adapters.HTTPAdapter(**pool_options)
+
+
+# Pooled keep-alive HTTPS sessions, one per xero node, so retries and later phases reuse the TLS connection
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+
+def get_http_session(xero_server):
+    with http_sessions_lock:
+        session = http_sessions.get(xero_server)
+        if session is None:
+            session = requests.Session()
+            adapter = http_adapter(pool_connections=1, pool_maxsize=2)
+            session.mount("https://", adapter)
+            http_sessions[xero_server] = session
+        return session
+
+
+def close_http_sessions():
+    with http_sessions_lock:
+        for session in http_sessions.values():
+            session.close()
+        http_sessions.clear()
+
+
+def xero_base_url(xero_server):
+    if settings.xero_https_port == 443:
+        return f"https://{xero_server}"
+    return f"https://{xero_server}:{settings.xero_https_port}"
+
+
+# Lightweight tier between full probes in daemon mode: an unauthenticated HEAD over the pooled TLS session,
+# anything short of a 5xx means the web tier is up. No ticket is minted and the Xero domain isn't touched.
+def check_liveness(xero_server):
+    url = f"{xero_base_url(xero_server)}{settings.daemon_liveness_path}"
+    start = time.perf_counter()
+    try:
+        response = get_http_session(xero_server).head(url, verify=False, allow_redirects=False,
+                                                      timeout=settings.daemon_liveness_timeout)
+        outcome = "success" if response.status_code < 500 else "http_error"
+        detail = f"HTTP {response.status_code}"
+    except requests.exceptions.RequestException as e:
+        outcome = request_outcome(e)
+        detail = str(e)
+    duration = time.perf_counter() - start
+    metrics.observe("xero_liveness_seconds", "Latency of the lightweight liveness checks run between full probes",
+                    {"node": xero_server, "outcome": outcome}, duration)
+    if outcome != "success":
+        logging.warning(f"{xero_server} liveness check failed after {duration:.3f}s ({outcome}: {detail})")
+    return outcome == "success"
+
+
+def check_liveness_all(nodes):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(settings.xero_probe_concurrency, len(nodes)),
+                                               thread_name_prefix="liveness") as executor:
+        return dict(zip(nodes, executor.map(
+            lambda node: call_with_log_context({"node": node, "phase": "liveness"}, check_liveness, node), nodes
+        )))
+
+
+# Cheap check for nodes behind an open circuit breaker: can a TCP connection and TLS handshake be completed
+def check_reachable(xero_server):
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    try:
+        with socket.create_connection((xero_server, settings.xero_https_port),
+                                      timeout=settings.xero_breaker_connect_timeout) as sock:
+            with context.wrap_socket(sock, server_hostname=xero_server):
+                return True
+    except (OSError, ssl.SSLError) as e:
+        logging.info(f"{xero_server} is not reachable: {e}")
+        return False
+
+
+def request_xero_ticket(xero_server, attempt, session=None):
+    api_url = f"{xero_base_url(xero_server)}/encodedTicket"
+
+    # URL encode the query constraints and display vars
+    query_constraints_encoded = urllib.parse.quote(settings.query_constraints)
+    display_vars_encoded = urllib.parse.quote(settings.display_vars)
+    # logging.info(query_constraints_encoded)
+    # logging.info(display_vars_encoded)
+    payload = {
+        "user": settings.xero_user,
+        "password": settings.xero_password,
+        "domain": settings.xero_domain,
+        "queryConstraints": query_constraints_encoded,
+        # "initialDisplay": display_vars_encoded,
+        "ticketDuration": "300",
+        "uriEncodedTicket": "true",
+        "ticketUser": "TICKET_TESTING_USER",
+        "ticketRoles": "EprUser",
+    }
+
+    outcome = "http_error"
+    start = time.perf_counter()
+    try:
+        logging.info(f"Testing Ticket Creation for {xero_server}, Attempt {attempt + 1}")
+        response = (session or get_http_session(xero_server)).post(api_url, data=payload, verify=False,
+                                                                    timeout=settings.xero_get_ticket_timeout)
+        # logging.info(f"{xero_server} Ticket Creation Response Status Code: {response.status_code}")  # Print status code for debugging
+        if response.status_code == 200:
+            logging.info(f"{xero_server} created a ticket successfully")
+            # logging.info(response.text)
+            outcome = "success"
+            return response.text, outcome
+        else:
+            logging.info(f"{xero_server} Ticket Creation Failure, Status Code: {response.status_code}")
+    except requests.exceptions.RequestException as e:
+        outcome = request_outcome(e)
+        logging.error(f"An error occurred while attempting to create xero tickets on {xero_server}: {e}")
+    finally:
+        record_probe_attempt(xero_server, "ticket", outcome, time.perf_counter() - start)
+    return None, outcome
+
+
+def request_ticket_verification(xero_server, xero_ticket, attempt, session=None):
+    verification_url = f"{xero_base_url(xero_server)}/?PatientID={settings.validation_study_PatientID}&AccessionNumber={settings.validation_study_AccessionNumber}&theme={settings.xero_theme}&ticket={xero_ticket}"
+
+    outcome = "http_error"
+    start = time.perf_counter()
+    try:
+        logging.info(f"Verifying Ticket for {xero_server}, Attempt {attempt + 1}")
+        response = (session or get_http_session(xero_server)).get(verification_url, verify=False,
+                                                                   timeout=settings.xero_ticket_validation_timeout)
+        # logging.info(f"{xero_server} Verification URL Response Status Code: {response.status_code}")
+        # logging.info(f"Verification URL Response Content: {response.text}")
+
+        if response.status_code == 200:
+            logging.info(f"{xero_server} Ticket verification successful")
+            outcome = "success"
+            return True, outcome
+        else:
+            logging.info(f"{xero_server} Ticket verification failed, Status Code: {response.status_code}")
+    except requests.exceptions.RequestException as e:
+        outcome = request_outcome(e)
+        logging.error(f"An error occurred while attempting to verify the ticket: {e}")
+    finally:
+        record_probe_attempt(xero_server, "verify", outcome, time.perf_counter() - start)
+    return False, outcome
+
+
+# Fetch one object of the validation study over WADO-URI through the ticketed session. The body is streamed in
+# chunks and cut off at xero_wado_max_bytes; the response must start within xero_wado_first_byte_timeout (which is also
+# the longest stall allowed mid-body) and finish within xero_wado_timeout, so a stalled or endless response can't hold
+# a probe slot
+def request_wado_object(xero_server, xero_ticket, object_uid):
+    wado_url = (
+        f"{xero_base_url(xero_server)}{settings.xero_wado_path}?requestType=WADO"
+        f"&studyUID={settings.xero_wado_study_uid}&seriesUID={settings.xero_wado_series_uid}&objectUID={object_uid}"
+        f"&contentType={urllib.parse.quote(settings.xero_wado_content_type)}&ticket={xero_ticket}"
+    )
+    frame = {"bytes": 0, "first_byte": None, "seconds": None, "outcome": "http_error"}
+    start = time.perf_counter()
+    deadline = start + settings.xero_wado_timeout
+    try:
+        with get_http_session(xero_server).get(wado_url, verify=False, stream=True,
+                                               timeout=settings.xero_wado_first_byte_timeout) as response:
+            # the response line and headers are the first bytes back, the body is read as it streams in
+            frame["first_byte"] = time.perf_counter() - start
+            if response.status_code != 200:
+                logging.info(f"{xero_server} WADO retrieval of {object_uid} failed, Status Code: {response.status_code}")
+                return frame
+            for chunk in response.iter_content(chunk_size=65536):
+                frame["bytes"] += len(chunk)
+                if frame["bytes"] >= settings.xero_wado_max_bytes:
+                    break
+                if time.perf_counter() > deadline:
+                    frame["outcome"] = "deadline"
+                    logging.info(f"{xero_server} WADO retrieval of {object_uid} exceeded {settings.xero_wado_timeout}s")
+                    return frame
+            frame["outcome"] = "success"
+    except requests.exceptions.RequestException as e:
+        frame["outcome"] = request_outcome(e)
+        logging.error(f"An error occurred while retrieving WADO object {object_uid} from {xero_server}: {e}")
+    finally:
+        frame["seconds"] = time.perf_counter() - start
+        if frame["first_byte"] is not None:
+            metrics.observe("xero_wado_first_byte_seconds", "Time to the first byte of WADO object bodies",
+                            {"node": xero_server}, frame["first_byte"])
+        metrics.observe("xero_wado_transfer_seconds", "Duration of WADO object retrievals",
+                        {"node": xero_server, "outcome": frame["outcome"]}, frame["seconds"])
+    return frame
+
+
+# Retrieve every configured WADO object and decide whether image retrieval on the node is degraded:
+# any failed or cut-off retrieval, or throughput below xero_wado_min_throughput KB/s
+def probe_wado(xero_server, xero_ticket):
+    frames = [request_wado_object(xero_server, xero_ticket, object_uid) for object_uid in settings.xero_wado_object_uids]
+    total_bytes = sum(frame["bytes"] for frame in frames)
+    total_seconds = sum(frame["seconds"] for frame in frames)
+    failed = [frame for frame in frames if frame["outcome"] != "success"]
+    wado = {
+        "frames": len(frames),
+        "bytes": total_bytes,
+        "seconds": total_seconds,
+        "first_byte": max((frame["first_byte"] for frame in frames if frame["first_byte"] is not None), default=None),
+        "throughput": total_bytes / total_seconds if total_seconds else 0.0,
+        "outcome": failed[0]["outcome"] if failed else "success",
+        "degraded_reason": None,
+    }
+    if failed:
+        wado["degraded_reason"] = f"{len(failed)}/{len(frames)} WADO retrievals failed ({wado['outcome']})"
+    elif wado["throughput"] < settings.xero_wado_min_throughput * 1024:
+        wado["degraded_reason"] = (
+            f"WADO throughput {wado['throughput'] / 1024:.0f} KB/s below {settings.xero_wado_min_throughput} KB/s"
+        )
+    metrics.set("xero_wado_throughput_bytes_per_second", "Throughput of the last WADO probe",
+                {"node": xero_server}, round(wado["throughput"]))
+    return wado
+
+
+# Async probe engine: runs the encodedTicket -> verification chain for every node at once.
+# Blocking HTTP calls run on a bounded executor and the semaphore is only held while a request
+# is in flight, so nodes waiting out a retry delay don't hold a probe slot.
+async def probe_node_async(xero_server, semaphore, executor, retry_amount=None):
+    if retry_amount is None:
+        retry_amount = settings.xero_retry_attempts
+    loop = asyncio.get_running_loop()
+    result = {
+        "node": xero_server,
+        "probe_id": uuid.uuid4().hex[:12],
+        "healthy": False,
+        "degraded": False,
+        "ticket_attempts": 0,
+        "verify_attempts": 0,
+        "wado": None,
+        "breaker": None,
+        "reachable": None,
+        "timings": {"ticket": None, "verify": None, "wado": None, "total": None},
+    }
+    if recorder.mode == "replay":
+        recorder.clock.new_timeline()
+    probe_start = time.perf_counter()
+    # each probe runs in its own task, so this only tags this probe's records
+    log_fields.set({"cluster": cluster_for_node(xero_server).name, "node": xero_server, "probe_id": result["probe_id"]})
+
+    # executor threads don't inherit the task's context, it goes along with each call with the phase and attempt added
+    def in_executor(phase, attempt, function, *args):
+        fields = {"phase": phase}
+        if attempt is not None:
+            fields["attempt"] = attempt + 1
+        context = contextvars.copy_context()
+        return loop.run_in_executor(executor, context.run, functools.partial(call_with_log_context, fields, function, *args))
+
+    result["breaker"] = CircuitBreaker.state(xero_server)
+    if result["breaker"] == "open":
+        async with semaphore:
+            result["reachable"] = await in_executor(
+                "reachability", None, recorder.call, "reachable", xero_server, check_reachable, xero_server
+            )
+        if not result["reachable"] or not CircuitBreaker.full_probe_due(xero_server, time.time()):
+            result["timings"]["total"] = time.perf_counter() - probe_start
+            return result
+        logging.info(f"{xero_server} circuit breaker is open, running its scheduled full probe")
+        result["breaker"] = "half_open"
+
+    xero_ticket = None
+    for attempt in range(retry_amount):
+        result["ticket_attempts"] = attempt + 1
+        async with semaphore:
+            xero_ticket, outcome = await in_executor("ticket", attempt, request_xero_ticket, xero_server, attempt)
+        if xero_ticket:
+            break
+        if attempt + 1 < retry_amount:
+            await asyncio.sleep(retry_delay(outcome, attempt))
+    result["timings"]["ticket"] = time.perf_counter() - probe_start
+
+    if not xero_ticket:
+        logging.error(f"Failed to create xero ticket on {xero_server} after {retry_amount} attempts")
+        result["timings"]["total"] = time.perf_counter() - probe_start
+        return result
+
+    verify_start = time.perf_counter()
+    for attempt in range(retry_amount):
+        result["verify_attempts"] = attempt + 1
+        async with semaphore:
+            verified, outcome = await in_executor(
+                "verify", attempt, request_ticket_verification, xero_server, xero_ticket, attempt
+            )
+        if verified:
+            result["healthy"] = True
+            break
+        if attempt + 1 < retry_amount:
+            await asyncio.sleep(retry_delay(outcome, attempt))
+    result["timings"]["verify"] = time.perf_counter() - verify_start
+
+    if not result["healthy"]:
+        logging.error(f"Failed to verify xero ticket on {xero_server} after {retry_amount} attempts")
+    elif settings.xero_wado:
+        # a node that verifies tickets can still be too slow to serve the images themselves
+        wado_start = time.perf_counter()
+        async with semaphore:
+            result["wado"] = await in_executor("wado", None, probe_wado, xero_server, xero_ticket)
+        result["degraded"] = result["wado"]["degraded_reason"] is not None
+        result["timings"]["wado"] = time.perf_counter() - wado_start
+    result["timings"]["total"] = time.perf_counter() - probe_start
+    return result
+
+
+# Each cluster has its own probe slots (xero_probe_concurrency, or concurrency for every cluster) so a slow
+# cluster can't hold the slots the others need; the worker threads are shared
+# Probes still running when the run's probe phase is over are cancelled and left out of the results.
+async def probe_all_nodes_async(nodes, concurrency=None):
+    if not nodes:
+        return {}
+    semaphores = {cluster.name: asyncio.Semaphore(concurrency or cluster.xero_probe_concurrency) for cluster in clusters}
+    max_workers = sum(concurrency or cluster.xero_probe_concurrency for cluster in clusters)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="probe")
+    pending = set()
+    cut_off = recorder.cut_off_probes(nodes) if recorder.mode == "replay" else set()
+    try:
+        tasks = {
+            node: asyncio.ensure_future(probe_node_async(node, semaphores[cluster_for_node(node).name], executor))
+            for node in nodes if node not in cut_off
+        }
+        remaining = run_budget.phase_remaining()
+        if tasks:
+            _, pending = await asyncio.wait(tasks.values(), timeout=None if remaining == math.inf else max(0.0, remaining))
+        # a node whose probe the last run cut off is waited for this time
+        overdue = {tasks[node] for node in run_budget.overdue if node in tasks} & pending
+        if overdue:
+            await asyncio.wait(overdue)
+            pending -= overdue
+        for task in pending:
+            task.cancel()
+    finally:
+        # a cancelled probe's request is left to time out on its own rather than holding up the run
+        executor.shutdown(wait=not pending, cancel_futures=True)
+    results = {}
+    for node in cut_off:
+        run_budget.defer(node, "probe", "it did not finish within the probe phase")
+    for node, task in tasks.items():
+        if task in pending:
+            run_budget.defer(node, "probe", "it did not finish within the probe phase")
+        else:
+            results[node] = task.result()
+    return results
+
+
+def probe_all_nodes(nodes, concurrency=None):
+    probe_results = asyncio.run(probe_all_nodes_async(nodes, concurrency))
+    for node, result in probe_results.items():
+        timings = result["timings"]
+        if result["breaker"] == "open":
+            status_board.record_probe(node, result)
+            metrics.inc("xero_reachability_checks", "Reachability checks of nodes behind an open circuit breaker",
+                        {"node": node, "outcome": "success" if result["reachable"] else "failure"})
+            logging.info(
+                f"{node} is disabled, reachability check {'passed' if result['reachable'] else 'failed'} "
+                f"in {timings['total']:.3f}s, full probe skipped"
+            )
+            continue
+        outcome = "success" if result["healthy"] else "failure"
+        metrics.observe("xero_probe_seconds", "Duration of the full ticket + verification probe, retries included",
+                        {"node": node, "outcome": outcome}, timings["total"])
+        metrics.inc("xero_probes", "Completed probes by outcome", {"node": node, "outcome": outcome})
+        metrics.set("xero_node_healthy", "1 if the node passed its last probe", {"node": node}, int(result["healthy"]))
+        if result["wado"] is not None:
+            metrics.set("xero_node_degraded", "1 if the node verifies tickets but failed its last WADO probe",
+                        {"node": node}, int(result["degraded"]))
+        verify_timing = f"{timings['verify']:.3f}s" if timings["verify"] is not None else "n/a"
+        wado_timing = f", wado {describe_wado(result['wado'])}" if result["wado"] is not None else ""
+        logging.info(
+            f"{node} probe {'passed' if result['healthy'] else 'failed'}: "
+            f"ticket {timings['ticket']:.3f}s ({result['ticket_attempts']} attempts), "
+            f"verify {verify_timing} ({result['verify_attempts']} attempts){wado_timing}, total {timings['total']:.3f}s"
+        )
+        if result["degraded"]:
+            logging.warning(f"{node} is degraded: {result['wado']['degraded_reason']}")
+        status_board.record_probe(node, result)
+        try:
+            probe_history.append(node, result)
+        except OSError as e:
+            logging.error(f"Unable to record probe history for {node}: {e}")
+    return probe_results
+
+
+# Cluster DB session pool for each cluster, shared by every thread and kept across daemon cycles
+def get_cluster_db_pool(cluster):
+    import cx_Oracle
+    with cluster.db_pool_lock:
+        if cluster.db_pool is None:
+            # Oracle database connection details
+            dsn = cx_Oracle.makedsn(cluster.cluster_db_host, cluster.cluster_db_port, service_name=cluster.cluster_db_service_name)
+            cluster.db_pool = cx_Oracle.SessionPool(
+                user=cluster.cluster_db_user, password=cluster.cluster_db_password, dsn=dsn,
+                min=1, max=cluster.cluster_db_pool_max, increment=1, threaded=True,
+                getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT,
+            )
+        return cluster.db_pool
+
+
+def close_cluster_db_pool():
+    for cluster in clusters:
+        with cluster.db_pool_lock:
+            if cluster.db_pool is not None:
+                import cx_Oracle
+                try:
+                    cluster.db_pool.close()
+                except cx_Oracle.DatabaseError as e:
+                    logging.error(f"Error closing the {cluster.name} cluster DB pool: {e}")
+                cluster.db_pool = None
+
+
+# Install stage of every node in a cluster, fetched in one query and shared by all of the cluster's failing nodes
+# for upgrade_status_ttl seconds
+def fetch_upgrade_status(cluster):
+    return recorder.call("db", cluster.name, query_upgrade_status, cluster)
+
+
+# Runs the installer_node query for the cluster, giving up after timeout seconds (math.inf waits) so an unreachable
+# cluster DB can't hold up the run (the daemon thread is left to finish on its own)
+def fetch_upgrade_status_within(cluster, timeout):
+    answers = queue.Queue()
+
+    def run():
+        try:
+            answers.put((fetch_upgrade_status(cluster), None))
+        except Exception as e:
+            answers.put((None, e))
+    # the thread shares the caller's context, so a replay moves the caller's clock on by the query's recorded time
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), name=f"upgrade-status-{cluster.name}", daemon=True).start()
+    try:
+        upgrade_status, error = answers.get(timeout=None if timeout == math.inf else timeout)
+    except queue.Empty:
+        raise TimeoutError(f"no answer from the cluster DB after {timeout:.0f}s")
+    if error is not None:
+        raise error
+    return upgrade_status
+
+
+def query_upgrade_status(cluster):
+    query = """
+    select inode.id "Cluster node", t.installstage "Installation Stage", t.uninstalled "Uninstalled"
+    from installer_node inode,
+    xmltable('/installStatus' 
+        passing xmltype(inode.status) 
+        columns 
+            installstage varchar2(64) path 'stage',
+            uninstalled varchar2(64) path 'uninstall'
+        ) t
+    """
+
+    pool = get_cluster_db_pool(cluster)
+    connection = pool.acquire()
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(query)
+            return {
+                node_id: {"stage": install_stage, "uninstalled": uninstalled}
+                for node_id, install_stage, uninstalled in cursor
+            }
+        finally:
+            cursor.close()
+    finally:
+        pool.release(connection)
+
+
+def get_upgrade_status_snapshot(cluster, timeout=math.inf):
+    upgrade_status_snapshot = cluster.upgrade_status_snapshot
+    # Holding the lock through the fetch means a burst of failing nodes waits on a single query
+    with cluster.upgrade_status_lock:
+        fetched_at = upgrade_status_snapshot["fetched_at"]
+        if fetched_at is not None and time.monotonic() - fetched_at < settings.upgrade_status_ttl:
+            return upgrade_status_snapshot["nodes"]
+
+        import cx_Oracle
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            nodes = fetch_upgrade_status_within(cluster, timeout)
+            outcome = "success"
+            logging.info(f"Fetched upgrade status for {len(nodes)} {cluster.name} cluster nodes")
+        except cx_Oracle.DatabaseError as e:
+            # Specifically catch Oracle-related errors, the failure is cached too so an outage isn't retried per node
+            logging.error(f"Database error occurred: {e}; continuing with restarts...")
+            nodes = None
+        except TimeoutError as e:
+            # the run's time for the node ran out first
+            logging.error(f"Upgrade status query failed: {e}; continuing with restarts...")
+            nodes = None
+        except Exception as e:
+            # Catch ANY other exception
+            logging.error(f"An unexpected error occurred: {e}")
+            nodes = None
+
+        metrics.observe("xero_upgrade_status_query_seconds", "Duration of the cluster DB install stage query",
+                        {"cluster": cluster.name, "outcome": outcome}, time.perf_counter() - start)
+        upgrade_status_snapshot["fetched_at"] = time.monotonic()
+        upgrade_status_snapshot["nodes"] = nodes
+        return nodes
+
+
+# cluster node ids carry the domain, match on the node name prefix like the old per-node query did
+def installer_entries(upgrade_status, xero_server):
+    return [
+        (node_id, status) for node_id, status in upgrade_status.items()
+        if node_id and node_id.upper().startswith(xero_server.upper())
+    ]
+
+
+#  check for upgrade pending/inprogress
+def check_for_upgrade(xero_server):
+    upgrade_status = get_upgrade_status_snapshot(cluster_for_node(xero_server), run_budget.bounded(xero_server, math.inf))
+    if upgrade_status is None:
+        return False
+
+    result = [
+        (status["stage"], node_id) for node_id, status in installer_entries(upgrade_status, xero_server)
+        if status["uninstalled"] == 'false' and status["stage"] == 'PREPARE'
+    ]
+    logging.info(f"upgrade check for {xero_server} result is:{result or None}")
+    return bool(result)
+
+
+node_inventory_store = LazyStateStore("node_inventory", "node_inventory_file")
+
+
+# Discovery gives up on the cluster DB after xero_discovery_timeout seconds
+def fetch_inventory(cluster):
+    return fetch_upgrade_status_within(cluster, settings.xero_discovery_timeout)
+
+
+# A discovered node id is used as the hostname for probes, restarts and disables, so one that doesn't
+# resolve is left out rather than failed, restarted and disabled every run
+def resolves(node_id):
+    try:
+        socket.getaddrinfo(node_id, None)
+    except (socket.gaierror, UnicodeError) as e:
+        logging.warning(f"Discovered node {node_id} does not resolve, leaving it out: {e}")
+        return False
+    return True
+
+
+# With xero_discover_nodes, a cluster's nodes are the installed nodes in its cluster DB matching
+# xero_discover_pattern that resolve. The list is cached in node_inventory_file and only queried again every
+# xero_inventory_refresh seconds; when the query fails the last known list is used, or xero_nodes if there is none.
+def refresh_inventory(cluster, now=None):
+    if not cluster.xero_discover_nodes:
+        return False
+    now = now or time.time()
+    entry = node_inventory_store.get(cluster.name)
+    if entry is None or now - entry["refreshed_at"] >= settings.xero_inventory_refresh:
+        try:
+            upgrade_status = fetch_inventory(cluster)
+        except Exception as e:
+            # a timeout, an Oracle error or anything else, the run goes on with the last known list
+            logging.error(f"Unable to discover the {cluster.name} cluster nodes: {e}")
+            metrics.inc("xero_inventory_refresh_failures", "Failed node discovery queries", {"cluster": cluster.name})
+        else:
+            nodes = sorted(
+                node_id.lower() for node_id, status in upgrade_status.items()
+                if node_id and status["uninstalled"] != 'true' and cluster.xero_discover_pattern.search(node_id)
+                and resolves(node_id.lower())
+            )
+            entry = {"refreshed_at": now, "nodes": nodes,
+                     "stages": {node_id.lower(): status["stage"] for node_id, status in upgrade_status.items() if node_id}}
+            node_inventory_store.update(lambda clusters: clusters.__setitem__(cluster.name, entry))
+            # the same query answers the upgrade check, so a failing node doesn't query it again straight away
+            with cluster.upgrade_status_lock:
+                cluster.upgrade_status_snapshot.update(fetched_at=time.monotonic(), nodes=upgrade_status)
+
+    if entry is None:
+        logging.warning(f"No node inventory for the {cluster.name} cluster yet, using xero_nodes")
+        nodes = cluster.xero_nodes
+    else:
+        nodes = entry["nodes"]
+        metrics.set("xero_inventory_age_seconds", "Age of the cached node inventory", {"cluster": cluster.name},
+                    round(now - entry["refreshed_at"]))
+    metrics.set("xero_inventory_nodes", "Nodes monitored in each cluster", {"cluster": cluster.name}, len(nodes))
+    if nodes == cluster.nodes:
+        return False
+    added, retired = set(nodes) - set(cluster.nodes), set(cluster.nodes) - set(nodes)
+    if added:
+        logging.info(f"{cluster.name} cluster node added: {', '.join(sorted(added))}")
+    if retired:
+        logging.info(f"{cluster.name} cluster node no longer listed: {', '.join(sorted(retired))}")
+    cluster.nodes = nodes
+    return True
+
+
+# Returns True if any cluster's node list changed
+def refresh_inventories():
+    now = time.time()
+    return any([refresh_inventory(cluster, now) for cluster in clusters])
+
+
+def restart_xero_services(xero_server):
+    try:
+        commands = [
+            (settings.xero_haproxy_restart_command, "HAProxy"),
+            (settings.xero_restart_command, "JBoss")
+        ]
+        logging.info(f"Attempting to restart {', '.join(name for _, name in commands)} on {xero_server}")
+        # both restarts run back to back over one SSH connection
+        results = execute_remote_commands(
+            xero_server, settings.xero_server_user, settings.xero_server_private_key, [command for command, _ in commands]
+        )
+        if results is None:
+            logging.error(f"Unable to run restart commands on {xero_server}")
+            return None
+        for (command, service_name), result in zip(commands, results):
+            if result['timed_out']:
+                logging.error(f"{service_name} restart timed out on {xero_server}: {result}")
+            else:
+                logging.info(f"{service_name} restarted successfully on {xero_server}: {result}")
+    except Exception as e:
+        logging.error(f"Error restarting services on Xero server ({xero_server}): {e}")
+        create_and_send_failure_incident(xero_server, "Unable to connect to server")
+        return None
+
+
+def disable_xero_server(xero_server):
+    local_time_str = datetime.now().time()
+    try:
+        logging.info(f"attempting to disable xero services on {xero_server}")
+        result = execute_remote_command(
+            xero_server,
+            settings.xero_server_user,
+            settings.xero_server_private_key,
+            settings.xero_disable_command,
+        )
+    except Exception as e:
+        logging.error(f"Error Disabling Xero server ({xero_server}): {e}")
+        subject = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} (Unable to connect to server) (Ticket Creation Failure))"
+        body = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} (Unable to connect to server)\nPlease investigate"
+        incident_summary = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} (Unable to connect to server)"
+        incident_description = body
+        external_unique_id = incident_external_id(xero_server)
+        urgency, impact = get_urgency_and_impact()
+        incident_number = create_service_now_incident(
+            incident_summary, incident_description,
+            settings.configuration_item, external_unique_id,
+            urgency, impact, xero_server
+        )
+        if incident_number:
+            logging.info(incident_number)
+            subject = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} (Unable to connect to server) {incident_number}"
+            DisabledServerManager.save_disabled_server(xero_server, incident_number)
+        else:
+            DisabledServerManager.save_disabled_server(xero_server, "Ticket Creation Failed")
+        if settings.use_memes:
+            meme_data = generate_meme(settings.unsuccessful_restart_meme_path, "ONE DOES NOT SIMPLY",f"DISABLE XERO SERVICES ON {xero_server}")
+            send_email(settings.smtp_recipients, subject, body, xero_server, meme_data)
+        else:
+            send_email(settings.smtp_recipients, subject, body, xero_server)
+    else:
+        logging.info(f"Xero server Disabling successfully: {result}")
+        subject = f"Xero Ticketing/Image Display has been Disabled on {xero_server} at {local_time_str}"
+        body = f"Xero Ticketing/Image Display has been Disabled on {xero_server} at {local_time_str}\nTo enable the server run the following command on the xero server: sudo agility-haproxy restart"
+        #body = f"Xero Ticketing/Image Display has been Disabled on {xero_server} at {local_time_str}\nTo manually purge cache run the following command: sudo /bin/nice -n +15 /bin/find /wado2cache* -mmin +240 -delete \nTo enable the server run the following command on the xero server: sudo agility-haproxy start"
+        incident_summary = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} (Server Disabled)"
+        incident_description = body
+        external_unique_id = incident_external_id(xero_server)
+        urgency, impact = get_urgency_and_impact()
+        incident_number = create_service_now_incident(
+            incident_summary, incident_description,
+            settings.configuration_item, external_unique_id,
+            urgency, impact, xero_server
+        )
+        if incident_number:
+            logging.info(incident_number)
+            subject = f"Xero Ticketing/Image Display has been Disabled on {xero_server} at {local_time_str} {incident_number}"
+            DisabledServerManager.save_disabled_server(xero_server,incident_number)
+        else:
+            DisabledServerManager.save_disabled_server(xero_server, "Ticket Creation Failed")
+        if settings.use_memes:
+            meme_data = generate_meme(settings.unsuccessful_restart_meme_path, "ONE DOES NOT SIMPLY",f"RESTART XERO SERVICES ON {xero_server}")
+            send_email(settings.smtp_recipients, subject, body, xero_server, meme_data)
+        else:
+            send_email(settings.smtp_recipients, subject, body, xero_server)
+    return None  # Return the result or another suitable value
+
+
+# Persistent SSH connections, one per host/user, reused across commands and daemon cycles
+ssh_clients = {}
+ssh_clients_lock = threading.Lock()
+ssh_connect_locks = {}
+
+
+# Returns the client and whether it is a pooled connection that was already open
+def get_ssh_client(hostname, username, private_key_path):
+    key = (hostname, username)
+    with ssh_clients_lock:
+        connect_lock = ssh_connect_locks.setdefault(key, threading.Lock())
+
+    # only one thread connects to a given host at a time, the others reuse its connection
+    with connect_lock:
+        with ssh_clients_lock:
+            ssh = ssh_clients.get(key)
+        if ssh is not None:
+            transport = ssh.get_transport()
+            if transport is not None and transport.is_active():
+                return ssh, True
+            ssh.close()
+
+        import paramiko
+        ssh = paramiko.SSHClient()
+        ssh.load_system_host_keys()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(
+            hostname, port=settings.xero_ssh_port, username=username, key_filename=private_key_path,
+            timeout=settings.xero_ssh_connect_timeout, banner_timeout=settings.xero_ssh_connect_timeout,
+            auth_timeout=settings.xero_ssh_connect_timeout,
+        )
+        ssh.get_transport().set_keepalive(30)
+        with ssh_clients_lock:
+            ssh_clients[key] = ssh
+        return ssh, False
+
+
+def discard_ssh_client(hostname, username):
+    with ssh_clients_lock:
+        ssh = ssh_clients.pop((hostname, username), None)
+    if ssh is not None:
+        ssh.close()
+
+
+def close_ssh_clients():
+    with ssh_clients_lock:
+        clients = list(ssh_clients.values())
+        ssh_clients.clear()
+    for ssh in clients:
+        ssh.close()
+
+
+# Run one command on its own channel, draining stdout/stderr as it arrives so a chatty or hung command can't block forever
+def run_channel_command(ssh, command, timeout):
+    channel = ssh.get_transport().open_session(timeout=settings.xero_ssh_connect_timeout)
+    output, error = [], []
+    timed_out = False
+    deadline = time.monotonic() + timeout
+    try:
+        channel.exec_command(command)
+        while True:
+            received = False
+            if channel.recv_ready():
+                output.append(channel.recv(32768))
+                received = True
+            if channel.recv_stderr_ready():
+                error.append(channel.recv_stderr(32768))
+                received = True
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+            if time.monotonic() > deadline:
+                timed_out = True
+                break
+            if not received:
+                sleep(0.05)
+        exit_status = None if timed_out else channel.recv_exit_status()
+    finally:
+        channel.close()
+
+    return {
+        'output': b"".join(output).decode(errors="replace"),
+        'error': b"".join(error).decode(errors="replace"),
+        'exit_status': exit_status,
+        'timed_out': timed_out,
+    }
+
+
+def execute_remote_commands(hostname, username, private_key_path, commands, timeout=None):
+    return recorder.call("ssh", hostname, run_remote_commands, hostname, username, private_key_path, commands, timeout,
+                         request=list(commands))
+
+
+def run_remote_commands(hostname, username, private_key_path, commands, timeout):
+    import paramiko
+    # a command gets no longer than the run has left for the node, but at least the time to connect
+    timeout = run_budget.bounded(hostname, timeout or settings.xero_ssh_command_timeout, settings.xero_ssh_connect_timeout)
+    results = []
+    try:
+        while True:
+            ssh, pooled = get_ssh_client(hostname, username, private_key_path)
+            try:
+                for command in commands[len(results):]:
+                    start = time.perf_counter()
+                    result = run_channel_command(ssh, command, timeout)
+                    if result['timed_out']:
+                        logging.error(f"Remote command on {hostname} timed out after {timeout:.0f}s: {command}")
+                    outcome = "timeout" if result['timed_out'] else "success" if result['exit_status'] == 0 else "nonzero_exit"
+                    metrics.observe("xero_ssh_command_seconds", "Duration of remote commands",
+                                    {"node": hostname, "outcome": outcome}, time.perf_counter() - start)
+                    results.append(result)
+                return results
+            except (paramiko.SSHException, EOFError, OSError) as e:
+                # a pooled connection may have been dropped by the server, reconnect once; a connection made
+                # just now that fails isn't retried, an unreachable host would cost two connect timeouts
+                discard_ssh_client(hostname, username)
+                if not pooled:
+                    raise
+                logging.info(f"SSH connection to {hostname} was lost ({e}), reconnecting")
+    except Exception as e:
+        logging.error(f"Error executing remote command: {e}")
+        metrics.inc("xero_ssh_failures", "Remote command batches that could not connect or run", {"node": hostname})
+        discard_ssh_client(hostname, username)
+        return None
+
+
+def execute_remote_command(hostname, username, private_key_path, command):
+    results = execute_remote_commands(hostname, username, private_key_path, [command])
+    return results[0] if results else None
+
+
+def notify_failed_server_pending_upgrade(xero_server):
+    local_time_str = datetime.now().time()
+    subject = f"Xero Ticketing/Image Display Failing on {xero_server} at {local_time_str} (Server in PREPARE Status)"
+    body = f"Xero Ticketing/Image Display Failing on {xero_server} at {local_time_str} (Server in PREPARE Status)\n The server will has been placed on the disabled servers lists, and will be removed automacailly after the upgrade is complete and ticketing is validated."
+    send_email(settings.smtp_recipients, subject, body, xero_server)
+    DisabledServerManager.save_disabled_server(xero_server, "PREPARE")
+    return
+
+
+def describe_wado(wado):
+    first_byte = f"{wado['first_byte']:.2f}s" if wado["first_byte"] is not None else "n/a"
+    return (
+        f"{wado['frames']} frames, {wado['bytes'] / 1024:.0f} KB in {wado['seconds']:.2f}s "
+        f"({wado['throughput'] / 1024:.0f} KB/s), first byte {first_byte}"
+    )
+
+
+def notify_wado_degraded(xero_server, wado):
+    local_time_str = datetime.now().time()
+    subject = f"Xero Image Display is degraded on {xero_server} at {local_time_str} ({wado['degraded_reason']})"
+    body = (
+        f"Xero Ticketing is working on {xero_server} but image retrieval over WADO is degraded at {local_time_str}: "
+        f"{wado['degraded_reason']}\nLast probe: {describe_wado(wado)}\n"
+        f"The server has been left in the load balancer rotation. Please investigate."
+    )
+    send_email(settings.smtp_recipients, subject, body, xero_server)
+
+
+def notify_wado_recovered(xero_server, wado):
+    local_time_str = datetime.now().time()
+    subject = f"Xero Image Display has recovered on {xero_server} at {local_time_str}"
+    body = f"Xero image retrieval over WADO has recovered on {xero_server} at {local_time_str}\nLast probe: {describe_wado(wado)}"
+    send_email(settings.smtp_recipients, subject, body, xero_server)
+
+restart_times_store = LazyStateStore("restart_times", "restart_times_file")
+
+
+# Deadline for a node to come back after a restart, learned from how long its previous restarts took
+def readiness_deadline(xero_server):
+    history = restart_times_store.get(xero_server) or []
+    if not history:
+        return settings.xero_ready_max_deadline
+    learned = max(history) * 1.5 + settings.xero_ready_initial_delay
+    return min(settings.xero_ready_max_deadline, max(settings.xero_ready_min_deadline, learned))
+
+
+# The time a restart is expected to need, for the run budget. A node with no restart history would get the full
+# xero_ready_max_deadline, which a short run deadline never fits, so it is budgeted the minimum; if it doesn't
+# pass in time its retest is deferred to the next run, which waits for it.
+def restart_estimate(xero_server):
+    if not restart_times_store.get(xero_server):
+        return settings.xero_ready_initial_delay + settings.xero_ready_min_deadline
+    return readiness_deadline(xero_server)
+
+
+def record_restart_time(xero_server, seconds):
+    def record(servers):
+        # keep the last 10 restart-to-healthy times per node
+        servers[xero_server] = (servers.get(xero_server, []) + [round(seconds, 1)])[-10:]
+    restart_times_store.update(record)
+
+
+# Poll a restarted node until it passes a full ticket + verification round trip or its deadline passes.
+# Connection refused means JBoss/HAProxy isn't listening yet, so it is retried on a short fixed interval;
+# 5xx responses and timeouts mean the service is up but unhealthy, so those back off exponentially with jitter.
+def wait_for_node_ready(xero_server, action="restart"):
+    ready_start = time.monotonic()
+    # only restarts have a learned deadline, a lighter action like a cache purge gets the minimum
+    deadline_seconds = readiness_deadline(xero_server) if action == "restart" else settings.xero_ready_min_deadline
+    # the run's time running out first leaves the node undecided (None) rather than failed
+    deadline = ready_start + min(deadline_seconds, run_budget.phase_remaining(xero_server))
+    logging.info(f"Waiting up to {deadline_seconds:.0f}s for {xero_server} to pass ticket verification")
+    sleep(settings.xero_ready_initial_delay)
+
+    delay = 2.0
+    attempt = 0
+    while True:
+        xero_ticket, outcome = request_xero_ticket(xero_server, attempt)
+        if xero_ticket:
+            verified, outcome = request_ticket_verification(xero_server, xero_ticket, attempt)
+            if verified:
+                elapsed = time.monotonic() - ready_start
+                logging.info(f"{xero_server} ready {elapsed:.1f}s after {action} ({attempt + 1} checks)")
+                if action == "restart":
+                    record_restart_time(xero_server, elapsed)
+                return True
+
+        attempt += 1
+        # the time left decides how many checks are made, so a replay takes it from the recording rather than from
+        # its own clock, which doesn't keep the recorded gaps between checks
+        remaining, cut_short = recorder.call(
+            "ready", xero_server, lambda: (deadline - time.monotonic(), deadline < ready_start + deadline_seconds)
+        )
+        if remaining <= 0:
+            if cut_short:
+                logging.info(f"{xero_server} not ready yet when the run's time ran out ({attempt} checks, last: {outcome})")
+                return None
+            logging.info(f"{xero_server} not ready after {deadline_seconds:.0f}s ({attempt} checks, last: {outcome})")
+            return False
+        if outcome == "connection_refused":
+            wait = 2.0
+        else:
+            wait = delay * random.uniform(0.5, 1.0)
+            delay = min(delay * 2, 30.0)
+        sleep(min(wait, remaining))
+
+
+wado_cache_store = LazyStateStore("wado_cache", "wado_cache_file")
+
+
+# Each line of the usage command output is "<cache path> <volume bytes> <used bytes> <file count>"; the df-only
+# command leaves out the file count
+def parse_wado_cache_usage(output):
+    volumes = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) not in (3, 4):
+            continue
+        try:
+            total, used, *files = (int(field) for field in fields[1:])
+        except ValueError:
+            continue
+        volumes.append({"path": fields[0], "total": total, "used": used, "files": files[0] if files else None})
+    return volumes
+
+
+# quick runs the df-only command, for the restart path where a file count isn't worth a find over the cache
+def collect_wado_cache_usage(xero_server, quick=False):
+    command = settings.xero_wado_cache_df_command if quick else settings.xero_wado_cache_usage_command
+    result = execute_remote_command(xero_server, settings.xero_server_user, settings.xero_server_private_key, command)
+    volumes = parse_wado_cache_usage(result['output']) if result else []
+    if not volumes:
+        logging.error(f"Unable to read WADO cache usage on {xero_server}: {result}")
+        return None
+    counted = all(volume["files"] is not None for volume in volumes)
+    usage = {
+        "checked_at": time.time(),
+        "volumes": volumes,
+        # volumes that report no size (not mounted) don't count
+        "used_percent": max((volume["used"] * 100 / volume["total"] for volume in volumes if volume["total"]), default=0),
+        "files": sum(volume["files"] for volume in volumes) if counted else None,
+    }
+    for volume in volumes:
+        labels = {"node": xero_server, "volume": volume["path"]}
+        metrics.set("xero_wado_cache_used_bytes", "Used bytes on each WADO cache volume", labels, volume["used"])
+        metrics.set("xero_wado_cache_size_bytes", "Size of each WADO cache volume", labels, volume["total"])
+        if volume["files"] is not None:
+            metrics.set("xero_wado_cache_files", "Files in each WADO cache", labels, volume["files"])
+    logging.info(
+        f"{xero_server} WADO cache {usage['used_percent']:.0f}% used"
+        + (f", {usage['files']} files" if counted else "")
+        + f" ({', '.join(volume['path'] for volume in volumes)})"
+    )
+
+    def record(servers):
+        entry = servers.setdefault(xero_server, {"purges": []})
+        entry.update(usage_at=usage["checked_at"], volumes=volumes, used_percent=usage["used_percent"])
+        # a quick reading doesn't count as the scheduled check
+        if not quick:
+            entry["checked_at"] = usage["checked_at"]
+    wado_cache_store.update(record)
+    return usage
+
+
+# The last usage reading of the node if it is at most xero_wado_cache_usage_max_age seconds old
+def recent_wado_cache_usage(xero_server):
+    entry = wado_cache_store.get(xero_server) or {}
+    measured_at = entry.get("usage_at", entry.get("checked_at"))
+    if measured_at is None or time.time() - measured_at > settings.xero_wado_cache_usage_max_age:
+        return None
+    volumes = entry["volumes"]
+    counted = all(volume["files"] is not None for volume in volumes)
+    return {"checked_at": measured_at, "volumes": volumes, "used_percent": entry["used_percent"],
+            "files": sum(volume["files"] for volume in volumes) if counted else None}
+
+
+def wado_cache_over_threshold(usage):
+    return usage is not None and usage["used_percent"] >= settings.xero_wado_cache_threshold
+
+
+# Run the niced purge and record what it reclaimed and how long it took, so its -mmin age can be tuned.
+# Returns the purge record, or None if another purge holds the cluster slot or the purge couldn't run.
+# quick measures the usage afterwards with the df-only command.
+def purge_wado_cache(xero_server, usage_before, wait=False, quick=False):
+    if not run_budget.allows(xero_server, "WADO cache purge", purge_estimate(xero_server)):
+        wado_cache_store.update(lambda servers: servers.setdefault(xero_server, {"purges": []}).update(purge_pending=True))
+        return None
+    purge_slot = cluster_for_node(xero_server).purge_slot
+    if not purge_slot.acquire(timeout=run_budget.bounded(xero_server, settings.xero_wado_purge_timeout) if wait else 0):
+        logging.info(f"Deferring WADO cache purge on {xero_server}, another purge is running in the cluster")
+        wado_cache_store.update(lambda servers: servers.setdefault(xero_server, {"purges": []}).update(purge_pending=True))
+        return None
+    try:
+        logging.info(f"Purging WADO cache on {xero_server} ({usage_before['used_percent']:.0f}% used)")
+        start = time.perf_counter()
+        results = execute_remote_commands(
+            xero_server, settings.xero_server_user, settings.xero_server_private_key,
+            [settings.xero_wado_purge_command], timeout=settings.xero_wado_purge_timeout,
+        )
+        seconds = time.perf_counter() - start
+        usage_after = collect_wado_cache_usage(xero_server, quick=quick)
+    finally:
+        purge_slot.release()
+
+    if results is None:
+        logging.error(f"Unable to run the WADO cache purge on {xero_server}")
+        return None
+    purge = {
+        "started_at": time.time() - seconds,
+        "seconds": round(seconds, 1),
+        "timed_out": results[0]['timed_out'],
+        "used_percent_before": round(usage_before["used_percent"], 1),
+        "used_percent_after": round(usage_after["used_percent"], 1) if usage_after else None,
+        "reclaimed_bytes": sum(volume["used"] for volume in usage_before["volumes"])
+        - sum(volume["used"] for volume in usage_after["volumes"]) if usage_after else None,
+        "files_removed": usage_before["files"] - usage_after["files"]
+        if usage_after and usage_before["files"] is not None and usage_after["files"] is not None else None,
+    }
+
+    def record(servers):
+        entry = servers.setdefault(xero_server, {"purges": []})
+        # keep the last 20 purges per node
+        entry["purges"] = (entry.get("purges", []) + [purge])[-20:]
+        entry["purge_pending"] = False
+    wado_cache_store.update(record)
+    metrics.observe("xero_wado_purge_seconds", "Duration of WADO cache purges",
+                    {"node": xero_server, "outcome": "timeout" if purge["timed_out"] else "success"}, seconds)
+    if purge["reclaimed_bytes"] is not None:
+        metrics.inc("xero_wado_purge_reclaimed_bytes", "Bytes reclaimed by WADO cache purges",
+                    {"node": xero_server}, max(0, purge["reclaimed_bytes"]))
+    logging.info(
+        f"WADO cache purge on {xero_server} took {purge['seconds']:.0f}s: {purge['used_percent_before']}% -> "
+        f"{purge['used_percent_after']}% used, reclaimed {purge['reclaimed_bytes']} bytes, "
+        f"removed {purge['files_removed']} files"
+    )
+    return purge
+
+
+# How long a purge on the node is expected to take, from its recent purges
+def purge_estimate(xero_server):
+    purges = (wado_cache_store.get(xero_server) or {}).get("purges", [])
+    if not purges:
+        return settings.xero_wado_purge_timeout
+    return min(settings.xero_wado_purge_timeout, max(purge["seconds"] for purge in purges) * 1.5)
+
+
+def wado_cache_check_due(xero_server, now):
+    entry = wado_cache_store.get(xero_server) or {}
+    return entry.get("purge_pending") or now - entry.get("checked_at", 0) >= settings.xero_wado_cache_check_interval
+
+
+# Scheduled check of one node: collect usage and purge if the cache has crossed the threshold
+def check_wado_cache(xero_server):
+    if not run_budget.allows(xero_server, "WADO cache check", 0):
+        return
+    usage = collect_wado_cache_usage(xero_server)
+    if wado_cache_over_threshold(usage):
+        purge_wado_cache(xero_server, usage)
+
+
+def check_wado_caches(nodes):
+    if not settings.xero_wado_cache_check_interval:
+        return
+    now = time.time()
+    due_nodes = [node for node in nodes if wado_cache_check_due(node, now)]
+    if not due_nodes:
+        return
+    logging.info(f"Checking WADO cache usage on {len(due_nodes)} nodes")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=settings.xero_probe_concurrency,
+                                               thread_name_prefix="wado-cache") as executor:
+        futures = [
+            (node, executor.submit(call_with_log_context, {"node": node, "phase": "wado_cache"}, check_wado_cache, node))
+            for node in due_nodes
+        ]
+        for node, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Unexpected error while checking the WADO cache on {node}: {e}")
+
+
+# A full cache is a common reason for a node to slow down and then fail, so when that looks like the cause
+# the purge is tried first and the node only restarted if it still fails afterwards. Nothing here holds up the
+# restart for long: a recent reading or a df-only one is used, and a purge already running elsewhere in the
+# cluster means the node is restarted rather than kept waiting for it.
+def purge_before_restart(xero_server):
+    usage = recent_wado_cache_usage(xero_server) or collect_wado_cache_usage(xero_server, quick=True)
+    if not wado_cache_over_threshold(usage):
+        return False
+    logging.info(f"{xero_server} WADO cache is {usage['used_percent']:.0f}% used, purging before a restart")
+    if purge_wado_cache(xero_server, usage, quick=True) is None:
+        return False
+    return wait_for_node_ready(xero_server, action="WADO cache purge")
+
+
+# Remediation limits shared by every worker, per cluster: at most xero_max_concurrent_restarts nodes are restarting
+# at once, and a node is only disabled if at least xero_min_healthy_nodes others stay in the load balancer rotation
+def nodes_in_rotation(cluster):
+    disabled = cluster.disabled_servers_store.get_all()
+    return [node for node in cluster.nodes if node not in disabled]
+
+
+def reserve_disable(xero_server):
+    cluster = cluster_for_node(xero_server)
+    with cluster.capacity_lock:
+        remaining = [node for node in nodes_in_rotation(cluster) if node != xero_server and node not in cluster.pending_disables]
+        if len(remaining) < cluster.xero_min_healthy_nodes:
+            logging.error(
+                f"Not disabling {xero_server}: only {len(remaining)} other {cluster.name} cluster nodes would remain "
+                f"in rotation (minimum {cluster.xero_min_healthy_nodes})"
+            )
+            return False
+        cluster.pending_disables.add(xero_server)
+        return True
+
+
+def release_disable(xero_server):
+    cluster = cluster_for_node(xero_server)
+    with cluster.capacity_lock:
+        cluster.pending_disables.discard(xero_server)
+
+
+def notify_capacity_floor(xero_server):
+    local_time_str = datetime.now().time()
+    subject = f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} (Not Disabled, Cluster Below Minimum Capacity)"
+    body = (
+        f"Xero Ticketing/Image Display is failing on {xero_server} at {local_time_str} and did not recover after a restart.\n"
+        f"The server has NOT been disabled because fewer than {cluster_for_node(xero_server).xero_min_healthy_nodes} other nodes would remain in the load balancer rotation.\n"
+        f"Please investigate."
+    )
+    send_email(settings.smtp_recipients, subject, body, xero_server)
+
+
+def log_cluster_capacity(stage, healthy_nodes):
+    for cluster in clusters:
+        healthy_count = sum(1 for node in cluster.nodes if node in healthy_nodes)
+        logging.info(
+            f"{cluster.name} cluster capacity {stage}: {healthy_count}/{len(cluster.nodes)} nodes healthy, "
+            f"{len(nodes_in_rotation(cluster))}/{len(cluster.nodes)} in rotation"
+        )
+
+
+# probe_result comes from the async probe engine; a disabled node is only re-enabled by its circuit breaker
+def process_node(node, probe_result):
+    if probe_result["healthy"]:
+        if DisabledServerManager.is_server_disabled(node):
+            # the circuit breaker re-enables it once it has passed enough probes in a row
+            return "half_open"
+        return "degraded" if probe_result["degraded"] else "healthy"
+    elif probe_result["breaker"] == "open":
+        return "already_disabled"
+    logging.info(f"Ticket Creation failed for {node}")
+    if DisabledServerManager.is_server_disabled(node):
+        logging.info(f"Skipping {node} - Server is already disabled.")
+        return "already_disabled"
+
+    # the slot is taken before the PREPARE check and any cache purge, so the longest-failing nodes are remediated
+    # first, and the wait for it ends with the run's time
+    restart_slots = cluster_for_node(node).restart_slots
+    remaining = run_budget.phase_remaining(node)
+    if not restart_slots.acquire(node, None if remaining == math.inf else max(0.0, remaining)):
+        run_budget.defer(node, "restart", "no restart slot came free before the run's time ran out")
+        return "deferred"
+    try:
+        server_in_prepare_status = check_for_upgrade(node)
+        metrics.inc("xero_upgrade_checks", "Upgrade (PREPARE) checks for failing nodes", {"in_prepare": str(server_in_prepare_status).lower()})
+        if server_in_prepare_status:
+            logging.info(f"Skipping {node} - Server is in a PREPARE Status")
+            notify_failed_server_pending_upgrade(node)
+            return "prepare"
+
+        if purge_before_restart(node):
+            local_time_str = datetime.now().time()
+            subject = f"Xero Ticketing/Image Display has been Restored on {node} at {local_time_str} (WADO Cache Purged)"
+            body = f"Xero Ticketing/Image Display has been Restored on {node} at {local_time_str} after its WADO cache was purged, no restart was needed"
+            send_email(settings.smtp_recipients, subject, body, node)
+            return "purged"
+
+        # checked once the slot is ours, the wait for it may have used up the time
+        if not run_budget.allows(node, "restart", restart_estimate(node)):
+            return "deferred"
+        restart_start = time.perf_counter()
+        restart_xero_services(node)
+        logging.info("Restart Completed, polling for readiness")
+        recovered = wait_for_node_ready(node)
+        metrics.observe("xero_restart_recovery_seconds", "Time from restart to the node passing (or failing) its retest",
+                        {"node": node, "outcome": {True: "recovered", False: "failed", None: "deferred"}[recovered]},
+                        time.perf_counter() - restart_start)
+    finally:
+        restart_slots.release()
+
+    if recovered is None:
+        run_budget.defer(node, "retest after restart", "the run's time ran out before it passed or failed")
+        return "deferred"
+    if not recovered:
+        if not reserve_disable(node):
+            notify_capacity_floor(node)
+            return "below_capacity_floor"
+        try:
+            logging.info(f"Ticket Creation failed for {node} Disabling Server")
+            disable_xero_server(node)
+        finally:
+            release_disable(node)
+        return "disabled"
+    else:
+        local_time_str = datetime.now().time()
+        subject = f"Xero Ticketing/Image Display has been Restored on {node} at {local_time_str}"
+        body = f"Xero Ticketing/Image Display has been Restored on {node} at {local_time_str}"
+        if settings.use_memes:
+            meme_data = generate_meme(settings.successful_restart_meme_path,
+                                      f"Xero Ticketing/Image Display has been Restored on {node}",
+                                      "")
+            send_email(settings.smtp_recipients, subject, body, node, meme_data)
+        else:
+            send_email(settings.smtp_recipients, subject, body, node)
+        return "restored"
+
+
+def correlate_failures(failed_nodes):
+    # nodes already disabled or in PREPARE have their own records, only new failures join the outage incident
+    new_failures = [node for node in failed_nodes if not DisabledServerManager.is_server_disabled(node)]
+    if len(new_failures) >= settings.correlation_min_nodes or (new_failures and service_now_client.correlated_incident):
+        service_now_client.add_correlation_candidates(new_failures)
+
+
+def notify_latency_drift(xero_server, reasons, action):
+    local_time_str = datetime.now().time()
+    subject = f"Xero Ticketing is slowing down on {xero_server} at {local_time_str}"
+    body = (
+        f"Xero Ticketing is still working on {xero_server} but its probe latency has drifted at {local_time_str}:\n"
+        + "\n".join(reasons) + f"\n{action}"
+    )
+    send_email(settings.smtp_recipients, subject, body, xero_server)
+
+
+def notify_latency_recovered(xero_server):
+    local_time_str = datetime.now().time()
+    subject = f"Xero Ticketing latency is back to normal on {xero_server} at {local_time_str}"
+    body = f"Xero Ticketing probe latency on {xero_server} is back within its baseline at {local_time_str}"
+    send_email(settings.smtp_recipients, subject, body, xero_server)
+
+
+def in_quiet_window():
+    current_time = datetime.now().time()
+    if settings.drift_quiet_start <= settings.drift_quiet_end:
+        return settings.drift_quiet_start <= current_time <= settings.drift_quiet_end
+    # the window crosses midnight
+    return current_time >= settings.drift_quiet_start or current_time <= settings.drift_quiet_end
+
+
+# Act on a drifting node before it fails: purge its WADO cache, or restart it if the cluster can spare it
+def preempt_drifting_node(xero_server):
+    if settings.drift_action == "purge":
+        usage = collect_wado_cache_usage(xero_server)
+        return usage is not None and purge_wado_cache(xero_server, usage, wait=True) is not None
+    if not reserve_disable(xero_server):
+        return False
+    restart_slots = cluster_for_node(xero_server).restart_slots
+    try:
+        restart_slots.acquire(xero_server)
+        try:
+            logging.info(f"Restarting {xero_server} in the quiet window, its probe latency has drifted")
+            restart_xero_services(xero_server)
+            return wait_for_node_ready(xero_server)
+        finally:
+            restart_slots.release()
+    finally:
+        release_disable(xero_server)
+
+
+# Alert once per drift episode, and take the configured action once per episode when inside the quiet window
+def handle_latency_drift(nodes):
+    flags = detect_latency_drift(nodes)
+    quiet = in_quiet_window()
+
+    def record(servers):
+        changes = []
+        for node in nodes:
+            if node in flags:
+                entry = servers.get(node)
+                if entry is None:
+                    entry = servers[node] = {"since": time.time(), "action_taken": False}
+                    changes.append((node, "drifting"))
+                entry["reasons"] = flags[node]
+                if settings.drift_action != "none" and quiet and not entry["action_taken"] \
+                        and not DisabledServerManager.is_server_disabled(node):
+                    entry["action_taken"] = True
+                    changes.append((node, "preempt"))
+            elif servers.pop(node, None) is not None:
+                changes.append((node, "recovered"))
+        return changes
+
+    for node, change in drifting_servers_store.update(record):
+        if change == "recovered":
+            logging.info(f"{node} probe latency is back within its baseline")
+            notify_latency_recovered(node)
+        elif change == "drifting":
+            logging.warning(f"{node} probe latency has drifted: {'; '.join(flags[node])}")
+            if settings.drift_action == "none":
+                action = "No action has been taken, please investigate."
+            elif quiet:
+                action = f"A pre-emptive {settings.drift_action} is being run now, inside the quiet window."
+            else:
+                action = f"A pre-emptive {settings.drift_action} will be run in the next quiet window ({settings.drift_quiet_start}-{settings.drift_quiet_end})."
+            notify_latency_drift(node, flags[node], action)
+        if change == "preempt":
+            estimate = purge_estimate(node) if settings.drift_action == "purge" else readiness_deadline(node)
+            if not run_budget.allows(node, f"pre-emptive {settings.drift_action}", estimate):
+                # left for the next run in the quiet window
+                drifting_servers_store.update(lambda servers, node=node: servers[node].update(action_taken=False))
+                continue
+            outcome = "success" if preempt_drifting_node(node) else "failure"
+            metrics.inc("xero_drift_preemptions", "Pre-emptive purges/restarts of drifting nodes",
+                        {"node": node, "action": settings.drift_action, "outcome": outcome})
+            logging.info(f"Pre-emptive {settings.drift_action} of {node}: {outcome}")
+
+
+# Time budget of a single run, run_deadline seconds (0 for none). Each phase may use a share of what is left when it
+# starts, so a slow probe phase can't leave nothing for remediation. Work that can't finish in its phase is skipped
+# and listed as deferred to the next run.
+class RunBudget:
+    phase_shares = {"probe": 0.4, "remediate": 0.85, "wado_cache": 0.5, "drift": 1.0}
+
+    def __init__(self):
+        self.deadline = None
+        self.phase_end = None
+        self.started = None
+        self.deferred = []
+        self.overdue = set()
+        self.lock = threading.Lock()
+
+    def start(self, seconds):
+        self.started = time.monotonic()
+        self.deadline = self.started + seconds if seconds else None
+        self.phase_end = self.deadline
+        self.deferred = []
+        # nodes the last run deferred work on aren't deferred again, their work runs past the deadline if it has to
+        self.overdue = set(deferred_work_store.get_all()) if self.deadline is not None else set()
+
+    def start_phase(self, phase):
+        if self.deadline is not None:
+            now = time.monotonic()
+            self.phase_end = now + max(0.0, self.deadline - now) * self.phase_shares[phase]
+
+    def phase_remaining(self, xero_server=None):
+        if self.phase_end is None or xero_server in self.overdue:
+            return math.inf
+        return self.phase_end - time.monotonic()
+
+    # seconds, cut down to what is left of the phase, as the timeout of a wait or remote command made for a node
+    def bounded(self, xero_server, seconds, floor=0.0):
+        return max(floor, min(seconds, self.phase_remaining(xero_server)))
+
+    def defer(self, xero_server, work, reason):
+        with self.lock:
+            self.deferred.append((xero_server, work, reason))
+        recorder.note("deferred", xero_server, work)
+        logging.warning(f"Deferring {work} on {xero_server} to the next run: {reason}")
+        metrics.inc("xero_deferred_work", "Work deferred to the next run for lack of time", {"work": work})
+
+    # True if work expected to take up to seconds can still finish in this phase, otherwise it is deferred
+    def allows(self, xero_server, work, seconds):
+        remaining = self.phase_remaining(xero_server)
+        if remaining > seconds:
+            return True
+        self.defer(xero_server, work, f"it needs up to {seconds:.0f}s and {max(0.0, remaining):.0f}s are left"
+                   if seconds else "the phase's time is up")
+        return False
+
+    # Counts the runs in a row each node has had work deferred in, and emails once a node reaches deferred_alert_after
+    def record_deferrals(self):
+        with self.lock:
+            reasons = {}
+            for xero_server, work, reason in self.deferred:
+                reasons.setdefault(xero_server, []).append(f"{work} ({reason})")
+        if not reasons and not deferred_work_store.get_all():
+            return
+
+        def record(servers):
+            counts = {xero_server: servers.get(xero_server, 0) + 1 for xero_server in reasons}
+            servers.clear()
+            servers.update(counts)
+            return counts
+        for xero_server, count in deferred_work_store.update(record).items():
+            if count == settings.deferred_alert_after:
+                notify_repeated_deferral(xero_server, count, reasons[xero_server])
+
+    def finish(self):
+        if self.deadline is not None:
+            elapsed = time.monotonic() - self.started
+            logging.info(f"Run took {elapsed:.0f}s of its {self.deadline - self.started:.0f}s budget")
+            metrics.set("xero_run_seconds", "Duration of the last monitoring run", {}, round(elapsed, 3))
+        if self.deferred:
+            logging.warning(f"Deferred to the next run: {'; '.join(f'{work} on {node} ({reason})' for node, work, reason in self.deferred)}")
+        metrics.set("xero_deferred_work_items", "Work items the last run deferred to the next", {}, len(self.deferred))
+        self.deadline = self.phase_end = None
+
+
+deferred_work_store = LazyStateStore("deferred_work", "deferred_work_file")
+run_budget = RunBudget()
+
+
+def notify_repeated_deferral(xero_server, count, work):
+    local_time_str = datetime.now().time()
+    subject = f"Xero monitoring has deferred work on {xero_server} {count} runs in a row at {local_time_str}"
+    body = (
+        f"The monitoring run has deferred work on {xero_server} for lack of time in each of the last {count} runs "
+        f"(this run: {'; '.join(work)}).\nThe run deadline may be too short for this cluster, please investigate."
+    )
+    send_email(settings.smtp_recipients, subject, body, xero_server)
+
+
+# Only one run at a time: the lock is held for the whole run (or the life of the daemon) and the file names the
+# holder. A run that dies releases the lock with its process, and the next run notes it left the file behind; a
+# holder older than run_lock_stale_after is reported as hung. Returns the open lock file, or None if it is held.
+def acquire_run_lock():
+    lock_file = open(settings.run_lock_file, 'a+')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        lock_file.seek(0)
+        holder = lock_file.read().split()
+        lock_file.close()
+        if len(holder) == 2:
+            pid, age = holder[0], time.time() - float(holder[1])
+            if age > settings.run_lock_stale_after:
+                logging.error(f"Run {pid} has held {settings.run_lock_file} for {age:.0f}s, past run_lock_stale_after "
+                              f"({settings.run_lock_stale_after}s); it looks hung and should be checked")
+            else:
+                logging.warning(f"Run {pid} started {age:.0f}s ago is still in progress, skipping this run")
+        else:
+            logging.warning(f"Another run holds {settings.run_lock_file}, skipping this run")
+        return None
+    lock_file.seek(0)
+    previous = lock_file.read().split()
+    if previous:
+        logging.warning(f"Run {previous[0]} did not release the run lock cleanly, taking it over")
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(f"{os.getpid()} {time.time():.0f}")
+    lock_file.flush()
+    return lock_file
+
+
+def release_run_lock(lock_file):
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.flush()
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    lock_file.close()
+
+
+# Remediates one node and takes it out of its cluster's restart queue however that ends
+def remediate_node(node, probe_result):
+    try:
+        return process_node(node, probe_result)
+    finally:
+        cluster_for_node(node).restart_slots.leave(node)
+
+
+def remediate_nodes(probe_results):
+    failing_since = FailureTracker.record_probe_results(probe_results)
+    DegradedTracker.record_probe_results(probe_results)
+    CircuitBreaker.record_probe_results(probe_results)
+    healthy_nodes = [node for node, result in probe_results.items() if result["healthy"]]
+    # longest-failing nodes get the first restart slots
+    failed_nodes = sorted(
+        (node for node, result in probe_results.items() if not result["healthy"]),
+        key=lambda node: failing_since[node],
+    )
+    now = time.time()
+    for node in failed_nodes:
+        logging.info(f"{node} has been failing for {now - failing_since[node]:.0f}s")
+
+    log_cluster_capacity("before remediation", healthy_nodes)
+    service_now_client.clear_correlation(healthy_nodes)
+    if settings.correlate_incidents:
+        correlate_failures(failed_nodes)
+    for cluster in clusters:
+        cluster.restart_slots.queue([node for node in failed_nodes if cluster_for_node(node) is cluster])
+    # each cluster gets its own workers, so one waiting on its restart slots doesn't hold up the others
+    with contextlib.ExitStack() as stack:
+        executors = {
+            cluster.name: stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(thread_name_prefix=f"remediate-{cluster.name}")
+            )
+            for cluster in clusters
+        }
+        futures = {
+            node: executors[cluster_for_node(node).name].submit(
+                call_with_log_context,
+                {"cluster": cluster_for_node(node).name, "node": node, "probe_id": probe_results[node]["probe_id"], "phase": "remediate"},
+                remediate_node, node, probe_results[node],
+            )
+            for node in healthy_nodes + failed_nodes
+        }
+        # one node's failure doesn't stop the others being remediated
+        outcomes = {}
+        for node, future in futures.items():
+            try:
+                outcomes[node] = future.result()
+            except Exception as e:
+                logging.error(f"Unexpected error while processing {node}: {e}")
+                outcomes[node] = "error"
+    log_cluster_capacity(
+        "after remediation", [node for node, outcome in outcomes.items() if outcome in ("healthy", "restored", "purged")]
+    )
+    return outcomes
+
+
+def main(record_path=None):
+    if recorder.mode is None and (record_path or settings.record_dir):
+        recorder.start_recording()
+    run_budget.start(settings.run_deadline)
+    outcomes = {}
+
+    try:
+        # incidents an earlier run couldn't create are retried in the background while this one runs
+        service_now_client.resume_pending()
+
+        # Phase 1: probe every node before touching any of them
+        refresh_inventories()
+        nodes = monitored_nodes()
+        run_budget.start_phase("probe")
+        probe_results = probe_all_nodes(nodes)
+        failed_nodes = [node for node, result in probe_results.items() if not result["healthy"]]
+        logging.info(
+            f"Probe phase complete: {len(probe_results) - len(failed_nodes)}/{len(probe_results)} nodes healthy "
+            f"across {len(clusters)} clusters"
+        )
+
+        # Phase 2: remediate the failing nodes within the restart cap and capacity floor
+        run_budget.start_phase("remediate")
+        outcomes = remediate_nodes(probe_results)
+
+        # Phase 3: scheduled WADO cache usage checks (and purges) on the nodes that are serving
+        run_budget.start_phase("wado_cache")
+        check_wado_caches([node for node, outcome in outcomes.items() if outcome in ("healthy", "degraded")])
+
+        # Phase 4: compare each node's recent probe latency with its history and the rest of the cluster
+        run_budget.start_phase("drift")
+        handle_latency_drift([node for node, outcome in outcomes.items() if outcome in ("healthy", "degraded")])
+    finally:
+        # a failed phase still delivers the queued email and writes the metrics and status
+        run_budget.record_deferrals()
+        probe_history.close()
+        close_http_sessions()
+        close_cluster_db_pool()
+        close_ssh_clients()
+        service_now_client.close()
+        email_outbox.close()
+        if recorder.mode == "record":
+            recorder.save(record_path, outcomes)
+        run_budget.finish()
+        metrics.set("xero_last_run_timestamp_seconds", "Completion time of the last monitoring run", {}, time.time())
+        write_metrics_textfile()
+        write_status_file()
+    logging.info("All tasks completed. Shutting down.")
+    return outcomes
+
+def run_daemon():
+    stop_event = threading.Event()
+
+    def handle_stop(signum, frame):
+        logging.info(f"Received signal {signum}, finishing in-flight work and shutting down")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+    if settings.metrics_http_port:
+        start_metrics_server(settings.metrics_http_port)
+    email_outbox.resend_spooled()
+    service_now_client.resume_pending()
+
+    refresh_inventories()
+    nodes = monitored_nodes()
+    next_inventory_refresh = time.monotonic() + settings.xero_inventory_refresh
+    logging.info(f"Starting daemon: probing {len(nodes)} nodes in {len(clusters)} clusters every {settings.daemon_probe_interval}s (+/- {settings.daemon_probe_jitter}s)")
+    if settings.daemon_liveness_interval:
+        logging.info(f"Liveness checks every {settings.daemon_liveness_interval}s between full probes")
+
+    # stagger the first probes so the nodes don't stay in lockstep
+    next_probe = {node: time.monotonic() + random.uniform(0, settings.daemon_probe_jitter) for node in nodes}
+    next_liveness = {node: due + settings.daemon_liveness_interval for node, due in next_probe.items()}
+    remediating = set()
+    remediating_lock = threading.Lock()
+    cache_check = None
+    drift_check = None
+    next_drift_check = time.monotonic() + settings.daemon_probe_interval
+
+    def remediate(node, probe_result):
+        try:
+            with log_context(cluster=cluster_for_node(node).name, node=node, probe_id=probe_result["probe_id"], phase="remediate"):
+                remediate_node(node, probe_result)
+        except Exception as e:
+            logging.error(f"Unexpected error while processing {node}: {e}")
+        finally:
+            with remediating_lock:
+                remediating.discard(node)
+
+    with concurrent.futures.ThreadPoolExecutor(thread_name_prefix="remediate") as executor:
+        while not stop_event.is_set():
+            now = time.monotonic()
+            if any(cluster.xero_discover_nodes for cluster in clusters) and now >= next_inventory_refresh:
+                next_inventory_refresh = now + settings.xero_inventory_refresh
+                if refresh_inventories():
+                    nodes = monitored_nodes()
+                    for node in set(next_probe) - set(nodes):
+                        next_probe.pop(node)
+                        next_liveness.pop(node)
+                    for node in set(nodes) - set(next_probe):
+                        next_probe[node] = now
+                        next_liveness[node] = now + settings.daemon_liveness_interval
+
+            if settings.daemon_liveness_interval:
+                live_nodes = [node for node, due in next_liveness.items() if due <= now]
+                for node in live_nodes:
+                    next_liveness[node] = now + settings.daemon_liveness_interval
+                with remediating_lock:
+                    # nodes due a full probe anyway are skipped, and disabled nodes are left to their circuit breaker
+                    live_nodes = [
+                        node for node in live_nodes
+                        if next_probe[node] > now and node not in remediating
+                        and not DisabledServerManager.is_server_disabled(node)
+                    ]
+                if live_nodes:
+                    for node, alive in check_liveness_all(live_nodes).items():
+                        status_board.record_liveness(node, alive)
+                        next_liveness[node] = time.monotonic() + settings.daemon_liveness_interval
+                        if not alive:
+                            # a failed liveness check brings the node's full probe forward to now
+                            next_probe[node] = now
+
+            with remediating_lock:
+                # a node being restarted/disabled is not probed again until that finishes
+                due_nodes = [node for node, due in next_probe.items() if due <= now and node not in remediating]
+
+            if due_nodes:
+                probe_results = probe_all_nodes(due_nodes)
+                if stop_event.is_set():
+                    # don't start restarts on the way out
+                    break
+                failing_since = FailureTracker.record_probe_results(probe_results)
+                DegradedTracker.record_probe_results(probe_results)
+                CircuitBreaker.record_probe_results(probe_results)
+                service_now_client.clear_correlation(
+                    [node for node in due_nodes if probe_results[node]["healthy"]]
+                )
+                if settings.correlate_incidents:
+                    correlate_failures([node for node in due_nodes if not probe_results[node]["healthy"]])
+                # longest-failing nodes get the first restart slots
+                for node in sorted(due_nodes, key=lambda node: failing_since.get(node, 0)):
+                    next_probe[node] = time.monotonic() + max(
+                        1, settings.daemon_probe_interval + random.uniform(-settings.daemon_probe_jitter, settings.daemon_probe_jitter)
+                    )
+                    next_liveness[node] = time.monotonic() + settings.daemon_liveness_interval
+                    probe_result = probe_results[node]
+                    # disabled nodes are re-enabled by their circuit breaker, there is nothing to remediate
+                    if probe_result["healthy"] or DisabledServerManager.is_server_disabled(node):
+                        continue
+                    with remediating_lock:
+                        remediating.add(node)
+                    cluster_for_node(node).restart_slots.queue([node])
+                    executor.submit(remediate, node, probe_result)
+
+            if due_nodes:
+                write_metrics_textfile()
+                write_status_file()
+
+            # one cache check pass at a time, over nodes that aren't being restarted or disabled
+            if settings.xero_wado_cache_check_interval and (cache_check is None or cache_check.done()):
+                with remediating_lock:
+                    idle_nodes = [
+                        node for node in nodes
+                        if node not in remediating and not DisabledServerManager.is_server_disabled(node)
+                    ]
+                now = time.time()
+                if any(wado_cache_check_due(node, now) for node in idle_nodes):
+                    cache_check = executor.submit(check_wado_caches, idle_nodes)
+
+            # latency drift is checked once per probe interval, it needs several probes to move anyway
+            if time.monotonic() >= next_drift_check and (drift_check is None or drift_check.done()):
+                next_drift_check = time.monotonic() + settings.daemon_probe_interval
+                with remediating_lock:
+                    idle_nodes = [
+                        node for node in nodes
+                        if node not in remediating and not DisabledServerManager.is_server_disabled(node)
+                    ]
+                drift_check = executor.submit(handle_latency_drift, idle_nodes)
+
+            # in digest mode the daemon sends one summary per probe interval instead of one per run
+            if settings.email_digest_mode and email_outbox.digest_age() >= settings.daemon_probe_interval:
+                email_outbox.flush_digest()
+
+            next_wake = min(next_probe.values())
+            if settings.daemon_liveness_interval:
+                next_wake = min(next_wake, min(next_liveness.values()))
+            stop_event.wait(max(0.5, next_wake - time.monotonic()))
+
+    close_http_sessions()
+    close_cluster_db_pool()
+    close_ssh_clients()
+    service_now_client.close()
+    email_outbox.close()
+    probe_history.close()
+    logging.info("Daemon stopped.")
+
+
+def meme_testing():
+    xero_server = "TESTSERVER"
+    local_time_str = datetime.now().time()
+    meme_data = generate_meme(settings.successful_restart_meme_path, f"Xero Ticketing/Image Display has been Restored on {xero_server}","")
+    #meme_data = generate_meme(unsuccessful_restart_meme_path, "ONE DOES NOT SIMPLY", f"RESTART XERO SERVICES ON {xero_server}")
+    subject = f"Xero Ticketing/Image Display has been Restored on {xero_server} at {local_time_str}"
+    body = f"Xero Ticketing/Image Display has been Restored on {xero_server} at {local_time_str}"
+    send_email(settings.smtp_recipients, subject, body, xero_server, meme_data)
+    email_outbox.close()
+
+# Dependencies only imported once a node fails (or the metrics endpoint is enabled), by what needs them
+deferred_imports = {
+    "SSH restarts/disables (paramiko)": ["paramiko"],
+    "Memes (Pillow)": ["PIL.Image", "PIL.ImageDraw", "PIL.ImageFont"],
+    "Upgrade check (cx_Oracle)": ["cx_Oracle"],
+    "Email (smtplib/email)": ["smtplib", "email.mime.multipart", "email.mime.image", "email.mime.text"],
+    "Metrics endpoint (http.server)": ["http.server"],
+}
+
+
+# (depth, package, cumulative ms) for each line of python -X importtime output, nesting is shown by indentation
+def parse_importtime(output):
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, package = line[len("import time:"):].split("|")
+        imports.append(((len(package) - len(package.lstrip()) - 1) // 2, package.strip(), int(cumulative) / 1000))
+    return imports
+
+
+# Import cost measured in a fresh interpreter, the same way a cron run starts: the healthy path first, then
+# each deferred dependency on top of it, and the time to parse and validate each config section
+def startup_report(limit=10):
+    import subprocess
+    marker = "xeroticket startup report"
+
+    def importtime(statements):
+        code = "\n".join(["import sys", "import xeroticket", f"sys.stderr.write({marker!r} + '\\n')",
+                          "sys.stderr.flush()"] + statements)
+        return subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=script_dir,
+                              capture_output=True, text=True)
+
+    names = [module for modules in deferred_imports.values() for module in modules]
+    result = importtime([f"print(','.join(module for module in {names!r} if module in sys.modules))"])
+    if result.returncode != 0:
+        print(f"Unable to import xeroticket:\n{result.stderr.split(marker)[-1].strip()}")
+        return 1
+    startup = parse_importtime(result.stderr.split(marker)[0])
+    # xeroticket's own imports are the depth 1 lines between the previous top-level import and xeroticket itself
+    own = next(index for index, (depth, package, _) in enumerate(startup) if depth == 0 and package == "xeroticket")
+    first = max((index for index, (depth, _, _) in enumerate(startup[:own]) if depth == 0), default=-1) + 1
+    direct = [(package, ms) for depth, package, ms in startup[first:own] if depth == 1]
+    print("Healthy path startup (python -X importtime, fresh interpreter)")
+    print(f"  {'interpreter + xeroticket':<40} {sum(ms for depth, _, ms in startup if depth == 0):8.1f} ms")
+    print(f"  {'xeroticket':<40} {startup[own][2]:8.1f} ms")
+    for package, ms in sorted(direct, key=lambda item: item[1], reverse=True)[:limit]:
+        print(f"    {package:<38} {ms:8.1f} ms")
+
+    loaded_early = [module for module in result.stdout.strip().split(",") if module]
+    print("\nDeferred until a node fails")
+    for label, modules in deferred_imports.items():
+        if any(module in loaded_early for module in modules):
+            print(f"  {label:<40} imported at startup")
+            continue
+        result = importtime([f"import {module}" for module in modules])
+        if result.returncode != 0:
+            print(f"  {label:<40} not installed")
+            continue
+        deferred = parse_importtime(result.stderr.split(marker)[-1])
+        print(f"  {label:<40} {sum(ms for depth, _, ms in deferred if depth == 0):8.1f} ms")
+
+    print("\nConfig sections (parse + validate)")
+    fresh_settings = Settings(config_file_path)
+    for section in config_options:
+        start = time.perf_counter()
+        try:
+            fresh_settings.load_section(section)
+            status = f"{(time.perf_counter() - start) * 1000:8.2f} ms"
+        except ConfigError as e:
+            status = f"invalid: {e}"
+        print(f"  {section:<40} {status}")
+    return 0
+
+
+# Token bucket shared by a node's load test workers, rate sessions per second with no bursts beyond one second
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline):
+        if not self.rate:
+            return True
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if now + wait >= deadline:
+                return False
+            sleep(wait)
+
+
+# One synthetic user: mint a ticket and open the viewer with it, on its own session like a separate browser
+def load_test_session(xero_server, session):
+    start = time.perf_counter()
+    xero_ticket, outcome = request_xero_ticket(xero_server, 0, session)
+    ticket_seconds = time.perf_counter() - start
+    verify_seconds = None
+    if xero_ticket:
+        verify_start = time.perf_counter()
+        verified, outcome = request_ticket_verification(xero_server, xero_ticket, 0, session)
+        verify_seconds = time.perf_counter() - verify_start
+    return {"outcome": outcome, "ticket": ticket_seconds, "verify": verify_seconds, "total": time.perf_counter() - start}
+
+
+def load_test_step(xero_server, concurrency, seconds, rate):
+    limiter = RateLimiter(rate)
+    deadline = time.monotonic() + seconds
+    sessions = []
+    sessions_lock = threading.Lock()
+
+    def worker():
+        with requests.Session() as session:
+            while time.monotonic() < deadline and limiter.acquire(deadline):
+                result = load_test_session(xero_server, session)
+                with sessions_lock:
+                    sessions.append(result)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, name=f"loadtest-{xero_server}-{index}") for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "node": xero_server,
+        "concurrency": concurrency,
+        "sessions": len(sessions),
+        "errors": sum(1 for result in sessions if result["outcome"] != "success"),
+        "throughput": len(sessions) / elapsed,
+    }
+    report["error_rate"] = report["errors"] / len(sessions) if sessions else 1.0
+    for phase in ("ticket", "verify", "total"):
+        values = [result[phase] for result in sessions if result[phase] is not None]
+        for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            report[f"{phase}_{name}"] = percentile(values, fraction) if values else None
+    return report
+
+
+def format_load_test_step(report):
+    def ms(value):
+        return f"{value * 1000:8.0f}" if value is not None else f"{'n/a':>8}"
+    return (
+        f"  {report['node']:<24} {report['concurrency']:>5} {report['sessions']:>8} {report['error_rate'] * 100:>6.1f}% "
+        f"{report['throughput']:>8.1f}/s {ms(report['ticket_p50'])} {ms(report['ticket_p95'])} {ms(report['ticket_p99'])} "
+        f"{ms(report['verify_p50'])} {ms(report['verify_p95'])} {ms(report['verify_p99'])}"
+    )
+
+
+# Ramp concurrent ticket-mint-and-open sessions on each node through the concurrency steps. All nodes run each step
+# at the same time; a node stops ramping once a step's error rate or session p95 crosses its abort threshold.
+def load_test(nodes, steps, step_seconds, rate, max_error_rate, max_p95, json_path=None):
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"Load testing {len(nodes)} nodes, {step_seconds}s per step"
+          + (f", at most {rate} sessions/s per node" if rate else ""))
+    print(f"  {'node':<24} {'conc':>5} {'sessions':>8} {'errors':>7} {'throughput':>10} "
+          f"{'ticket p50/p95/p99 ms':>26} {'verify p50/p95/p99 ms':>26}")
+    reports = []
+    active = list(nodes)
+    aborted = {}
+    for concurrency in steps:
+        if not active:
+            break
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(active), thread_name_prefix="loadtest") as executor:
+            step_reports = list(executor.map(lambda node: load_test_step(node, concurrency, step_seconds, rate), active))
+        for report in step_reports:
+            print(format_load_test_step(report))
+            reports.append(report)
+            if report["error_rate"] > max_error_rate:
+                aborted[report["node"]] = f"error rate {report['error_rate'] * 100:.1f}% at concurrency {concurrency}"
+            elif max_p95 and report["total_p95"] is not None and report["total_p95"] > max_p95:
+                aborted[report["node"]] = f"session p95 {report['total_p95']:.2f}s at concurrency {concurrency}"
+        active = [node for node in active if node not in aborted]
+    close_http_sessions()
+
+    print()
+    for node in nodes:
+        node_reports = [report for report in reports if report["node"] == node]
+        # the step that crossed a threshold doesn't count as held
+        held = node_reports[:-1] if node in aborted else node_reports
+        summary = (f"held concurrency {held[-1]['concurrency']}, peak {max(report['throughput'] for report in held):.1f} sessions/s"
+                   if held else "did not hold the first step")
+        print(f"  {node}: {summary}" + (f", aborted on {aborted[node]}" if node in aborted else ""))
+    if json_path:
+        with open(json_path, "w") as file:
+            json.dump(reports, file, indent=2)
+    return 1 if aborted else 0
+
+
+# The module-wide state stores by store name, each cluster adds its own disabled and failing servers stores
+shared_store_names = (
+    "degraded_servers", "circuit_breakers", "drifting_servers", "node_inventory", "restart_times", "wado_cache",
+    "pending_incidents", "deferred_work",
+)
+
+
+def state_stores():
+    stores = {name: globals()[f"{name}_store"] for name in shared_store_names}
+    for cluster in clusters:
+        stores[f"{cluster.store_prefix}disabled_servers"] = cluster.disabled_servers_store
+        stores[f"{cluster.store_prefix}failing_servers"] = cluster.failing_servers_store
+    return stores
+
+
+# a deep copy, the stores update their entries in place as the run goes on
+def snapshot_state():
+    return json.loads(json.dumps({name: store.get_all() for name, store in state_stores().items()}))
+
+
+def disabled_state():
+    return {cluster.name: cluster.disabled_servers_store.get_all() for cluster in clusters}
+
+
+# enough probe history for drift detection to see what it saw when the run was recorded
+def snapshot_history():
+    limit = settings.drift_baseline + settings.drift_window
+    return {node: [list(record) for record in probe_history.recent(node, limit)] for node in monitored_nodes()}
+
+
+# Points every state store, the probe history and the per-run objects at a scratch directory seeded with the
+# recording's state, so a replay never touches the real state files and each replay starts from its own
+def reset_for_replay(state_dir, recording):
+    settings.state_backend = "json"
+    settings.history_dir = os.path.join(state_dir, "history")
+    settings.metrics_textfile = ""
+    settings.status_file = ""
+    settings.record_dir = ""
+    settings.smtp_spool_dir = os.path.join(state_dir, "email_spool")
+    for name in shared_store_names:
+        setattr(settings, f"{name}_file", os.path.join(state_dir, f"{name}.json"))
+    replay_clusters = load_clusters()
+    for cluster in replay_clusters:
+        cluster.disabled_servers_file = os.path.join(state_dir, f"disabled_servers_{cluster.name}.json")
+        cluster.failing_servers_file = os.path.join(state_dir, f"failing_servers_{cluster.name}.json")
+        cluster.open_stores()
+    globals().update(
+        {f"{name}_store": open_state_store(name, getattr(settings, f"{name}_file")) for name in shared_store_names},
+        clusters=replay_clusters, metrics=MetricsRegistry(), status_board=StatusBoard(), probe_history=ProbeHistory(),
+        email_outbox=EmailOutbox(), service_now_client=ServiceNowClient(),
+    )
+    for name, store in state_stores().items():
+        store.update(lambda servers: servers.update(recording["state"].get(name, {})))
+    for node, records in recording["history"].items():
+        probe_history.extend(node, records)
+    http_sessions.clear()
+    ssh_clients.clear()
+
+
+def replay_recording(path):
+    recording = load_recording(path)
+    real_time = time
+    clock = ReplayClock(real_time, recording["started_at"])
+    report = {"recording": path, "interactions": len(recording["interactions"]), "error": None}
+    start = real_time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="xeroticket-replay-") as state_dir:
+        reset_for_replay(state_dir, recording)
+        recorder.start_replay(recording, clock)
+        globals().update(time=clock, sleep=clock.sleep)
+        outcomes = {}
+        try:
+            outcomes = main()
+        except Exception as e:
+            report["error"] = repr(e)
+        finally:
+            globals().update(time=real_time, sleep=real_time.sleep)
+            recorder.stop()
+        mismatches = recorder.mismatches
+        for node in sorted(set(recording["outcomes"]) | set(outcomes)):
+            if recording["outcomes"].get(node) != outcomes.get(node):
+                mismatches.append(f"{node} outcome: recorded {recording['outcomes'].get(node)}, replayed {outcomes.get(node)}")
+        disabled = disabled_state()
+        for name, servers in recording["disabled"].items():
+            if disabled.get(name) != servers:
+                mismatches.append(f"{name} disabled servers: recorded {servers}, replayed {disabled.get(name)}")
+        for (kind, key), pending in recorder.pending.items():
+            if pending:
+                mismatches.append(f"{len(pending)} recorded {kind} {key} interactions were not replayed")
+        probe_history.close()
+    # a request the recording didn't have is usually retried, report it once with a count
+    report["mismatches"] = [f"{line} ({count}x)" if count > 1 else line
+                            for line, count in collections.Counter(mismatches).items()]
+    report["seconds"] = real_time.perf_counter() - start
+    return report
+
+
+# Replays recorded runs with no network, at full speed, and reports every place the decisions, remediation
+# commands or emails differ from the recording
+def replay_recordings(paths, verbose=False, json_path=None):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".jsonl.gz")))
+        else:
+            files.append(path)
+    if not verbose:
+        logging.disable(logging.ERROR)
+    start = time.perf_counter()
+    reports = []
+    for path in files:
+        report = replay_recording(path)
+        reports.append(report)
+        status = "ok" if not report["mismatches"] and not report["error"] else "DIFF"
+        print(f"{status:<4} {path}: {report['interactions']} interactions in {report['seconds'] * 1000:.0f} ms")
+        for line in report["mismatches"] + ([f"error: {report['error']}"] if report["error"] else []):
+            print(f"       {line}")
+    failed = [report for report in reports if report["mismatches"] or report["error"]]
+    print(f"{len(reports) - len(failed)}/{len(reports)} recordings replayed without differences "
+          f"in {time.perf_counter() - start:.2f}s")
+    if json_path:
+        with open(json_path, "w") as file:
+            json.dump(reports, file, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Monitor Xero ticketing and restart/disable failing nodes")
+    parser.add_argument("--daemon", action="store_true",
+                        help="stay resident and probe each node on its own interval instead of running once")
+    parser.add_argument("--check-config", action="store_true",
+                        help="validate every section of the config file and exit")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record every outbound interaction of this run to FILE, for the replay command")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="report import and config parsing time for the healthy and failure paths and exit")
+    subparsers = parser.add_subparsers(dest="command")
+    loadtest_parser = subparsers.add_parser(
+        "loadtest", help="ramp concurrent ticket-mint-and-open sessions against nodes and report throughput/latency"
+    )
+    loadtest_parser.add_argument("--nodes", nargs="+", help="nodes to load test (default: every node of every cluster)")
+    loadtest_parser.add_argument("--steps", type=int, nargs="+", default=[1, 2, 4, 8, 16],
+                                 help="concurrent sessions per node at each step")
+    loadtest_parser.add_argument("--step-seconds", type=int, default=30, help="how long each step runs")
+    loadtest_parser.add_argument("--rate", type=float, default=0,
+                                 help="maximum new sessions per second per node (0 for no limit)")
+    loadtest_parser.add_argument("--max-error-rate", type=float, default=0.05,
+                                 help="stop ramping a node once a step's error rate is above this fraction")
+    loadtest_parser.add_argument("--max-p95", type=float, default=0,
+                                 help="stop ramping a node once a step's ticket + open p95 is above this many seconds")
+    loadtest_parser.add_argument("--json", help="also write the per-step reports to this file")
+    replay_parser = subparsers.add_parser(
+        "replay", help="replay recorded runs offline and report where the decisions differ from the recording"
+    )
+    replay_parser.add_argument("recordings", nargs="+", help="recording files, or directories of them")
+    replay_parser.add_argument("--verbose", action="store_true", help="log the replayed runs as a live run would")
+    replay_parser.add_argument("--json", help="also write the per-recording reports to this file")
+    args = parser.parse_args()
+    try:
+        if args.command == "loadtest":
+            if not args.nodes:
+                refresh_inventories()
+            sys.exit(load_test(args.nodes or monitored_nodes(), args.steps, args.step_seconds, args.rate,
+                               args.max_error_rate, args.max_p95, args.json))
+        elif args.command == "replay":
+            sys.exit(replay_recordings(args.recordings, args.verbose, args.json))
+        elif args.startup_report:
+            sys.exit(startup_report())
+        elif args.check_config:
+            settings.validate()
+            print(f"{config_file_path} is valid")
+        else:
+            run_lock = acquire_run_lock()
+            if run_lock is None:
+                sys.exit(1)
+            try:
+                if args.daemon:
+                    run_daemon()
+                else:
+                    main(args.record)
+            finally:
+                release_run_lock(run_lock)
+    except ConfigError as e:
+        logging.error(e)
+        sys.exit(2)
     #meme_testing()
\ No newline at end of file
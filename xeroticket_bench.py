@@ -0,0 +1,721 @@
+import argparse
+import configparser
+import datetime
+import http.server
+import importlib.util
+import ipaddress
+import json
+import logging
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import socketserver
+import ssl
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import paramiko
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+# Benchmark harness: starts a local stand-in farm (fake Xero HTTPS endpoints, an SSH server stub, an SMTP sink
+# and a fake ServiceNow table API) in a child process, points xeroticket at it through a generated config,
+# and times main() for each requested cluster size.
+#
+# Every simulated node is a loopback address (127.0.X.Y). The farm listens on each of those addresses (or on
+# --bind, if that isn't a loopback address) and identifies the node from the address each connection arrived on.
+
+
+def node_addresses(count):
+    base = int(ipaddress.IPv4Address("127.0.1.1"))
+    addresses = []
+    offset = 0
+    while len(addresses) < count:
+        address = ipaddress.IPv4Address(base + offset)
+        offset += 1
+        # skip .0 and .255 so every address is a usable host address
+        if address.packed[-1] in (0, 255):
+            continue
+        addresses.append(str(address))
+    return addresses
+
+
+def generate_certificate(directory):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "xeroticket-bench")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.IPv4Address("127.0.0.1"))]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(directory, "bench-cert.pem")
+    key_path = os.path.join(directory, "bench-key.pem")
+    with open(cert_path, "wb") as file:
+        file.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as file:
+        file.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()
+        ))
+    return cert_path, key_path
+
+
+# Shared fault model for every fake service in the farm
+class FaultProfile:
+    def __init__(self, options, failing_nodes, slow_wado_nodes=(), full_cache_nodes=()):
+        self.latency = options["latency_ms"] / 1000
+        self.jitter = options["jitter_ms"] / 1000
+        self.error_rate = options["error_rate"]
+        self.hung_rate = options["hung_rate"]
+        self.hang_seconds = options["hang_seconds"]
+        self.recovery_rate = options["recovery_rate"]
+        self.failing_nodes = set(failing_nodes)
+        self.slow_wado_nodes = set(slow_wado_nodes)
+        self.full_cache_nodes = set(full_cache_nodes)
+        self.wado_object_size = int(options.get("wado_object_kb", 0) * 1024)
+        self.wado_kbps = options.get("wado_kbps", 0)
+        self.lock = threading.Lock()
+
+    def delay(self, scale=1.0):
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)) * scale)
+
+    def hangs(self):
+        if random.random() < self.hung_rate:
+            time.sleep(self.hang_seconds)
+            return True
+        return False
+
+    def errors(self):
+        return random.random() < self.error_rate
+
+    def is_failing(self, node):
+        with self.lock:
+            return node in self.failing_nodes
+
+    def wado_rate(self, node):
+        # bytes per second a node streams WADO bodies at, slow nodes run at a tenth of the configured rate
+        rate = self.wado_kbps * 1024
+        return rate / 10 if node in self.slow_wado_nodes else rate
+
+    def wado_cache_usage(self, node, count_files=True):
+        # two 100 GB cache volumes per node, 92% used on nodes with a full cache and 40% otherwise
+        with self.lock:
+            used_percent = 92 if node in self.full_cache_nodes else 40
+        volume = 100 * 1024 ** 3
+        return "".join(
+            f"/wado2cache{index} {volume} {volume * used_percent // 100}"
+            + (f" {used_percent * 1000}" if count_files else "") + "\n"
+            for index in (1, 2)
+        )
+
+    def purged(self, node):
+        with self.lock:
+            was_full = node in self.full_cache_nodes
+            self.full_cache_nodes.discard(node)
+        # a full cache is what broke the node, so the purge fixes it as often as a restart would
+        if was_full:
+            self.restarted(node)
+
+    def restarted(self, node):
+        if random.random() < self.recovery_rate:
+            with self.lock:
+                self.failing_nodes.discard(node)
+
+
+class BenchHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeXeroHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    profile = None
+
+    def node(self):
+        return self.connection.getsockname()[0]
+
+    def reply(self, status, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, ok_body):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        if self.profile.hangs():
+            return
+        self.profile.delay()
+        if self.profile.is_failing(self.node()):
+            self.reply(503, "node failing")
+        elif self.profile.errors():
+            self.reply(500, "injected error")
+        else:
+            self.reply(200, ok_body)
+
+    def do_POST(self):
+        if self.path.startswith("/encodedTicket"):
+            self.handle_request(f"TICKET-{random.getrandbits(64):016x}")
+        else:
+            self.reply(404, "not found")
+
+    def do_GET(self):
+        if self.path.startswith("/wado"):
+            self.stream_wado_object()
+        else:
+            self.handle_request("<html><body>viewer</body></html>")
+
+    def do_HEAD(self):
+        # daemon liveness checks, headers only
+        self.profile.delay()
+        self.send_response(503 if self.profile.is_failing(self.node()) else 200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def stream_wado_object(self):
+        if self.profile.hangs():
+            return
+        self.profile.delay()
+        if self.profile.is_failing(self.node()):
+            self.reply(503, "node failing")
+            return
+        size = self.profile.wado_object_size
+        rate = self.profile.wado_rate(self.node())
+        self.send_response(200)
+        self.send_header("Content-Type", "application/dicom")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        chunk = bytes(16384)
+        sent = 0
+        start = time.perf_counter()
+        try:
+            while sent < size:
+                piece = chunk[:size - sent]
+                self.wfile.write(piece)
+                sent += len(piece)
+                # pace the body so it averages the node's configured rate
+                ahead = sent / rate - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            # the probe stops reading once it reaches its byte cap
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServiceNowHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    profile = None
+    counter = 0
+    counter_lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.profile.hangs():
+            return
+        self.profile.delay()
+        if self.profile.errors():
+            status, body = 503, {"error": "injected error"}
+        else:
+            with self.counter_lock:
+                FakeServiceNowHandler.counter += 1
+                number = FakeServiceNowHandler.counter
+            status, body = 201, {"result": {"u_task_string": f"INC{number:07d}", "u_task": {"value": f"{number:032x}"}}}
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSSHServer(paramiko.ServerInterface):
+    def __init__(self, profile, node):
+        self.profile = profile
+        self.node = node
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        def run():
+            # give the client a moment to see the exec request acknowledged before output arrives
+            time.sleep(0.01)
+            if not self.profile.hangs():
+                self.profile.delay(scale=5)
+                if b"restart" in command:
+                    self.profile.restarted(self.node)
+                if b"df -P" in command:
+                    channel.sendall(self.profile.wado_cache_usage(self.node, b"find" in command).encode())
+                else:
+                    if b"-delete" in command:
+                        self.profile.purged(self.node)
+                    channel.sendall(b"ok\n")
+                channel.send_exit_status(0)
+            channel.close()
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+
+def serve_ssh(listeners, host_key, profile):
+    def handle(connection):
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(host_key)
+        try:
+            transport.start_server(server=FakeSSHServer(profile, connection.getsockname()[0]))
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+    accept_forever(listeners, lambda connection, address: threading.Thread(
+        target=handle, args=(connection,), daemon=True).start())
+
+
+# One listening socket per address, all on the port the first one was given
+def listen_on(addresses):
+    listeners = []
+    port = 0
+    for address in addresses:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((address, port))
+        listener.listen(1024)
+        port = listener.getsockname()[1]
+        listeners.append(listener)
+    return listeners
+
+
+def accept_forever(listeners, handle):
+    selector = selectors.DefaultSelector()
+    for listener in listeners:
+        selector.register(listener, selectors.EVENT_READ)
+    while True:
+        for key, _ in selector.select():
+            try:
+                connection, address = key.fileobj.accept()
+            except OSError:
+                continue
+            handle(connection, address)
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    profile = None
+    received = 0
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 xeroticket-bench SMTP sink")
+        in_data = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").rstrip("\r\n")
+            if in_data:
+                if command == ".":
+                    in_data = False
+                    self.profile.delay()
+                    SMTPSinkHandler.received += 1
+                    self.reply("250 queued")
+                continue
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "DATA":
+                in_data = True
+                self.reply("354 end data with <CR><LF>.<CR><LF>")
+            elif verb == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+def run_farm(options, nodes, failing_nodes, slow_wado_nodes, full_cache_nodes, cert_path, key_path, ready):
+    profile = FaultProfile(options, failing_nodes, slow_wado_nodes, full_cache_nodes)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    # a loopback --bind listens on each node's own address, so nothing is reachable from outside this host
+    addresses = nodes if ipaddress.ip_address(options["bind"]).is_loopback else [options["bind"]]
+    if resource is not None and len(addresses) > 1:
+        # two listening sockets per node, on top of the connections they accept
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = 4 * len(addresses) + 1024
+        if soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted if hard == resource.RLIM_INFINITY else min(wanted, hard), hard))
+
+    FakeXeroHandler.profile = profile
+    # the server only handles the connections accept_forever hands it, the TLS handshake happens on the handler thread
+    xero_server = BenchHTTPServer(("127.0.0.1", 0), FakeXeroHandler, bind_and_activate=False)
+    xero_listeners = listen_on(addresses)
+
+    # ServiceNow gets its own profile: latency and --service-now-error-rate, but no hung requests
+    service_now_profile = FaultProfile(dict(options, error_rate=options["service_now_error_rate"], hung_rate=0), [])
+    FakeServiceNowHandler.profile = service_now_profile
+    service_now_server = BenchHTTPServer(("127.0.0.1", 0), FakeServiceNowHandler)
+    service_now_server.socket = context.wrap_socket(service_now_server.socket, server_side=True)
+
+    SMTPSinkHandler.profile = FaultProfile(dict(options, error_rate=0, hung_rate=0), [])
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    smtp_server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPSinkHandler)
+    smtp_server.daemon_threads = True
+
+    ssh_listeners = listen_on(addresses)
+    host_key = paramiko.RSAKey.generate(2048)
+
+    for server in (service_now_server, smtp_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=accept_forever, args=(xero_listeners, lambda connection, address: xero_server.process_request(
+        context.wrap_socket(connection, server_side=True, do_handshake_on_connect=False), address)), daemon=True).start()
+    threading.Thread(target=serve_ssh, args=(ssh_listeners, host_key, profile), daemon=True).start()
+
+    ready.put({
+        "https_port": xero_listeners[0].getsockname()[1],
+        "service_now_port": service_now_server.server_address[1],
+        "smtp_port": smtp_server.server_address[1],
+        "ssh_port": ssh_listeners[0].getsockname()[1],
+    })
+    while True:
+        time.sleep(3600)
+
+
+def write_config(directory, ports, nodes, options):
+    key_path = os.path.join(directory, "bench-ssh-key")
+    if not os.path.exists(key_path):
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+
+    config = configparser.ConfigParser()
+    config["Xero"] = {
+        "xero_user": "bench",
+        "xero_password": "bench",
+        "xero_domain": "agility",
+        "xero_query_constraints": "",
+        "xero_nodes": ",".join(nodes[0::options["clusters"]]),
+        "cluster_name": "site1",
+        "xero_restart_command": "xero-restart -q",
+        "xero_haproxy_restart_command": "service agility-haproxy restart",
+        "xero_disable_command": "service agility-haproxy stop",
+        "xero_wado_purge_command": "find /wado2cache* -mmin +1440 -delete",
+        "xero_server_user": "bench",
+        "xero_server_private_key": key_path,
+        "xero_ssh_port": str(ports["ssh_port"]),
+        "xero_https_port": str(ports["https_port"]),
+        "xero_get_ticket_timeout": str(options["timeout"]),
+        "xero_ticket_validation_timeout": str(options["timeout"]),
+        "xero_retry_attempts": "2",
+        "xero_probe_concurrency": str(options["concurrency"]),
+        "xero_max_concurrent_restarts": str(options["max_restarts"]),
+        "xero_min_healthy_nodes": "1",
+        "disabled_servers_file": os.path.join(directory, "disabled_servers.txt"),
+        "failing_servers_file": os.path.join(directory, "failing_servers.txt"),
+        "circuit_breakers_file": os.path.join(directory, "circuit_breakers.txt"),
+        "restart_times_file": os.path.join(directory, "restart_times.txt"),
+        "pending_incidents_file": os.path.join(directory, "pending_incidents.txt"),
+        "node_inventory_file": os.path.join(directory, "node_inventory.txt"),
+        "state_db_file": os.path.join(directory, "xero_state.db"),
+        "xero_ready_initial_delay": "1",
+        "xero_wado": str(options["wado_kbps"] > 0),
+        "xero_wado_study_uid": "1.2.826.0.1.3680043.2.1143.1",
+        "xero_wado_series_uid": "1.2.826.0.1.3680043.2.1143.1.1",
+        "xero_wado_object_uids": "1.2.826.0.1.3680043.2.1143.1.1.1,1.2.826.0.1.3680043.2.1143.1.1.2",
+        "xero_wado_min_throughput": str(max(1, int(options["wado_kbps"] / 4))),
+        "degraded_servers_file": os.path.join(directory, "degraded_servers.txt"),
+        "wado_cache_file": os.path.join(directory, "wado_cache.txt"),
+        "validation_study_PatientID": "BENCH",
+        "validation_study_AccessionNumber": "BENCH",
+        "theme": "efv",
+        "cluster_db_host": "127.0.0.1",
+        "cluster_db_port": "1521",
+        "cluster_db_service_name": "bench",
+        "cluster_db_user": "bench",
+        "cluster_db_password": "bench",
+    }
+    # the other clusters share the stand-in farm and cluster DB, each with its own state files
+    for index in range(1, options["clusters"]):
+        config[f"Cluster site{index + 1}"] = {
+            "xero_nodes": ",".join(nodes[index::options["clusters"]]),
+            "disabled_servers_file": os.path.join(directory, f"disabled_servers_site{index + 1}.txt"),
+            "failing_servers_file": os.path.join(directory, f"failing_servers_site{index + 1}.txt"),
+        }
+    config["History"] = {
+        "history_dir": os.path.join(directory, "probe_history"),
+        "drifting_servers_file": os.path.join(directory, "drifting_servers.txt"),
+    }
+    config["Email"] = {
+        "smtp_server": "127.0.0.1",
+        "smtp_port": str(ports["smtp_port"]),
+        "smtp_username": "",
+        "smtp_password": "None",
+        "smtp_from_domain": "bench.invalid",
+        "smtp_recipients": "oncall@bench.invalid",
+        "smtp_spool_dir": os.path.join(directory, "email_spool"),
+    }
+    config["ServiceNow"] = {
+        "api_user": "bench",
+        "api_password": "bench",
+        "instance": f"127.0.0.1:{ports['service_now_port']}",
+        "table": "u_incident_import",
+        "ticket_type": "incident",
+        "configuration_item": "xero",
+        "assignment_group": "bench",
+        "assignee": "",
+        "business_hours_start_time": "08:00:00",
+        "business_hours_end_time": "17:00:00",
+        "after_hours_urgency": "3",
+        "after_hours_impact": "3",
+        "business_hours_urgency": "3",
+        "business_hours_impact": "3",
+    }
+    config["Run"] = {
+        "deferred_work_file": os.path.join(directory, "deferred_work.txt"),
+        "lock_file": os.path.join(directory, "xeroticket.lock"),
+    }
+    config["Logging"] = {
+        "log_file": os.path.join(directory, "xero_ticket.log"),
+    }
+    config["Meme"] = {
+        "use_memes": str(options["memes"]),
+        "successful_restart_meme": "No_Need_To_Thank_Me.jpg",
+        "unsuccessful_restart_meme": "Boromir.jpg",
+        "font": "Impact.ttf",
+    }
+    config_path = os.path.join(directory, "xeroticket-bench.ini")
+    with open(config_path, "w") as file:
+        config.write(file)
+    return config_path
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+# The cluster DB is stood in for by replacing fetch_upgrade_status, so the Oracle client is never used. Without
+# it installed, the upgrade status code still imports cx_Oracle for its DatabaseError; this module provides that.
+def install_fake_cx_oracle():
+    if importlib.util.find_spec("cx_Oracle") is not None:
+        return
+    cx_oracle = types.ModuleType("cx_Oracle")
+
+    class DatabaseError(Exception):
+        pass
+
+    def unavailable(*args, **kwargs):
+        raise DatabaseError("the bench has no Oracle client, queries go to its stand-in")
+
+    cx_oracle.DatabaseError = DatabaseError
+    cx_oracle.makedsn = cx_oracle.SessionPool = cx_oracle.connect = unavailable
+    cx_oracle.SPOOL_ATTRVAL_WAIT = 0
+    sys.modules["cx_Oracle"] = cx_oracle
+
+
+class RunSampler:
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_event.set()
+        self.thread.join()
+
+
+def run_benchmark(xeroticket, nodes, options):
+    settings = xeroticket.settings
+    cluster_files = [path for cluster in xeroticket.clusters for path in (cluster.disabled_servers_file, cluster.failing_servers_file)]
+    for path in cluster_files + [settings.degraded_servers_file, settings.wado_cache_file,
+                                 settings.drifting_servers_file, settings.circuit_breakers_file,
+                                 settings.pending_incidents_file, settings.deferred_work_file]:
+        if os.path.exists(path):
+            os.remove(path)
+    # the nodes of this run are dealt out to the clusters round robin, like write_config did
+    for index, cluster in enumerate(xeroticket.clusters):
+        cluster.nodes = nodes[index::len(xeroticket.clusters)]
+        cluster.open_stores()
+        cluster.upgrade_status_snapshot.update(fetched_at=None, nodes=None)
+    xeroticket.degraded_servers_store = xeroticket.open_state_store("degraded_servers", settings.degraded_servers_file)
+    xeroticket.wado_cache_store = xeroticket.open_state_store("wado_cache", settings.wado_cache_file)
+    xeroticket.circuit_breakers_store = xeroticket.open_state_store("circuit_breakers", settings.circuit_breakers_file)
+    xeroticket.drifting_servers_store = xeroticket.open_state_store("drifting_servers", settings.drifting_servers_file)
+    xeroticket.pending_incidents_store = xeroticket.open_state_store("pending_incidents", settings.pending_incidents_file)
+    xeroticket.deferred_work_store = xeroticket.open_state_store("deferred_work", settings.deferred_work_file)
+
+    # keep every raw latency that goes through the metrics registry so exact percentiles can be reported
+    samples = {}
+    original_observe = xeroticket.metrics.observe
+
+    def observe(name, documentation, labels, value):
+        phase = labels.get("phase")
+        samples.setdefault(f"{name}[{phase}]" if phase else name, []).append(value)
+        original_observe(name, documentation, labels, value)
+
+    xeroticket.metrics.observe = observe
+    tracemalloc.start()
+    try:
+        with RunSampler() as sampler:
+            start = time.perf_counter()
+            xeroticket.main()
+            wall = time.perf_counter() - start
+        _, peak_traced = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        xeroticket.metrics.observe = original_observe
+
+    return {
+        "nodes": len(nodes),
+        "wall_seconds": wall,
+        "peak_threads": sampler.peak_threads,
+        "peak_traced_mb": peak_traced / 1024 / 1024,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else None,
+        "phases": {
+            name: {
+                "count": len(values),
+                "p50_ms": percentile(values, 0.50) * 1000,
+                "p95_ms": percentile(values, 0.95) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "mean_ms": statistics.fmean(values) * 1000,
+            }
+            for name, values in sorted(samples.items())
+        },
+    }
+
+
+def print_report(report):
+    print(
+        f"\n{report['nodes']} nodes: wall {report['wall_seconds']:.2f}s, peak threads {report['peak_threads']}, "
+        f"peak traced {report['peak_traced_mb']:.1f} MB"
+        + (f", max RSS {report['max_rss_mb']:.1f} MB" if report["max_rss_mb"] is not None else "")
+    )
+    print(f"  {'phase':<48} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, phase in report["phases"].items():
+        print(f"  {name:<48} {phase['count']:>6} {phase['p50_ms']:>9.1f} {phase['p95_ms']:>9.1f} {phase['p99_ms']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark xeroticket runs against a local stand-in Xero farm")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[5, 50, 500], help="cluster sizes to run")
+    parser.add_argument("--runs", type=int, default=1, help="runs per cluster size")
+    parser.add_argument("--latency-ms", type=float, default=20, help="mean service latency of every fake endpoint")
+    parser.add_argument("--jitter-ms", type=float, default=5, help="standard deviation of the service latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of Xero requests answered with HTTP 500")
+    parser.add_argument("--hung-rate", type=float, default=0.0, help="fraction of requests/commands that never answer")
+    parser.add_argument("--hang-seconds", type=float, default=60, help="how long a hung request holds its connection")
+    parser.add_argument("--failing-fraction", type=float, default=0.0,
+                        help="fraction of nodes that fail every probe, exercising the restart/disable path")
+    parser.add_argument("--recovery-rate", type=float, default=1.0,
+                        help="probability that a restart fixes a failing node")
+    parser.add_argument("--wado-kbps", type=float, default=0,
+                        help="enable the WADO probe, with every node streaming objects at this rate (0 disables it)")
+    parser.add_argument("--wado-object-kb", type=float, default=512, help="size of each WADO object served")
+    parser.add_argument("--slow-wado-fraction", type=float, default=0.0,
+                        help="fraction of nodes serving WADO at a tenth of --wado-kbps, below the probe's "
+                             "degraded threshold of a quarter of --wado-kbps")
+    parser.add_argument("--full-cache-fraction", type=float, default=0.0,
+                        help="fraction of nodes whose WADO cache is over the purge threshold, failing nodes first")
+    parser.add_argument("--service-now-error-rate", type=float, default=0.0)
+    parser.add_argument("--db-latency-ms", type=float, default=20, help="latency of the stand-in upgrade status query")
+    parser.add_argument("--timeout", type=int, default=5, help="ticket/verification timeout written to the config")
+    parser.add_argument("--concurrency", type=int, default=10, help="xero_probe_concurrency written to the config")
+    parser.add_argument("--max-restarts", type=int, default=1, help="xero_max_concurrent_restarts written to the config")
+    parser.add_argument("--clusters", type=int, default=1,
+                        help="split the nodes round robin into this many clusters, each with its own state and limits")
+    parser.add_argument("--memes", action="store_true", help="render memes for notifications")
+    parser.add_argument("--bind", default="127.0.0.1",
+                        help="address the fake Xero HTTPS/SSH endpoints listen on, it must cover 127.0.X.Y (e.g. 0.0.0.0); "
+                             "a loopback address listens on each simulated node's own address")
+    parser.add_argument("--json", help="also write the reports to this file")
+    args = parser.parse_args()
+    options = vars(args)
+
+    directory = tempfile.mkdtemp(prefix="xeroticket-bench-")
+    cert_path, key_path = generate_certificate(directory)
+    all_nodes = node_addresses(max(args.nodes))
+    failing_nodes = random.sample(all_nodes, int(len(all_nodes) * args.failing_fraction))
+    slow_wado_nodes = random.sample(all_nodes, int(len(all_nodes) * args.slow_wado_fraction))
+    # failing nodes get the full caches first, so the purge-before-restart path is exercised
+    full_cache_nodes = (failing_nodes + [node for node in all_nodes if node not in failing_nodes])[
+        :int(len(all_nodes) * args.full_cache_fraction)
+    ]
+
+    ready = multiprocessing.Queue()
+    farm = multiprocessing.Process(target=run_farm, args=(options, all_nodes, failing_nodes, slow_wado_nodes, full_cache_nodes, cert_path, key_path, ready), daemon=True)
+    farm.start()
+    ports = ready.get(timeout=60)
+
+    os.environ["XEROTICKET_CONFIG"] = write_config(directory, ports, all_nodes, options)
+    # the fake ServiceNow presents the bench certificate, trust it for this process only
+    os.environ["REQUESTS_CA_BUNDLE"] = cert_path
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    install_fake_cx_oracle()
+    import xeroticket
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # stand-in for the cluster DB: nothing is in PREPARE, every lookup costs db_latency_ms
+    def fetch_upgrade_status(cluster):
+        time.sleep(args.db_latency_ms / 1000)
+        return {}
+    xeroticket.fetch_upgrade_status = fetch_upgrade_status
+
+    reports = []
+    try:
+        for count in args.nodes:
+            for _ in range(args.runs):
+                report = run_benchmark(xeroticket, all_nodes[:count], options)
+                print_report(report)
+                reports.append(report)
+    finally:
+        farm.terminate()
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(reports, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()